@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# compares the bbox filter to the equivalent lon / lat greater_or_equal / lower_or_equal filters
+# usage: bin/benchmark_bbox_filter.py [BBOX] [RECORDED_AT_TIME_FROM] [RECORDED_AT_TIME_TO] [ITERATIONS]
+# e.g.: bin/benchmark_bbox_filter.py 34.75,32.03,34.82,32.1 2023-05-01T00:00:00+03:00 2023-05-02T00:00:00+03:00 5
+# requires the open_bus_stride_api package to be installed (pip install -e .) and the db env vars to be set
+# the bbox filter can use a gist index on the point(lon, lat) expression, the indexes are created by the stride db migrations
+# the scan node types of each query are printed, so it can be checked whether the indexes exist and are used
+import sys
+import json
+import datetime
+import statistics
+
+import sqlalchemy
+from open_bus_stride_db import model
+from open_bus_stride_db.db import get_session
+
+from open_bus_stride_api.routers import common
+
+
+def get_filters(form, db_model, bbox):
+    if form == 'bbox':
+        return [{'type': 'bbox', 'fields': (db_model.lon, db_model.lat), 'value': bbox}]
+    else:
+        lon_min, lat_min, lon_max, lat_max = common.parse_bbox(bbox)
+        return [
+            {'type': 'greater_or_equal', 'field': db_model.lon, 'value': lon_min},
+            {'type': 'lower_or_equal', 'field': db_model.lon, 'value': lon_max},
+            {'type': 'greater_or_equal', 'field': db_model.lat, 'value': lat_min},
+            {'type': 'lower_or_equal', 'field': db_model.lat, 'value': lat_max},
+        ]
+
+
+def explain_analyze(session, statement):
+    compiled = statement.compile(dialect=session.bind.dialect)
+    res = session.connection().exec_driver_sql('EXPLAIN (ANALYZE, FORMAT JSON) {}'.format(compiled), compiled.params).scalar()
+    return (json.loads(res) if isinstance(res, str) else res)[0]
+
+
+def get_scan_node_types(plan):
+    node_types = set()
+    if 'Scan' in plan['Node Type']:
+        node_types.add('{} ({})'.format(plan['Node Type'], plan.get('Index Name', plan.get('Relation Name'))))
+    for sub_plan in plan.get('Plans', []):
+        node_types.update(get_scan_node_types(sub_plan))
+    return node_types
+
+
+def benchmark(session, db_model, extra_filters, bbox, iterations):
+    res = {}
+    for form in ['lon_lat', 'bbox']:
+        q = common.get_list_query(session, db_model, None, None, [*extra_filters, *get_filters(form, db_model, bbox)],
+                                  get_count=True)
+        statement = sqlalchemy.select(sqlalchemy.func.count()).select_from(q.statement.subquery())
+        execution_times = []
+        for _ in range(int(iterations)):
+            explain = explain_analyze(session, statement)
+            execution_times.append(explain['Execution Time'])
+        res[form] = statistics.median(execution_times)
+        print('{} {}: median {:.2f}ms, min {:.2f}ms, {}'.format(
+            db_model.__tablename__, form, res[form], min(execution_times),
+            ', '.join(sorted(get_scan_node_types(explain['Plan'])))
+        ))
+    print('{} speed-up: {:.2f}x'.format(db_model.__tablename__, res['lon_lat'] / res['bbox'] if res['bbox'] else float('inf')))
+
+
+def main(bbox='34.75,32.03,34.82,32.1', recorded_at_time_from=None, recorded_at_time_to=None, iterations='5'):
+    if recorded_at_time_to:
+        recorded_at_time_to = datetime.datetime.fromisoformat(recorded_at_time_to)
+    else:
+        recorded_at_time_to = datetime.datetime.now(datetime.timezone.utc)
+    if recorded_at_time_from:
+        recorded_at_time_from = datetime.datetime.fromisoformat(recorded_at_time_from)
+    else:
+        recorded_at_time_from = recorded_at_time_to - datetime.timedelta(days=1)
+    with get_session() as session:
+        benchmark(session, model.SiriVehicleLocation, [
+            {'type': 'datetime_from', 'field': model.SiriVehicleLocation.recorded_at_time, 'value': recorded_at_time_from},
+            {'type': 'datetime_to', 'field': model.SiriVehicleLocation.recorded_at_time, 'value': recorded_at_time_to},
+        ], bbox, iterations)
+        benchmark(session, model.GtfsStop, [
+            {'type': 'datetime_from', 'field': model.GtfsStop.date, 'value': recorded_at_time_from.date()},
+            {'type': 'datetime_to', 'field': model.GtfsStop.date, 'value': recorded_at_time_to.date()},
+        ], bbox, iterations)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
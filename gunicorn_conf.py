@@ -49,6 +49,25 @@ timeout = int(timeout_str)
 keepalive = int(keepalive_str)
 
 
+prometheus_multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+# the workers split DB_MAX_CONNECTIONS between them, so that scaling to more workers doesn't exceed the postgresql max_connections
+os.environ["DB_POOL_WORKERS"] = str(workers)
+
+
+def on_starting(server):
+    # metrics files of previous runs must be removed, otherwise their values are added to the new metrics
+    if prometheus_multiproc_dir:
+        os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+        for filename in os.listdir(prometheus_multiproc_dir):
+            os.remove(os.path.join(prometheus_multiproc_dir, filename))
+
+
+def child_exit(server, worker):
+    if prometheus_multiproc_dir:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
 # For debugging and testing
 log_data = {
     "loglevel": loglevel,
@@ -64,5 +83,7 @@ log_data = {
     "use_max_workers": use_max_workers,
     "host": host,
     "port": port,
+    "prometheus_multiproc_dir": prometheus_multiproc_dir,
+    "db_max_connections": os.getenv("DB_MAX_CONNECTIONS"),
 }
 print(json.dumps(log_data))
\ No newline at end of file
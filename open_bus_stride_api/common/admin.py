@@ -0,0 +1,20 @@
+import os
+import hmac
+
+
+# token required for the admin endpoints and debug features, they are disabled if it's not set
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+
+def get_request_admin_token(get_header):
+    # get_header(name, default) returns a request header, the token is sent in the X-Admin-Token or Authorization: Bearer header
+    token = get_header('x-admin-token', None)
+    authorization = get_header('authorization', None) or ''
+    if not token and authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    return token
+
+
+def is_admin_token_valid(token):
+    # always invalid if ADMIN_TOKEN is not set
+    return bool(ADMIN_TOKEN and token) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
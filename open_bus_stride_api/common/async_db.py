@@ -0,0 +1,46 @@
+import os
+
+import sqlalchemy.engine
+import sqlalchemy.ext.asyncio
+import sqlalchemy.orm
+
+from . import db_pool
+
+
+# when enabled, list/get routes use an asyncpg connection pool instead of running the sync db code in the threadpool
+ASYNC_DB = os.environ.get('ASYNC_DB', '').lower() in ('1', 'true', 'yes')
+ASYNC_DB_POOL_SIZE = int(os.environ.get('ASYNC_DB_POOL_SIZE', '20'))
+ASYNC_DB_MAX_OVERFLOW = int(os.environ.get('ASYNC_DB_MAX_OVERFLOW', '10'))
+ASYNC_DB_POOL_TIMEOUT = int(os.environ.get('ASYNC_DB_POOL_TIMEOUT', '30'))
+
+
+_async_sessionmaker = None
+
+
+def get_async_sqlalchemy_url():
+    url = sqlalchemy.engine.make_url(os.environ['SQLALCHEMY_URL']).set(drivername='postgresql+asyncpg')
+    if db_pool.DB_PGBOUNCER:
+        url = url.update_query_dict({'prepared_statement_cache_size': '0'})
+    return url
+
+
+def get_async_sessionmaker():
+    # engine is created on first use, so that each gunicorn worker process creates its own pool
+    global _async_sessionmaker
+    if _async_sessionmaker is None:
+        pool_kwargs = db_pool.get_engine_pool_kwargs(ASYNC_DB_POOL_SIZE, ASYNC_DB_MAX_OVERFLOW, ASYNC_DB_POOL_TIMEOUT)
+        connect_args = {'server_settings': {
+            'application_name': os.environ.get('SQLALCHEMY_APPLICATION_NAME', 'api'),
+        }}
+        if db_pool.DB_PGBOUNCER:
+            connect_args['statement_cache_size'] = 0
+        engine = sqlalchemy.ext.asyncio.create_async_engine(get_async_sqlalchemy_url(), connect_args=connect_args, **pool_kwargs)
+        db_pool.register_pool('async', engine.sync_engine, pool_kwargs)
+        _async_sessionmaker = sqlalchemy.orm.sessionmaker(
+            engine, class_=sqlalchemy.ext.asyncio.AsyncSession, expire_on_commit=False
+        )
+    return _async_sessionmaker
+
+
+def get_async_session():
+    return get_async_sessionmaker()()
@@ -0,0 +1,343 @@
+import os
+import time
+import pickle
+import hashlib
+import logging
+import datetime
+import functools
+import threading
+import collections
+
+import fastapi
+
+from . import request_context, http_cache, response_formats
+
+
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', 'yes').lower() in ('1', 'true', 'yes')
+# memory - separate cache for each worker process
+# shm - cache files in shared memory directory, shared by all worker processes on the same host
+# redis - redis compatible server, shared by all workers which use the same server (requires the redis package)
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+CACHE_MAX_ITEMS = int(os.environ.get('CACHE_MAX_ITEMS', '1000'))
+# results with more rows are not cached, to limit the cache memory usage
+CACHE_MAX_ITEM_ROWS = int(os.environ.get('CACHE_MAX_ITEM_ROWS', '1000'))
+# ttl for queries which are limited to closed dates (see http_cache.is_closed_date), this data is not modified after it was loaded by the ETL
+CACHE_HISTORICAL_TTL_SECONDS = int(os.environ.get('CACHE_HISTORICAL_TTL_SECONDS', str(60 * 60 * 24)))
+# ttl for queries which include dates which are not closed yet, this data may still be updated by the ETL
+CACHE_CURRENT_TTL_SECONDS = int(os.environ.get('CACHE_CURRENT_TTL_SECONDS', '300'))
+# gunicorn worker_tmp_dir is /dev/shm, so it's available in the docker image
+CACHE_SHM_DIR = os.environ.get('CACHE_SHM_DIR', '/dev/shm/open-bus-stride-api-cache')
+CACHE_SHM_MAX_BYTES = int(os.environ.get('CACHE_SHM_MAX_BYTES', str(256 * 1024 * 1024)))
+# expired and excess cache files are removed after this number of cache writes
+CACHE_SHM_CLEANUP_INTERVAL = int(os.environ.get('CACHE_SHM_CLEANUP_INTERVAL', '50'))
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+CACHE_REDIS_KEY_PREFIX = os.environ.get('CACHE_REDIS_KEY_PREFIX', 'open-bus-stride-api:cache:')
+CACHE_STATUS_HEADER = 'X-Cache'
+
+
+class LRUCache:
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        # returns tuple of (found, value)
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                expires, value = item
+                if expires > time.time():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._items[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, ttl_seconds):
+        with self._lock:
+            self._items[key] = (time.time() + ttl_seconds, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'items': len(self._items),
+                'max_items': self.max_items,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class SharedMemoryCache:
+    # each item is stored in a separate file, named by the hash of the key
+    # files are written atomically, so it's safe to use from multiple processes without locking
+    # the file modification time is updated on read and used for the LRU eviction
+
+    def __init__(self, path, max_items, max_bytes, cleanup_interval=CACHE_SHM_CLEANUP_INTERVAL):
+        self.path = path
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.cleanup_interval = cleanup_interval
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._num_sets = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get_filename(self, key):
+        return os.path.join(self.path, hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, key):
+        filename = self._get_filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                expires, item_key, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            expires, item_key, value = None, None, None
+        if item_key == key and expires > time.time():
+            try:
+                os.utime(filename)
+            except OSError:
+                pass
+            with self._lock:
+                self.hits += 1
+            return True, value
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def set(self, key, value, ttl_seconds):
+        filename = self._get_filename(key)
+        tmp_filename = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump((time.time() + ttl_seconds, key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+        with self._lock:
+            self._num_sets += 1
+            cleanup = self._num_sets % self.cleanup_interval == 0
+        if cleanup:
+            self.cleanup()
+
+    def _iterate_files(self):
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield entry.path, stat
+
+    def cleanup(self):
+        # removes least recently used files until both max items and max bytes limits are met
+        # expired items are removed when they are read, or when evicted by this cleanup
+        files = sorted(self._iterate_files(), key=lambda item: item[1].st_mtime)
+        total_bytes = sum(stat.st_size for _, stat in files)
+        num_files = len(files)
+        for filename, stat in files:
+            if num_files <= self.max_items and total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            num_files -= 1
+            total_bytes -= stat.st_size
+            with self._lock:
+                self.evictions += 1
+
+    def clear(self):
+        for filename, _ in self._iterate_files():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def get_stats(self):
+        files = list(self._iterate_files())
+        with self._lock:
+            return {
+                'items': len(files),
+                'bytes': sum(stat.st_size for _, stat in files),
+                'max_items': self.max_items,
+                'max_bytes': self.max_bytes,
+                # counters are for the current worker process only
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class RedisCache:
+    # LRU eviction should be configured on the redis server using maxmemory and maxmemory-policy=allkeys-lru
+    # errors are logged and handled as cache misses, so that the api keeps working if redis is not available
+
+    def __init__(self, client=None, url=CACHE_REDIS_URL, key_prefix=CACHE_REDIS_KEY_PREFIX):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.key_prefix = key_prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _get_redis_key(self, key):
+        return self.key_prefix + hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key):
+        try:
+            data = self.client.get(self._get_redis_key(key))
+            item_key, value = pickle.loads(data) if data is not None else (None, None)
+        except Exception:
+            logging.exception('failed to get item from redis cache')
+            item_key, value = None, None
+            with self._lock:
+                self.errors += 1
+        with self._lock:
+            if item_key == key:
+                self.hits += 1
+                return True, value
+            else:
+                self.misses += 1
+                return False, None
+
+    def set(self, key, value, ttl_seconds):
+        try:
+            self.client.set(self._get_redis_key(key), pickle.dumps((key, value), protocol=pickle.HIGHEST_PROTOCOL), ex=int(ttl_seconds))
+        except Exception:
+            logging.exception('failed to set item in redis cache')
+            with self._lock:
+                self.errors += 1
+
+    def clear(self):
+        for redis_key in self.client.scan_iter(match=self.key_prefix + '*'):
+            self.client.delete(redis_key)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                # counters are for the current worker process only
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+            }
+
+
+def create_cache_backend(backend):
+    if backend == 'memory':
+        return LRUCache(CACHE_MAX_ITEMS)
+    elif backend == 'shm':
+        return SharedMemoryCache(CACHE_SHM_DIR, CACHE_MAX_ITEMS, CACHE_SHM_MAX_BYTES)
+    elif backend == 'redis':
+        return RedisCache()
+    else:
+        raise Exception(f'invalid cache backend: {backend}')
+
+
+_cache = create_cache_backend(CACHE_BACKEND) if CACHE_ENABLED else None
+
+
+def get_stats():
+    if _cache is None:
+        return {'enabled': False}
+    return {'enabled': True, 'backend': CACHE_BACKEND, **_cache.get_stats()}
+
+
+def _normalize_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    elif isinstance(value, str):
+        return value.strip()
+    else:
+        return str(value)
+
+
+def get_cache_key(func, kwargs):
+    return '{}.{}?{}'.format(func.__module__, func.__qualname__, '&'.join(
+        f'{name}={_normalize_value(value)}' for name, value in sorted(kwargs.items()) if value is not None
+    ))
+
+
+def get_ttl_seconds(kwargs, date_to_param_names):
+    if http_cache.is_historical_query(kwargs, date_to_param_names):
+        return CACHE_HISTORICAL_TTL_SECONDS
+    else:
+        return CACHE_CURRENT_TTL_SECONDS
+
+
+def _get_cache_value(res, max_item_rows):
+    # returns the value to cache, or None if the result should not be cached
+    context = request_context.get_request_context()
+    response_headers = dict(context['response_headers']) if context else {}
+    if isinstance(res, list):
+        if len(res) <= max_item_rows:
+            return {'data': res, 'response_headers': response_headers}
+    elif isinstance(res, fastapi.Response) and not isinstance(res, fastapi.responses.StreamingResponse):
+        return {
+            'body': res.body, 'status_code': res.status_code, 'media_type': res.media_type,
+            'headers': {key.decode('latin-1'): value.decode('latin-1') for key, value in res.raw_headers if key != b'content-length'},
+            'response_headers': response_headers,
+        }
+    return None
+
+
+def _get_cached_response(value):
+    for name, header_value in value['response_headers'].items():
+        request_context.set_response_header(name, header_value)
+    if 'data' in value:
+        return value['data']
+    else:
+        return fastapi.Response(content=value['body'], status_code=value['status_code'],
+                                media_type=value['media_type'], headers=value['headers'])
+
+
+def cached_route(date_to_param_names=(), max_item_rows=None):
+    # caches the results of an async route function based on its parameters
+    # date_to_param_names are the parameters which limit the upper bound of dates returned by the query,
+    # they are used to decide the cache ttl
+    # max_item_rows overrides CACHE_MAX_ITEM_ROWS for routes which return bounded aggregated results
+    # the http Cache-Control header is also set based on date_to_param_names, regardless of CACHE_ENABLED
+
+    def _decorator(func):
+
+        @functools.wraps(func)
+        async def _wrapper(**kwargs):
+            res = await _get_response(kwargs)
+            http_cache.set_cache_control(http_cache.is_historical_query(kwargs, date_to_param_names))
+            return res
+
+        async def _get_response(kwargs):
+            # formats other than json are streamed, so they are not cached
+            if not CACHE_ENABLED or response_formats.get_response_format(kwargs.get('format')) != 'json':
+                return await func(**kwargs)
+            key = get_cache_key(func, kwargs)
+            found, value = _cache.get(key)
+            if found:
+                request_context.set_response_header(CACHE_STATUS_HEADER, 'HIT')
+                return _get_cached_response(value)
+            res = await func(**kwargs)
+            value = _get_cache_value(res, max_item_rows or CACHE_MAX_ITEM_ROWS)
+            if value is not None:
+                _cache.set(key, value, get_ttl_seconds(kwargs, date_to_param_names))
+            request_context.set_response_header(CACHE_STATUS_HEADER, 'MISS')
+            return res
+
+        return _wrapper
+
+    return _decorator
@@ -0,0 +1,162 @@
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', 'yes').lower() in ('1', 'true', 'yes')
+# encodings in order of preference, the first one which is accepted by the client is used
+COMPRESSION_ENCODINGS = [
+    encoding.strip() for encoding in os.environ.get('COMPRESSION_ENCODINGS', 'br,gzip').split(',')
+    if encoding.strip() and (encoding.strip() != 'br' or brotli is not None)
+]
+# non-streaming responses smaller than this are not compressed, streaming responses are always compressed
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+# lower levels use less cpu, the default levels compress the repetitive json responses well enough
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '5'))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '4'))
+# parquet data is already compressed
+COMPRESSION_EXCLUDE_MEDIA_TYPES = ['application/vnd.apache.parquet']
+
+
+class GzipCompressor:
+
+    def __init__(self):
+        # wbits=31 adds the gzip header and trailer
+        self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        # sync flush makes sure all the data compressed so far is sent to the client
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data=b''):
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data=b''):
+        return self._compressor.process(data) + self._compressor.finish()
+
+
+COMPRESSORS = {
+    'gzip': GzipCompressor,
+    'br': BrotliCompressor,
+}
+
+
+def get_accepted_encoding(accept_encoding):
+    accepted_encodings = set()
+    for value in accept_encoding.split(','):
+        encoding, *params = [part.strip() for part in value.split(';')]
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    pass
+        if quality > 0:
+            accepted_encodings.add(encoding.lower())
+    for encoding in COMPRESSION_ENCODINGS:
+        if encoding in accepted_encodings or '*' in accepted_encodings:
+            return encoding
+    return None
+
+
+def _get_header(headers, name):
+    for key, value in headers:
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _update_headers(headers, content_encoding, body_length=None, is_not_modified=False):
+    # returns the headers for a response which may be compressed depending on the request accept-encoding
+    # for not modified responses, only the etag and vary headers are updated to match the compressed response
+    updated_headers, vary = [], []
+    for key, value in headers:
+        key = key.lower()
+        if key == b'vary':
+            vary.append(value.decode('latin-1'))
+        elif key == b'etag' and content_encoding and not value.startswith(b'W/'):
+            # the compressed response is not byte-identical to the uncompressed one
+            updated_headers.append((key, b'W/' + value))
+        elif key == b'content-length' and content_encoding:
+            if body_length is not None:
+                updated_headers.append((key, str(body_length).encode('latin-1')))
+        else:
+            updated_headers.append((key, value))
+    updated_headers.append((b'vary', ', '.join([*vary, 'Accept-Encoding']).encode('latin-1')))
+    if content_encoding and not is_not_modified:
+        updated_headers.append((b'content-encoding', content_encoding.encode('latin-1')))
+    return updated_headers
+
+
+class CompressionMiddleware:
+    # compresses responses using brotli or gzip, based on the request Accept-Encoding header
+    # streaming responses are compressed incrementally, each chunk is flushed so that clients can decode it immediately
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not COMPRESSION_ENABLED or scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = _get_header(scope.get('headers', []), b'accept-encoding')
+        encoding = get_accepted_encoding(accept_encoding) if accept_encoding else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        start_message = None
+        compressor = None
+
+        async def _send(message):
+            nonlocal start_message, compressor
+            if message['type'] == 'http.response.start':
+                headers = message.get('headers', [])
+                media_type = (_get_header(headers, b'content-type') or '').split(';')[0].strip()
+                if message['status'] == 304:
+                    await send({**message, 'headers': _update_headers(headers, encoding, is_not_modified=True)})
+                elif (
+                    message['status'] == 200 and _get_header(headers, b'content-encoding') is None
+                    and media_type not in COMPRESSION_EXCLUDE_MEDIA_TYPES
+                ):
+                    start_message = message
+                else:
+                    await send(message)
+            elif message['type'] == 'http.response.body' and start_message is not None:
+                headers = start_message.get('headers', [])
+                body = message.get('body', b'')
+                more_body = message.get('more_body', False)
+                if compressor is None:
+                    if not more_body and len(body) < COMPRESSION_MIN_SIZE:
+                        await send({**start_message, 'headers': _update_headers(headers, None)})
+                        start_message = None
+                        await send(message)
+                        return
+                    compressor = COMPRESSORS[encoding]()
+                    if not more_body:
+                        body = compressor.finish(body)
+                        await send({**start_message, 'headers': _update_headers(headers, encoding, len(body))})
+                        start_message = None
+                        await send({**message, 'body': body})
+                        return
+                    await send({**start_message, 'headers': _update_headers(headers, encoding)})
+                body = compressor.compress(body) if more_body else compressor.finish(body)
+                if body or not more_body:
+                    await send({**message, 'body': body})
+            else:
+                await send(message)
+
+        await self.app(scope, receive, _send)
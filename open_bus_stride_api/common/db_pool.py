@@ -0,0 +1,246 @@
+import os
+import time
+import logging
+import itertools
+import threading
+import contextlib
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
+import sqlalchemy.pool
+import sqlalchemy.event
+import sqlalchemy.engine
+import open_bus_stride_db.db
+
+from . import metrics, request_context
+
+
+# connection pool of the sync db sessions of each worker process
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '10'))
+# seconds to wait for a connection when all the pool connections are in use, requests which time out return status 503
+DB_POOL_TIMEOUT_SECONDS = float(os.environ.get('DB_POOL_TIMEOUT_SECONDS', '30'))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'yes').lower() in ('1', 'true', 'yes')
+DB_POOL_RECYCLE_SECONDS = int(os.environ.get('DB_POOL_RECYCLE_SECONDS', '1800'))
+# total number of db connections of all the worker processes, the pools of each worker are limited to its share
+# should be lower than the postgresql max_connections, minus the connections of other clients
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', '0'))
+# number of worker processes which share DB_MAX_CONNECTIONS, it's set by gunicorn_conf.py
+DB_POOL_WORKERS = int(os.environ.get('DB_POOL_WORKERS', '1'))
+# when connecting through pgbouncer in transaction pooling mode, connections are pooled by pgbouncer instead of the workers
+# and prepared statements are disabled, because consecutive transactions may run on different server connections
+DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', '').lower() in ('1', 'true', 'yes')
+# comma-separated list of read replica sqlalchemy urls, the queries of analytical routes (see analytical_route) are sent to
+# the replicas in round robin order, if no replica is healthy they are sent to the primary
+DB_REPLICA_URLS = [url.strip() for url in os.environ.get('DB_REPLICA_URLS', '').split(',') if url.strip()]
+# replicas are checked at this interval, a replica is unhealthy if it can't be connected to or its replication lag is too high
+DB_REPLICA_HEALTH_CHECK_SECONDS = float(os.environ.get('DB_REPLICA_HEALTH_CHECK_SECONDS', '30'))
+DB_REPLICA_MAX_LAG_SECONDS = float(os.environ.get('DB_REPLICA_MAX_LAG_SECONDS', '300'))
+DB_REPLICA_CONNECT_TIMEOUT_SECONDS = int(os.environ.get('DB_REPLICA_CONNECT_TIMEOUT_SECONDS', '5'))
+# the lag is null for servers which are not in recovery, e.g. a second local postgresql instance which is used for testing
+REPLICA_LAG_SQL = 'select case when pg_is_in_recovery() then extract(epoch from now() - pg_last_xact_replay_timestamp()) end'
+
+
+logger = logging.getLogger(__name__)
+
+_sessionmaker = None
+_sessionmaker_lock = threading.Lock()
+_replicas = None
+_replicas_counter = itertools.count()
+# name and settings of the pools which were created by the worker process
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_sqlalchemy_url():
+    url = os.environ.get('SQLALCHEMY_URL')
+    if url:
+        return sqlalchemy.engine.make_url(url)
+    return open_bus_stride_db.db._sessionmaker.kw['bind'].url
+
+
+def get_num_pools():
+    from . import async_db
+    return 2 if async_db.ASYNC_DB else 1
+
+
+def get_pool_limits(pool_size, max_overflow):
+    # returns tuple of (pool_size, max_overflow) limited to the share of the worker process in DB_MAX_CONNECTIONS
+    # when async db is enabled the share is split between the sync and async pools
+    if not DB_MAX_CONNECTIONS:
+        return pool_size, max_overflow
+    max_connections = max(1, DB_MAX_CONNECTIONS // (DB_POOL_WORKERS * get_num_pools()))
+    pool_size = min(pool_size, max_connections)
+    return pool_size, min(max_overflow, max_connections - pool_size)
+
+
+def get_engine_pool_kwargs(pool_size, max_overflow, pool_timeout):
+    if DB_PGBOUNCER:
+        return {'poolclass': sqlalchemy.pool.NullPool}
+    pool_size, max_overflow = get_pool_limits(pool_size, max_overflow)
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'pool_recycle': DB_POOL_RECYCLE_SECONDS,
+    }
+
+
+def register_pool(name, engine, pool_kwargs):
+    # updates the pool metrics on checkout / checkin, engine is a sync engine (for async engines use engine.sync_engine)
+    capacity = pool_kwargs.get('pool_size', 0) + pool_kwargs.get('max_overflow', 0)
+    _pools[name] = {'engine': engine, 'capacity': capacity, 'checked_out': 0, **pool_kwargs}
+    metrics.set_pool_capacity(name, capacity)
+
+    def _add_checked_out(value):
+        with _pools_lock:
+            _pools[name]['checked_out'] += value
+            metrics.set_pool_checked_out(name, _pools[name]['checked_out'])
+
+    @sqlalchemy.event.listens_for(engine, 'checkout')
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        _add_checked_out(1)
+
+    @sqlalchemy.event.listens_for(engine, 'checkin')
+    def _checkin(dbapi_connection, connection_record):
+        _add_checked_out(-1)
+
+
+def create_engine(url, pool_name, connect_args=None):
+    url = sqlalchemy.engine.make_url(url)
+    if url.get_backend_name() != 'postgresql':
+        return sqlalchemy.create_engine(url)
+    pool_kwargs = get_engine_pool_kwargs(DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT_SECONDS)
+    engine = sqlalchemy.create_engine(url, connect_args={
+        'application_name': os.environ.get('SQLALCHEMY_APPLICATION_NAME', 'api'),
+        **(connect_args or {}),
+    }, **pool_kwargs)
+    register_pool(pool_name, engine, pool_kwargs)
+    return engine
+
+
+def get_sessionmaker():
+    # engines are created on first use, so that each gunicorn worker process creates its own pools
+    global _sessionmaker, _replicas
+    if _sessionmaker is None:
+        with _sessionmaker_lock:
+            if _sessionmaker is None:
+                _replicas = [
+                    {
+                        'name': f'replica{i}',
+                        'engine': create_engine(url, f'replica{i}', {'connect_timeout': DB_REPLICA_CONNECT_TIMEOUT_SECONDS}),
+                        'healthy': True,
+                        'checked_at': None,
+                        'lock': threading.Lock(),
+                    } for i, url in enumerate(DB_REPLICA_URLS)
+                ]
+                _sessionmaker = sqlalchemy.orm.sessionmaker(bind=create_engine(get_sqlalchemy_url(), 'sync'))
+    return _sessionmaker
+
+
+def set_analytical_request():
+    context = request_context.get_request_context()
+    if context is not None:
+        context['db_analytical'] = True
+
+
+def analytical_route(func):
+    # decorator for routes which run heavy queries, their queries are sent to the read replicas
+    # should be placed below the router decorator
+    return request_context.route_context_decorator(db_analytical=True)(func)
+
+
+def is_replica_request():
+    # replica sessions are sync, so the async db routes should run the sync db code in the threadpool for these requests
+    context = request_context.get_request_context()
+    return bool(DB_REPLICA_URLS) and context is not None and context.get('db_analytical', False)
+
+
+def set_replica_healthy(replica, healthy, error=None):
+    if replica['healthy'] != healthy:
+        logger.warning(f'db replica {replica["name"]} is {"healthy" if healthy else "unhealthy"}{f": {error}" if error else ""}')
+    replica['healthy'] = healthy
+    replica['checked_at'] = time.monotonic()
+
+
+def check_replica(replica):
+    try:
+        with replica['engine'].connect() as connection:
+            lag_seconds = connection.exec_driver_sql(REPLICA_LAG_SQL).scalar()
+    except sqlalchemy.exc.DBAPIError as e:
+        set_replica_healthy(replica, False, e.orig)
+    else:
+        if lag_seconds is not None and DB_REPLICA_MAX_LAG_SECONDS and lag_seconds > DB_REPLICA_MAX_LAG_SECONDS:
+            set_replica_healthy(replica, False, f'replication lag of {lag_seconds:.0f} seconds')
+        else:
+            set_replica_healthy(replica, True)
+
+
+def get_healthy_replicas():
+    # each replica is checked by a single request thread, other requests use the result of the previous check
+    for replica in _replicas:
+        if replica['checked_at'] is None or time.monotonic() - replica['checked_at'] >= DB_REPLICA_HEALTH_CHECK_SECONDS:
+            if replica['lock'].acquire(blocking=False):
+                try:
+                    check_replica(replica)
+                finally:
+                    replica['lock'].release()
+    return [replica for replica in _replicas if replica['healthy']]
+
+
+def create_replica_session(sessionmaker):
+    # returns a session of the next healthy replica in round robin order, or None if no replica is available
+    replicas = get_healthy_replicas()
+    if not replicas:
+        return None
+    start = next(_replicas_counter)
+    for i in range(len(replicas)):
+        replica = replicas[(start + i) % len(replicas)]
+        session = sessionmaker(bind=replica['engine'])
+        try:
+            # the connection is checked out in advance, so that connection errors fall back to the next replica or the primary
+            metrics.checkout_connection(session)
+        except sqlalchemy.exc.OperationalError as e:
+            session.close()
+            set_replica_healthy(replica, False, e.orig)
+        else:
+            return session
+    return None
+
+
+def create_session():
+    sessionmaker = get_sessionmaker()
+    if is_replica_request():
+        session = create_replica_session(sessionmaker)
+        if session is not None:
+            return session
+    return sessionmaker()
+
+
+@contextlib.contextmanager
+def get_session():
+    session = create_session()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def get_status():
+    # pool health data of the worker process which handles the request
+    return {
+        'pid': os.getpid(),
+        'workers': DB_POOL_WORKERS,
+        'max_connections': DB_MAX_CONNECTIONS or None,
+        'pgbouncer': DB_PGBOUNCER,
+        'replicas': {replica['name']: replica['healthy'] for replica in _replicas or []},
+        'pools': {
+            name: {
+                **{key: value for key, value in pool.items() if key not in ('engine', 'poolclass')},
+                'saturation': round(pool['checked_out'] / pool['capacity'], 3) if pool['capacity'] else None,
+                'status': pool['engine'].pool.status(),
+            } for name, pool in _pools.items()
+        },
+    }
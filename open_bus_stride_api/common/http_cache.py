@@ -0,0 +1,134 @@
+import os
+import hashlib
+import datetime
+import functools
+
+from . import request_context
+from ..materialized import store
+
+
+# max-age for responses of queries which are limited to closed dates, this data is not modified after it was loaded by the ETL
+HTTP_CACHE_HISTORICAL_MAX_AGE_SECONDS = int(os.environ.get('HTTP_CACHE_HISTORICAL_MAX_AGE_SECONDS', str(60 * 60 * 24)))
+# headers which are not sent with a 304 Not Modified response
+NOT_MODIFIED_EXCLUDE_HEADERS = [b'content-length', b'content-type', b'content-encoding']
+
+
+def get_cache_control(is_historical):
+    if is_historical:
+        return f'public, max-age={HTTP_CACHE_HISTORICAL_MAX_AGE_SECONDS}'
+    else:
+        # allows proxies to store the response, but they must revalidate it using the etag
+        return 'no-cache'
+
+
+def is_closed_date(value):
+    # uses the materialized stores definition of closed periods, which allows the ETL to finish loading the data
+    # dates are closed after the end of the UTC day, naive datetimes are considered as UTC
+    if isinstance(value, datetime.datetime):
+        return store.is_closed(value)
+    elif isinstance(value, datetime.date):
+        return store.is_closed_day(value)
+    else:
+        return False
+
+
+def is_historical_query(kwargs, date_to_param_names):
+    # returns True only if the query is limited to closed dates
+    date_to_values = [kwargs.get(name) for name in date_to_param_names if kwargs.get(name) is not None]
+    return bool(date_to_values) and all(is_closed_date(value) for value in date_to_values)
+
+
+def set_cache_control(is_historical):
+    request_context.set_response_header('Cache-Control', get_cache_control(is_historical))
+
+
+def date_cache_control(date_to_param_names=(), item_date_field_names=()):
+    # sets the Cache-Control header of routes which don't use cache.cached_route, using the same closed dates check
+    # date_to_param_names are the parameters which limit the upper bound of dates returned by list routes
+    # item_date_field_names are the date fields of the item returned by get routes
+    # should be placed below the router decorator
+
+    def _decorator(func):
+
+        @functools.wraps(func)
+        async def _wrapper(**kwargs):
+            res = await func(**kwargs)
+            if item_date_field_names:
+                set_cache_control(isinstance(res, dict) and is_historical_query(res, item_date_field_names))
+            else:
+                set_cache_control(is_historical_query(kwargs, date_to_param_names))
+            return res
+
+        return _wrapper
+
+    return _decorator
+
+
+def get_etag(body):
+    return '"{}"'.format(hashlib.blake2b(body, digest_size=16).hexdigest())
+
+
+def is_etag_match(if_none_match, etag):
+    # weak comparison, as required for If-None-Match
+    if if_none_match.strip() == '*':
+        return True
+    etag = etag[2:] if etag.startswith('W/') else etag
+    for value in if_none_match.split(','):
+        value = value.strip()
+        if value.startswith('W/'):
+            value = value[2:]
+        if value == etag:
+            return True
+    return False
+
+
+def _get_header(headers, name):
+    for key, value in headers:
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+class ETagMiddleware:
+    # adds an etag to successful GET responses, based on a hash of the response body
+    # if the request If-None-Match header matches, an empty 304 Not Modified response is sent instead
+    # streaming responses (e.g. limit=-1) are passed through without an etag, to avoid buffering them
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET':
+            await self.app(scope, receive, send)
+            return
+        if_none_match = _get_header(scope.get('headers', []), b'if-none-match')
+        start_message = None
+
+        async def _send(message):
+            nonlocal start_message
+            if message['type'] == 'http.response.start':
+                if message['status'] == 200:
+                    start_message = message
+                else:
+                    await send(message)
+            elif message['type'] == 'http.response.body' and start_message is not None:
+                headers = list(start_message.get('headers', []))
+                if message.get('more_body', False) or _get_header(headers, b'etag') is not None:
+                    await send(start_message)
+                else:
+                    etag = get_etag(message.get('body', b''))
+                    headers.append((b'etag', etag.encode('latin-1')))
+                    if if_none_match and is_etag_match(if_none_match, etag):
+                        await send({
+                            'type': 'http.response.start', 'status': 304,
+                            'headers': [(key, value) for key, value in headers if key.lower() not in NOT_MODIFIED_EXCLUDE_HEADERS],
+                        })
+                        message = {'type': 'http.response.body', 'body': b''}
+                    else:
+                        await send({**start_message, 'headers': headers})
+                start_message = None
+                await send(message)
+            else:
+                await send(message)
+
+        await self.app(scope, receive, _send)
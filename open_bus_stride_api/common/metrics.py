@@ -0,0 +1,214 @@
+import os
+import time
+import contextlib
+import contextvars
+
+import sqlalchemy.event
+import sqlalchemy.engine
+import prometheus_client
+from prometheus_client import multiprocess
+
+
+# when running with multiple gunicorn workers, PROMETHEUS_MULTIPROC_DIR must be set so that metrics are aggregated from all the workers
+# it's set in the Dockerfile and cleaned by gunicorn_conf.py when the server starts
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+if PROMETHEUS_MULTIPROC_DIR:
+    # the directory is created also here, for entrypoints which don't use gunicorn (e.g. the materialized cli, uvicorn or pytest)
+    # /dev/shm is mounted when the container starts, so it can't be created in the Dockerfile
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'yes').lower() in ('1', 'true', 'yes')
+# add a Server-Timing response header with the db, fetch, encode and total durations of the request
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'yes').lower() in ('1', 'true', 'yes')
+SECONDS_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+REQUEST_SECONDS = prometheus_client.Histogram('stride_api_request_seconds', 'Total request duration', ['route', 'method', 'status'], buckets=SECONDS_BUCKETS)
+DB_EXECUTE_SECONDS = prometheus_client.Histogram('stride_api_db_execute_seconds', 'Time spent executing db queries per request', ['route'], buckets=SECONDS_BUCKETS)
+DB_FETCH_SECONDS = prometheus_client.Histogram('stride_api_db_fetch_seconds', 'Time spent fetching and building result rows per request', ['route'], buckets=SECONDS_BUCKETS)
+SERIALIZATION_SECONDS = prometheus_client.Histogram('stride_api_serialization_seconds', 'Time spent serializing the response per request', ['route'], buckets=SECONDS_BUCKETS)
+POOL_CHECKOUT_SECONDS = prometheus_client.Histogram('stride_api_pool_checkout_seconds', 'Time spent waiting for a db connection from the pool', ['route'], buckets=SECONDS_BUCKETS)
+ROWS_RETURNED = prometheus_client.Counter('stride_api_rows_returned', 'Number of rows returned', ['route'])
+BYTES_WRITTEN = prometheus_client.Counter('stride_api_bytes_written', 'Number of response body bytes written', ['route'])
+ERRORS = prometheus_client.Counter('stride_api_errors', 'Number of requests which failed with a server error', ['route', 'status'])
+# pool gauges are summed over the live worker processes
+POOL_CAPACITY = prometheus_client.Gauge('stride_api_db_pool_capacity', 'Maximum number of db connections of the pool (pool size + max overflow)', ['pool'], multiprocess_mode='livesum')
+POOL_CHECKED_OUT = prometheus_client.Gauge('stride_api_db_pool_checked_out', 'Number of db connections which are currently in use', ['pool'], multiprocess_mode='livesum')
+POOL_CHECKOUT_TIMEOUTS = prometheus_client.Counter('stride_api_db_pool_checkout_timeouts', 'Number of requests which failed waiting for a db connection from the pool')
+
+_request_metrics = contextvars.ContextVar('request_metrics', default=None)
+# path template of each endpoint, used as the route label
+_endpoint_routes = {}
+
+
+def add(name, value):
+    # adds to the value of a metric of the current request
+    request_metrics = _request_metrics.get()
+    if request_metrics is not None:
+        request_metrics[name] = request_metrics.get(name, 0) + value
+
+
+@contextlib.contextmanager
+def timer(name):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - start_time)
+
+
+def timed_iterator(iterator, name):
+    # yields the items of the iterator, the time spent waiting for each item is added to the given metric
+    iterator = iter(iterator)
+    while True:
+        with timer(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+async def async_timed_iterator(aiterator, name):
+    aiterator = aiterator.__aiter__()
+    while True:
+        with timer(name):
+            try:
+                item = await aiterator.__anext__()
+            except StopAsyncIteration:
+                return
+        yield item
+
+
+def mark_data_returned():
+    # called when a route returns data which is serialized by fastapi (response model validation and encoding)
+    # the time until the response starts is counted as serialization time
+    request_metrics = _request_metrics.get()
+    if request_metrics is not None:
+        request_metrics['data_returned_at'] = time.perf_counter()
+
+
+def set_pool_capacity(pool, capacity):
+    POOL_CAPACITY.labels(pool).set(capacity)
+
+
+def set_pool_checked_out(pool, checked_out):
+    POOL_CHECKED_OUT.labels(pool).set(checked_out)
+
+
+def checkout_connection(session):
+    # gets the session connection from the pool in advance, to measure the time spent waiting for it
+    with timer('pool_checkout'):
+        session.connection()
+
+
+async def async_checkout_connection(session):
+    with timer('pool_checkout'):
+        await session.connection()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_execute_start_time'] = time.perf_counter()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_time = conn.info.pop('metrics_execute_start_time', None)
+    if start_time is not None:
+        add('db_execute', time.perf_counter() - start_time)
+
+
+def _get_route(scope):
+    endpoint = scope.get('endpoint')
+    if endpoint is None:
+        return 'unmatched'
+    route = _endpoint_routes.get(endpoint)
+    if route is None:
+        route = next((route.path for route in scope['app'].routes if getattr(route, 'endpoint', None) is endpoint), 'unmatched')
+        _endpoint_routes[endpoint] = route
+    return route
+
+
+def _get_timings(request_metrics):
+    # returns tuple of (db_execute_seconds, db_fetch_seconds, serialization_seconds)
+    db_execute = request_metrics.get('db_execute', 0)
+    # db time of the common db helpers includes both execution and fetching
+    db_fetch = max(0, request_metrics.get('db', 0) - db_execute)
+    serialization_seconds = request_metrics.get('serialization', 0)
+    if 'data_returned_at' in request_metrics and 'response_started_at' in request_metrics:
+        serialization_seconds += max(0, request_metrics['response_started_at'] - request_metrics['data_returned_at'])
+    return db_execute, db_fetch, serialization_seconds
+
+
+def get_server_timing(request_metrics, total_seconds):
+    # for streaming responses the timings include only the work done before the response started
+    db_execute, db_fetch, serialization_seconds = _get_timings(request_metrics)
+    return ', '.join(
+        f'{name};dur={seconds * 1000:.1f}'
+        for name, seconds in [('db', db_execute), ('fetch', db_fetch), ('encode', serialization_seconds), ('total', total_seconds)]
+    )
+
+
+def _observe(scope, request_metrics, status, duration):
+    route = _get_route(scope)
+    REQUEST_SECONDS.labels(route, scope['method'], str(status)).observe(duration)
+    db_execute, db_fetch, serialization_seconds = _get_timings(request_metrics)
+    DB_EXECUTE_SECONDS.labels(route).observe(db_execute)
+    DB_FETCH_SECONDS.labels(route).observe(db_fetch)
+    SERIALIZATION_SECONDS.labels(route).observe(serialization_seconds)
+    if 'pool_checkout' in request_metrics:
+        POOL_CHECKOUT_SECONDS.labels(route).observe(request_metrics['pool_checkout'])
+    ROWS_RETURNED.labels(route).inc(request_metrics.get('rows', 0))
+    BYTES_WRITTEN.labels(route).inc(request_metrics.get('bytes', 0))
+    if status >= 500:
+        ERRORS.labels(route, str(status)).inc()
+
+
+class MetricsMiddleware:
+    # collects the request metrics and adds the Server-Timing header
+    # should be the outermost middleware, so that the bytes written are the final response bytes
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not (METRICS_ENABLED or SERVER_TIMING) or scope['type'] != 'http' or scope['path'] == '/metrics':
+            await self.app(scope, receive, send)
+            return
+        request_metrics = {}
+        token = _request_metrics.set(request_metrics)
+        start_time = time.perf_counter()
+        status = 500
+
+        async def _send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                request_metrics['response_started_at'] = time.perf_counter()
+                if SERVER_TIMING:
+                    message['headers'] = [
+                        *message.get('headers', []),
+                        (b'server-timing', get_server_timing(request_metrics, request_metrics['response_started_at'] - start_time).encode()),
+                        # allows browser clients of other origins to read the timings using the resource timing api
+                        (b'timing-allow-origin', b'*'),
+                    ]
+            elif message['type'] == 'http.response.body':
+                request_metrics['bytes'] = request_metrics.get('bytes', 0) + len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _request_metrics.reset(token)
+            if METRICS_ENABLED:
+                _observe(scope, request_metrics, status, time.perf_counter() - start_time)
+
+
+def get_metrics():
+    # returns tuple of (content, content_type)
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
@@ -0,0 +1,118 @@
+import math
+import struct
+
+import fastapi
+
+
+# mapbox vector tiles encoding, see https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+# only point features are supported, which is all we need for vehicle locations and velocity cells
+EXTENT = 4096
+MEDIA_TYPE = 'application/vnd.mapbox-vector-tile'
+MAX_ZOOM = 22
+GEOM_TYPE_POINT = 1
+COMMAND_MOVE_TO = 1
+
+
+def _varint(value):
+    res = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            res.append(byte | 0x80)
+        else:
+            res.append(byte)
+            return bytes(res)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(field_number, wire_type):
+    return _varint((field_number << 3) | wire_type)
+
+
+def _length_delimited(field_number, data):
+    return _key(field_number, 2) + _varint(len(data)) + data
+
+
+def _packed_varints(field_number, values):
+    return _length_delimited(field_number, b''.join(_varint(value) for value in values))
+
+
+def _value(value):
+    if isinstance(value, bool):
+        return _key(7, 0) + _varint(int(value))
+    elif isinstance(value, int):
+        return _key(6, 0) + _varint(_zigzag(value))
+    elif isinstance(value, float):
+        return _key(3, 1) + struct.pack('<d', value)
+    else:
+        return _length_delimited(1, str(value).encode())
+
+
+def encode_layer(name, features, extent=EXTENT):
+    # features is a list of tuples: (x, y, properties) where x, y are integer tile coordinates in range [0, extent)
+    keys, values = {}, {}
+    encoded_features = []
+    for x, y, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+        encoded_features.append(_length_delimited(2, b''.join([
+            _packed_varints(2, tags),
+            _key(3, 0) + _varint(GEOM_TYPE_POINT),
+            _packed_varints(4, [(COMMAND_MOVE_TO & 0x7) | (1 << 3), _zigzag(x), _zigzag(y)]),
+        ])))
+    return b''.join([
+        _key(15, 0) + _varint(2),
+        _length_delimited(1, name.encode()),
+        *encoded_features,
+        *[_length_delimited(3, key.encode()) for key in keys],
+        *[_length_delimited(4, _value(value)) for _, value in values],
+        _key(5, 0) + _varint(extent),
+    ])
+
+
+def encode_tile(layers):
+    # layers is a dict of layer name to list of features, see encode_layer
+    return b''.join(_length_delimited(3, encode_layer(name, features)) for name, features in layers.items())
+
+
+def validate_tile(z, x, y):
+    if not (0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise fastapi.HTTPException(status_code=400, detail='Invalid tile coordinates')
+
+
+def get_tile_bounds(z, x, y):
+    # returns the web mercator tile bounds as dict of lon_min, lon_max, lat_min, lat_max
+    n = 2 ** z
+
+    def _lat(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return {
+        'lon_min': x / n * 360 - 180,
+        'lon_max': (x + 1) / n * 360 - 180,
+        'lat_min': _lat(y + 1),
+        'lat_max': _lat(y),
+    }
+
+
+def get_tile_pixel(z, x, y, lon, lat, extent=EXTENT):
+    # returns the integer coordinates of the given point in the tile, or None if it's outside of the tile
+    n = 2 ** z
+    lat_rad = math.radians(lat)
+    px = int(((lon + 180) / 360 * n - x) * extent)
+    py = int(((1 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad)) / math.pi) / 2 * n - y) * extent)
+    if 0 <= px < extent and 0 <= py < extent:
+        return px, py
+    return None
+
+
+def get_tile_response(layers):
+    return fastapi.Response(content=encode_tile(layers), media_type=MEDIA_TYPE)
@@ -0,0 +1,112 @@
+import inspect
+import functools
+import contextvars
+import urllib.parse
+
+
+_request_context = contextvars.ContextVar('request_context', default=None)
+
+
+def get_request_context():
+    return _request_context.get()
+
+
+def set_response_header(name, value):
+    # headers set during request handling are added to the response by RequestContextMiddleware
+    # this allows common code (e.g. common.get_list) to add headers without access to the response object
+    context = get_request_context()
+    if context is not None:
+        context['response_headers'][name.lower()] = str(value)
+
+
+def get_request_header(name, default=None):
+    context = get_request_context()
+    if context is None:
+        return default
+    name = name.lower().encode()
+    for key, value in context['scope'].get('headers', []):
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return default
+
+
+def route_context_decorator(**values):
+    # decorator for routes which set values of the request context, should be placed below the router decorator
+    def _set_values():
+        context = get_request_context()
+        if context is not None:
+            context.update(values)
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                _set_values()
+                return await func(*args, **kwargs)
+
+        else:
+
+            # sync routes run in the threadpool, with a copy of the request context
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                _set_values()
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_query_param(name, default=None):
+    context = get_request_context()
+    if context is None:
+        return default
+    values = urllib.parse.parse_qs(context['scope'].get('query_string', b'').decode('latin-1')).get(name)
+    return values[-1] if values else default
+
+
+async def wait_for_disconnect():
+    # waits until the http client disconnects, messages which are received while waiting are passed on to the app
+    context = get_request_context()
+    while True:
+        message = await context['receive']()
+        context['received_messages'].append(message)
+        if message['type'] == 'http.disconnect':
+            return
+
+
+class RequestContextMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        context = {
+            'scope': scope,
+            'response_headers': {},
+            'receive': receive,
+            'received_messages': [],
+        }
+        token = _request_context.set(context)
+
+        async def _receive():
+            if context['received_messages']:
+                return context['received_messages'].pop(0)
+            return await receive()
+
+        async def _send(message):
+            if message['type'] == 'http.response.start' and context['response_headers']:
+                message['headers'] = [
+                    *message.get('headers', []),
+                    *[(name.encode('latin-1'), value.encode('latin-1')) for name, value in context['response_headers'].items()]
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, _receive, _send)
+        finally:
+            _request_context.reset(token)
@@ -0,0 +1,231 @@
+import io
+import csv
+import enum
+import decimal
+import datetime
+
+import orjson
+import fastapi
+
+from . import request_context, serialization
+
+
+MEDIA_TYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+# number of rows in each arrow record batch / parquet row group, larger batches compress better
+COLUMNAR_BATCH_SIZE = 10000
+
+
+def get_response_format(format_):
+    # format_ is the value of the format query parameter, if it's not set the Accept header is used
+    if format_:
+        if format_ not in MEDIA_TYPES:
+            raise fastapi.HTTPException(status_code=400, detail=f'Invalid format, valid values: {", ".join(MEDIA_TYPES)}')
+        return format_
+    # the response depends on the Accept header, so http caches must take it into account
+    request_context.set_response_header('Vary', 'Accept')
+    accept = request_context.get_request_header('accept')
+    if accept:
+        media_ranges = []
+        for i, media_range in enumerate(accept.split(',')):
+            media_type, *params = [part.strip() for part in media_range.split(';')]
+            quality = 1.0
+            for param in params:
+                if param.startswith('q='):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        pass
+            media_ranges.append((-quality, i, media_type.lower()))
+        for _, _, media_type in sorted(media_ranges):
+            for response_format, format_media_type in MEDIA_TYPES.items():
+                if media_type == format_media_type:
+                    return response_format
+            if media_type in ('*/*', 'application/*'):
+                break
+    return 'json'
+
+
+def get_chunk_size(response_format, default_chunk_size):
+    return COLUMNAR_BATCH_SIZE if response_format in ('arrow', 'parquet') else default_chunk_size
+
+
+class _BytesSink:
+    # file-like object which collects the bytes written by the csv / arrow / parquet writers
+
+    def __init__(self):
+        self.closed = False
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class NdjsonEncoder:
+
+    def encode(self, items):
+        return b''.join(orjson.dumps(item, default=serialization._default, option=orjson.OPT_APPEND_NEWLINE) for item in items)
+
+    def finish(self):
+        return b''
+
+
+def _get_csv_value(value):
+    if value is None:
+        return ''
+    elif isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    elif isinstance(value, enum.Enum):
+        return value.value
+    elif isinstance(value, (dict, list)):
+        return serialization.dumps(value).decode()
+    else:
+        return value
+
+
+class CsvEncoder:
+
+    def __init__(self):
+        self._fieldnames = None
+
+    def encode(self, items):
+        if not items:
+            return b''
+        output = io.StringIO()
+        writer = csv.writer(output)
+        if self._fieldnames is None:
+            self._fieldnames = list(items[0].keys())
+            writer.writerow(self._fieldnames)
+        for item in items:
+            writer.writerow([_get_csv_value(item.get(fieldname)) for fieldname in self._fieldnames])
+        return output.getvalue().encode()
+
+    def finish(self):
+        return b''
+
+
+def _get_arrow_type(pa, values):
+    # the column type is decided based on the first non-null value in the first batch
+    # columns which have only null values in the first batch are encoded as strings
+    value = next((value for value in values if value is not None), None)
+    if isinstance(value, bool):
+        return pa.bool_()
+    elif isinstance(value, int):
+        return pa.int64()
+    elif isinstance(value, (float, decimal.Decimal)):
+        return pa.float64()
+    elif isinstance(value, datetime.datetime):
+        return pa.timestamp('us', tz='UTC' if value.tzinfo else None)
+    elif isinstance(value, datetime.date):
+        return pa.date32()
+    elif isinstance(value, datetime.time):
+        return pa.time64('us')
+    else:
+        return pa.string()
+
+
+def _get_arrow_value(pa, arrow_type, value):
+    if value is None:
+        return None
+    elif isinstance(value, enum.Enum):
+        value = value.value
+    if arrow_type == pa.string() and not isinstance(value, str):
+        return serialization.dumps(value).decode() if isinstance(value, (dict, list)) else str(value)
+    elif arrow_type == pa.float64() and isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+class _ArrowEncoderBase:
+
+    def __init__(self):
+        import pyarrow
+        self._pa = pyarrow
+        self._sink = _BytesSink()
+        self._schema = None
+        self._writer = None
+
+    def _get_record_batch(self, items):
+        pa = self._pa
+        fieldnames = list(items[0].keys())
+        if self._schema is None:
+            self._schema = pa.schema([
+                (fieldname, _get_arrow_type(pa, [item.get(fieldname) for item in items]))
+                for fieldname in fieldnames
+            ])
+        return pa.RecordBatch.from_arrays([
+            pa.array([_get_arrow_value(pa, field.type, item.get(field.name)) for item in items], type=field.type)
+            for field in self._schema
+        ], schema=self._schema)
+
+    def _new_writer(self, sink, schema):
+        raise NotImplementedError()
+
+    def _write_batch(self, record_batch):
+        raise NotImplementedError()
+
+    def encode(self, items):
+        if not items:
+            return b''
+        record_batch = self._get_record_batch(items)
+        if self._writer is None:
+            self._writer = self._new_writer(self._sink, self._schema)
+        self._write_batch(record_batch)
+        return self._sink.pop()
+
+    def finish(self):
+        if self._writer is None:
+            # no results, the output contains only an empty schema
+            self._schema = self._pa.schema([])
+            self._writer = self._new_writer(self._sink, self._schema)
+        self._writer.close()
+        return self._sink.pop()
+
+
+class ArrowEncoder(_ArrowEncoderBase):
+
+    def _new_writer(self, sink, schema):
+        return self._pa.ipc.new_stream(sink, schema)
+
+    def _write_batch(self, record_batch):
+        self._writer.write_batch(record_batch)
+
+
+class ParquetEncoder(_ArrowEncoderBase):
+
+    def _new_writer(self, sink, schema):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(sink, schema, compression='zstd')
+
+    def _write_batch(self, record_batch):
+        # each batch is written as a separate row group, so that it can be sent to the client immediately
+        self._writer.write_batch(record_batch, row_group_size=record_batch.num_rows)
+
+
+ENCODERS = {
+    'ndjson': NdjsonEncoder,
+    'csv': CsvEncoder,
+    'arrow': ArrowEncoder,
+    'parquet': ParquetEncoder,
+}
+
+
+def get_encoder(response_format):
+    return ENCODERS[response_format]()
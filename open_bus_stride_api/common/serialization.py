@@ -0,0 +1,36 @@
+import os
+
+import orjson
+import fastapi
+
+from . import metrics
+
+
+# encode responses using orjson instead of fastapi.encoders.jsonable_encoder and json.dumps
+FAST_SERIALIZATION = os.environ.get('FAST_SERIALIZATION', 'yes').lower() in ('1', 'true', 'yes')
+
+
+def _default(obj):
+    # orjson natively encodes datetimes, dates and enums the same way as jsonable_encoder
+    # other types are encoded using jsonable_encoder, to keep the output compatible
+    return fastapi.encoders.jsonable_encoder(obj)
+
+
+def dumps(obj):
+    return orjson.dumps(obj, default=_default)
+
+
+def rows_to_dicts(rows):
+    # rows are sqlalchemy Row tuples of the same query, so they all have the same fields
+    if not rows:
+        return []
+    fields = rows[0]._fields
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def get_json_response(data):
+    # returning a response object skips the route response_model validation and encoding,
+    # so it should be used only for data which is known to match the response model
+    with metrics.timer('serialization'):
+        content = dumps(data)
+    return fastapi.Response(content=content, media_type='application/json')
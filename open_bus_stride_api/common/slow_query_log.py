@@ -0,0 +1,160 @@
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+import collections
+import concurrent.futures
+
+import sqlalchemy.event
+import sqlalchemy.engine
+
+from . import request_context
+
+
+# queries which take longer than this number of seconds are logged, 0 disables the slow query log
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS', '5'))
+# fraction of slow queries which are re-run in the background using EXPLAIN (ANALYZE, BUFFERS) to capture their plan
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = float(os.environ.get('SLOW_QUERY_EXPLAIN_SAMPLE_RATE', '0.1'))
+SLOW_QUERY_EXPLAIN_TIMEOUT_SECONDS = float(os.environ.get('SLOW_QUERY_EXPLAIN_TIMEOUT_SECONDS', '60'))
+# explains which are waiting to run above this number are skipped, so that slow queries don't pile up
+SLOW_QUERY_EXPLAIN_MAX_PENDING = 5
+# number of query shapes which are kept in memory for the admin endpoint, least recently seen shapes are evicted
+SLOW_QUERY_MAX_FINGERPRINTS = 500
+SLOW_QUERY_MAX_PARAMS_LENGTH = 2000
+
+logger = logging.getLogger(__name__)
+
+_fingerprints = collections.OrderedDict()
+_lock = threading.Lock()
+_explain_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='slow-query-explain')
+_explain_pending = 0
+
+
+def normalize_sql(statement):
+    # replaces literals and bound parameters with placeholders, so that queries which differ only in values have the same shape
+    sql = statement.lower()
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'%\(\w+\)s|%s|\$\d+|(?<!:):\w+', '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def get_fingerprint(normalized_sql):
+    return hashlib.sha1(normalized_sql.encode()).hexdigest()[:16]
+
+
+def _get_params_json(parameters):
+    params_json = json.dumps(parameters, default=str)
+    if len(params_json) > SLOW_QUERY_MAX_PARAMS_LENGTH:
+        params_json = params_json[:SLOW_QUERY_MAX_PARAMS_LENGTH] + '...'
+    return params_json
+
+
+def _update_fingerprint(entry, plan=None):
+    with _lock:
+        stats = _fingerprints.pop(entry['fingerprint'], None)
+        if stats is None:
+            stats = {
+                'fingerprint': entry['fingerprint'],
+                'normalized_sql': entry['normalized_sql'],
+                'count': 0,
+                'total_seconds': 0,
+                'max_seconds': 0,
+                'paths': [],
+            }
+        if plan is None:
+            stats['count'] += 1
+            stats['total_seconds'] += entry['seconds']
+            if entry['seconds'] >= stats['max_seconds']:
+                stats['max_seconds'] = entry['seconds']
+                stats['slowest_sql'] = entry['sql']
+                stats['slowest_params'] = entry['params']
+            if entry['path'] and entry['path'] not in stats['paths']:
+                stats['paths'] = [*stats['paths'], entry['path']][-10:]
+        else:
+            stats['plan'] = plan
+        _fingerprints[entry['fingerprint']] = stats
+        while len(_fingerprints) > SLOW_QUERY_MAX_FINGERPRINTS:
+            _fingerprints.popitem(last=False)
+
+
+def _explain(entry, engine, statement, parameters):
+    # the query is re-run on the engine it was executed on, so that queries of the replicas don't load the primary
+    global _explain_pending
+    try:
+        with engine.connect() as connection, connection.begin():
+            # analyze runs the query, so it must not be able to modify data
+            connection.exec_driver_sql('set transaction read only')
+            connection.exec_driver_sql(f'set local statement_timeout = {int(SLOW_QUERY_EXPLAIN_TIMEOUT_SECONDS * 1000)}')
+            plan = connection.exec_driver_sql(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}', parameters).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+        _update_fingerprint(entry, plan)
+        logger.warning(json.dumps({'slow_query_plan': entry['fingerprint'], 'plan': plan}, default=str))
+    except Exception as e:
+        logger.warning(json.dumps({'slow_query_plan': entry['fingerprint'], 'error': str(e)}))
+    finally:
+        with _lock:
+            _explain_pending -= 1
+
+
+def _submit_explain(entry, engine, statement, parameters):
+    global _explain_pending
+    with _lock:
+        if _explain_pending >= SLOW_QUERY_EXPLAIN_MAX_PENDING:
+            return
+        _explain_pending += 1
+    _explain_executor.submit(_explain, entry, engine, statement, parameters)
+
+
+def is_explainable(engine, statement):
+    # statements of the async engine use the asyncpg $n placeholders, which the sync explain connection can't run
+    return (
+        engine is not None and not engine.dialect.is_async
+        and statement.lstrip().lower().startswith(('select', 'with'))
+    )
+
+
+def log_slow_query(statement, parameters, seconds, engine=None):
+    # engine is the engine which executed the statement, a sample of the slow queries is explained using it
+    normalized_sql = normalize_sql(statement)
+    scope = (request_context.get_request_context() or {}).get('scope', {})
+    entry = {
+        'fingerprint': get_fingerprint(normalized_sql),
+        'normalized_sql': normalized_sql,
+        'sql': statement,
+        'params': _get_params_json(parameters),
+        'seconds': round(seconds, 3),
+        'path': scope.get('path'),
+        'query_string': scope.get('query_string', b'').decode('latin-1') or None,
+    }
+    logger.warning(json.dumps({'slow_query': entry}))
+    _update_fingerprint(entry)
+    if is_explainable(engine, statement) and random.random() < SLOW_QUERY_EXPLAIN_SAMPLE_RATE:
+        _submit_explain(entry, engine, statement, parameters)
+
+
+def get_top(limit=20, order_by='total_seconds'):
+    with _lock:
+        stats = [dict(stats) for stats in _fingerprints.values()]
+    return sorted(stats, key=lambda stats: stats[order_by], reverse=True)[:limit]
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['slow_query_start_time'] = time.perf_counter()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_time = conn.info.pop('slow_query_start_time', None)
+    if not SLOW_QUERY_SECONDS or start_time is None or statement.lstrip().upper().startswith('EXPLAIN'):
+        return
+    seconds = time.perf_counter() - start_time
+    if seconds >= SLOW_QUERY_SECONDS:
+        log_slow_query(statement, parameters, seconds, conn.engine)
@@ -1,57 +1,129 @@
-import itertools
+import sqlalchemy
+from starlette.concurrency import run_in_threadpool
 
-import fastapi
+from ..routers import common
+from . import async_db, response_formats, statement_timeout, metrics, db_pool
 
-from open_bus_stride_db.db import _sessionmaker
 
-from ..routers import common
+def get_keyset_sql_column_after_condition(direction, fieldname, value_param, value):
+    # sql equivalent of common._get_keyset_column_after_condition
+    if direction == 'desc':
+        return f'{fieldname} is not null' if value is None else f'{fieldname} < :{value_param}'
+    elif value is None:
+        return None
+    else:
+        return f'({fieldname} > :{value_param} or {fieldname} is null)'
+
+
+def get_keyset_sql_condition(order_by_args, values, sql_params):
+    # sql equivalent of common.get_keyset_condition, values are added to sql_params as bound parameters
+    # the fields may be nullable, so row value comparison is not used
+    conditions = []
+    for i, (direction, fieldname) in enumerate(order_by_args):
+        assert fieldname.isidentifier(), f'invalid order by field: {fieldname}'
+        sql_params[f'cursor_value_{i}'] = values[i]
+        after_condition = get_keyset_sql_column_after_condition(direction, fieldname, f'cursor_value_{i}', values[i])
+        if after_condition is not None:
+            conditions.append(' and '.join([
+                *[f'{prev_fieldname} is null' if values[j] is None else f'{prev_fieldname} = :cursor_value_{j}'
+                  for j, (_, prev_fieldname) in enumerate(order_by_args[:i])],
+                after_condition
+            ]))
+    return ' or '.join([f'({condition})' for condition in conditions]) or 'false'
 
 
-QUERY_PAGE_SIZE = 1000
+def get_list_sql(sql, sql_params, default_limit, limit, offset, order_by, skip_order_by, cursor=None):
+    # returns the final sql and params for a non-count list query
+    if not limit and default_limit:
+        limit = default_limit
+    if limit:
+        limit = int(limit)
+    stream = common.is_streaming_limit(limit)
+    common.validate_cursor_params(cursor, offset, skip_order_by)
+    order_by_args, limit, offset = common.process_list_query_order_by_limit_offset(skip_order_by, order_by, False, limit, offset, skip_order_by_id_field=True)
+    sql_where, sql_order_by, sql_limit, sql_offset = '', '', '', ''
+    if cursor:
+        sql_params = dict(sql_params)
+        sql_where = ' where ' + get_keyset_sql_condition(order_by_args, common.decode_cursor(cursor, order_by_args), sql_params)
+    if order_by_args is not None:
+        sql_order_by = ' order by ' + ', '.join([f'{fieldname} {direction}' for direction, fieldname in order_by_args])
+    if limit is not None:
+        sql_limit = f' limit {limit}'
+    if not stream:
+        common.validate_limit(limit)
+    if stream:
+        sql_limit = f' limit {common.MAX_LIMIT}'
+    if offset is not None:
+        sql_offset = f' offset {offset}'
+    if sql_where or sql_order_by or sql_limit or sql_offset:
+        sql = f'select * from ({sql}) a {sql_where}{sql_order_by}{sql_limit}{sql_offset}'
+    return sql, sql_params, stream, order_by_args, limit
 
 
-def list_(sql, sql_params, default_limit, limit, offset, get_count, order_by, skip_order_by):
-    session = _sessionmaker()
+def get_list_sql_data(session, sql, sql_params, order_by_args, limit):
+    with metrics.timer('db'):
+        data = [common.post_process_response_obj(obj, None) for obj in session.execute(sql, sql_params)]
+    metrics.add('rows', len(data))
+    common.set_next_cursor_header(order_by_args, limit, data)
+    metrics.mark_data_returned()
+    return data
+
+
+def list_(sql, sql_params, default_limit, limit, offset, get_count, order_by, skip_order_by, cursor=None, count_mode=None, response_format=None):
+    response_format = response_formats.get_response_format(response_format)
+    session = db_pool.create_session()
     try:
+        metrics.checkout_connection(session)
         if get_count:
-            sql = f'select count(1) from ({sql}) as count'
-            cnt = list(session.execute(sql, sql_params))[0][0]
+            with metrics.timer('db'):
+                count_response = common.get_count_response(session, sql, sql_params, count_mode)
             session.close()
-            return fastapi.Response(content=str(cnt), media_type="application/json")
+            return count_response
         else:
-            if get_count:
-                limit, offset, default_limit, order_by = None, None, None, None
-            elif not limit and default_limit:
-                limit = default_limit
-            if limit:
-                limit = int(limit)
-            order_by_args, limit, offset = common.process_list_query_order_by_limit_offset(skip_order_by, order_by, get_count, limit, offset, skip_order_by_id_field=True)
-            sql_order_by, sql_limit, sql_offset = '', '', ''
-            if order_by_args is not None:
-                sql_order_by = ' order by ' + ', '.join([f'{fieldname} {direction}' for direction, fieldname in order_by_args])
-            if limit is not None:
-                sql_limit = f' limit {limit}'
-            assert get_count or (sql_limit and 0 < limit <= 15000), "due to abuse, limit must be between 1 and 15000, contact us if you need more"
-            if offset is not None:
-                sql_offset = f' offset {offset}'
-            if sql_order_by or sql_limit or sql_offset:
-                sql = f'select * from ({sql}) a {sql_order_by}{sql_limit}{sql_offset}'
-            data = [common.post_process_response_obj(obj, None) for obj in session.execute(sql, sql_params)]
-            session.close()
-            return data
-            # iterator = (o for o in session.execute(sql, sql_params, execution_options={'stream_results': True}))
-            # first_items = list(itertools.islice(iterator, QUERY_PAGE_SIZE + 1))
-            # if len(first_items) <= QUERY_PAGE_SIZE:
-            #     common.debug_print(f'got {len(first_items)} items - returning without streaming')
-            #     data = [common.post_process_response_obj(obj, None) for obj in first_items]
-            #     session.close()
-            #     return data
-            # else:
-            #     common.debug_print(f'got {len(first_items)} items - returning using streaming')
-            #     return fastapi.responses.StreamingResponse(
-            #         common.streaming_response_iterator(session, first_items, iterator, None),
-            #         media_type="application/json"
-            #     )
+            sql, sql_params, stream, order_by_args, limit = get_list_sql(sql, sql_params, default_limit, limit, offset, order_by, skip_order_by, cursor)
+            common.check_query_cost(session, sql, sql_params)
+            if stream or response_format != 'json':
+                common.debug_print(f'Streaming results for query: {sql}')
+                result = session.execute(sql, sql_params, execution_options={'stream_results': True})
+                return common.get_streaming_response(session, iter(result), None, response_format)
+            else:
+                data = get_list_sql_data(session, sql, sql_params, order_by_args, limit)
+                session.close()
+                return data
     except:
         session.close()
         raise
+
+
+async def list_async(sql, sql_params, default_limit, limit, offset, get_count, order_by, skip_order_by, cursor=None, count_mode=None, response_format=None):
+    if not async_db.ASYNC_DB or db_pool.is_replica_request():
+        return await statement_timeout.run_cancellable(run_in_threadpool(
+            list_, sql, sql_params, default_limit, limit, offset, get_count, order_by, skip_order_by, cursor, count_mode, response_format
+        ))
+    response_format = response_formats.get_response_format(response_format)
+    session = async_db.get_async_session()
+    try:
+        await metrics.async_checkout_connection(session)
+        if get_count:
+            with metrics.timer('db'):
+                count_response = await statement_timeout.run_cancellable(session.run_sync(lambda sync_session: common.get_count_response(
+                    sync_session, sql, sql_params, count_mode
+                )))
+            await session.close()
+            return count_response
+        else:
+            sql, sql_params, stream, order_by_args, limit = get_list_sql(sql, sql_params, default_limit, limit, offset, order_by, skip_order_by, cursor)
+            await statement_timeout.run_cancellable(session.run_sync(lambda sync_session: common.check_query_cost(sync_session, sql, sql_params)))
+            if stream or response_format != 'json':
+                common.debug_print(f'Streaming results for query: {sql}')
+                result = await session.stream(sqlalchemy.text(sql), sql_params)
+                return common.get_async_streaming_response(session, result, None, response_format)
+            else:
+                data = await statement_timeout.run_cancellable(session.run_sync(lambda sync_session: get_list_sql_data(
+                    sync_session, sql, sql_params, order_by_args, limit
+                )))
+                await session.close()
+                return data
+    except:
+        await session.close()
+        raise
@@ -0,0 +1,91 @@
+import os
+import asyncio
+
+import sqlalchemy.exc
+import sqlalchemy.orm
+import sqlalchemy.event
+
+from . import request_context
+
+
+# postgresql statement_timeout of queries which run during requests, 0 disables the timeout
+STATEMENT_TIMEOUT_SECONDS = float(os.environ.get('STATEMENT_TIMEOUT_SECONDS', '30'))
+# timeout of analytical routes (see route_statement_timeout), should be lower than the gunicorn worker timeout
+ANALYTICAL_STATEMENT_TIMEOUT_SECONDS = float(os.environ.get('ANALYTICAL_STATEMENT_TIMEOUT_SECONDS', '100'))
+# cancel the running queries of a request when the http client disconnects
+CANCEL_ON_DISCONNECT = os.environ.get('CANCEL_ON_DISCONNECT', 'yes').lower() in ('1', 'true', 'yes')
+# postgresql error code of queries which were canceled due to statement timeout or cancel request
+QUERY_CANCELED_PGCODE = '57014'
+
+
+class ClientDisconnectedError(Exception):
+    pass
+
+
+def get_statement_timeout_seconds():
+    context = request_context.get_request_context()
+    if context is None:
+        return None
+    return context.get('statement_timeout_seconds', STATEMENT_TIMEOUT_SECONDS)
+
+
+def route_statement_timeout(seconds):
+    # decorator for routes which need a different statement timeout, should be placed below the router decorator
+    return request_context.route_context_decorator(statement_timeout_seconds=seconds)
+
+
+def is_query_canceled(exc):
+    return isinstance(exc, sqlalchemy.exc.DBAPIError) and getattr(exc.orig, 'pgcode', None) == QUERY_CANCELED_PGCODE
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_begin')
+def _after_begin(session, transaction, connection):
+    # applies to all the sessions which are used during requests, including async sessions which wrap a sync session
+    context = request_context.get_request_context()
+    if context is None or connection.dialect.name != 'postgresql':
+        return
+    timeout_seconds = get_statement_timeout_seconds()
+    if timeout_seconds:
+        # set local applies only to the current transaction, so it's not kept when the connection returns to the pool
+        connection.exec_driver_sql(f'set local statement_timeout = {int(timeout_seconds * 1000)}')
+    dbapi_connection = connection.connection.dbapi_connection
+    if CANCEL_ON_DISCONNECT and hasattr(dbapi_connection, 'cancel'):
+        context.setdefault('db_connections', {})[session] = dbapi_connection
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, 'after_transaction_end')
+def _after_transaction_end(session, transaction):
+    # the connection returns to the pool, so it must not be canceled anymore
+    context = request_context.get_request_context()
+    if context is not None and transaction.parent is None:
+        context.get('db_connections', {}).pop(session, None)
+
+
+def cancel_queries():
+    # sends a cancel request for the queries which currently run on the connections of the current request
+    context = request_context.get_request_context()
+    for dbapi_connection in list(context.get('db_connections', {}).values()):
+        dbapi_connection.cancel()
+
+
+async def run_cancellable(awaitable):
+    # awaits the given awaitable, if the http client disconnects before it completes, its queries are canceled
+    # sync queries which run in the threadpool are canceled using a cancel request, async queries are canceled by canceling the task
+    context = request_context.get_request_context()
+    if not CANCEL_ON_DISCONNECT or context is None:
+        return await awaitable
+    task = asyncio.ensure_future(awaitable)
+    disconnect_task = asyncio.ensure_future(request_context.wait_for_disconnect())
+    try:
+        await asyncio.wait([task, disconnect_task], return_when=asyncio.FIRST_COMPLETED)
+        if not task.done():
+            cancel_queries()
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+            raise ClientDisconnectedError()
+        return task.result()
+    finally:
+        disconnect_task.cancel()
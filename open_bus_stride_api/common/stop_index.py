@@ -0,0 +1,162 @@
+import os
+import math
+import threading
+import collections
+
+from starlette.concurrency import run_in_threadpool
+from open_bus_stride_db.model.gtfs_stop import GtfsStop
+
+from . import cache, http_cache, db_pool
+
+
+# number of dates which are kept in memory, least recently used dates are evicted
+STOP_INDEX_MAX_DATES = int(os.environ.get('STOP_INDEX_MAX_DATES', '7'))
+# grid cell size, about 1.1km of latitude, a date has about 30,000 stops so most cells have a few stops
+GRID_CELL_DEGREES = 0.01
+EARTH_RADIUS_METERS = 6371008.8
+METERS_PER_DEGREE = EARTH_RADIUS_METERS * math.pi / 180
+STOP_FIELDS = ['id', 'date', 'code', 'lat', 'lon', 'name', 'city']
+
+
+def get_distance_meters(lat1, lon1, lat2, lon2):
+    # haversine formula
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _get_cell(lat, lon):
+    return int(math.floor(lat / GRID_CELL_DEGREES)), int(math.floor(lon / GRID_CELL_DEGREES))
+
+
+def _get_cell_min_meters(lat, max_distance_meters):
+    # lower bound of the size of a grid cell in meters, for cells within max_distance_meters of lat
+    max_abs_lat = min(abs(lat) + max_distance_meters / METERS_PER_DEGREE + GRID_CELL_DEGREES, 89.0)
+    return GRID_CELL_DEGREES * METERS_PER_DEGREE * math.cos(math.radians(max_abs_lat))
+
+
+class StopIndex:
+    # grid index of the stops of a single date
+
+    def __init__(self, stops):
+        self._stops = [stop for stop in stops if stop['lat'] is not None and stop['lon'] is not None]
+        self._cells = collections.defaultdict(list)
+        for stop in self._stops:
+            self._cells[_get_cell(stop['lat'], stop['lon'])].append(stop)
+        self._cells_bounds = (
+            min(cell[0] for cell in self._cells), max(cell[0] for cell in self._cells),
+            min(cell[1] for cell in self._cells), max(cell[1] for cell in self._cells),
+        ) if self._cells else None
+
+    def __len__(self):
+        return len(self._stops)
+
+    def _iterate_ring(self, cell_lat, cell_lon, ring):
+        # yields the stops in the cells which are exactly ring cells away from the given cell
+        if ring == 0:
+            yield from self._cells.get((cell_lat, cell_lon), [])
+            return
+        for d_lat in range(-ring, ring + 1):
+            d_lons = range(-ring, ring + 1) if abs(d_lat) == ring else (-ring, ring)
+            for d_lon in d_lons:
+                yield from self._cells.get((cell_lat + d_lat, cell_lon + d_lon), [])
+
+    def _iterate_rings(self, lat, lon, max_distance_meters):
+        # yields tuples of (ring, cell_min_meters, stops) for the rings of cells around the point,
+        # up to max_distance_meters or until there are no more cells with stops
+        if self._cells_bounds is None:
+            return
+        cell_lat, cell_lon = _get_cell(lat, lon)
+        min_cell_lat, max_cell_lat, min_cell_lon, max_cell_lon = self._cells_bounds
+        cell_min_meters = _get_cell_min_meters(lat, max_distance_meters)
+        max_ring = min(
+            int(math.ceil(max_distance_meters / cell_min_meters)) + 1,
+            max(abs(cell_lat - min_cell_lat), abs(cell_lat - max_cell_lat),
+                abs(cell_lon - min_cell_lon), abs(cell_lon - max_cell_lon)),
+        )
+        for ring in range(max_ring + 1):
+            yield ring, cell_min_meters, self._iterate_ring(cell_lat, cell_lon, ring)
+
+    def _get_result(self, distance_stops, limit):
+        distance_stops.sort(key=lambda distance_stop: distance_stop[0])
+        return [{**stop, 'distance_meters': distance} for distance, stop in distance_stops[:limit]]
+
+    def within_radius(self, lat, lon, radius_meters, limit):
+        # returns the stops within the radius, ordered by distance
+        distance_stops = []
+        for _, _, stops in self._iterate_rings(lat, lon, radius_meters):
+            for stop in stops:
+                distance = get_distance_meters(lat, lon, stop['lat'], stop['lon'])
+                if distance <= radius_meters:
+                    distance_stops.append((distance, stop))
+        return self._get_result(distance_stops, limit)
+
+    def nearest(self, lat, lon, limit, max_distance_meters):
+        # returns the nearest stops, ordered by distance
+        # rings of cells around the point are scanned until the next rings can't contain nearer stops
+        distance_stops = []
+        for ring, cell_min_meters, stops in self._iterate_rings(lat, lon, max_distance_meters):
+            for stop in stops:
+                distance = get_distance_meters(lat, lon, stop['lat'], stop['lon'])
+                if distance <= max_distance_meters:
+                    distance_stops.append((distance, stop))
+            if len(distance_stops) >= limit:
+                distance_stops.sort(key=lambda distance_stop: distance_stop[0])
+                del distance_stops[limit:]
+                # stops in the next rings are at least this far from the point
+                if distance_stops[-1][0] <= ring * cell_min_meters:
+                    break
+        return self._get_result(distance_stops, limit)
+
+
+_indexes = cache.LRUCache(STOP_INDEX_MAX_DATES)
+# lock of each date which is being loaded, so that loading a date doesn't block requests of other dates
+_load_locks = {}
+_load_locks_lock = threading.Lock()
+
+
+def load_stops(date):
+    with db_pool.get_session() as session:
+        return [
+            dict(zip(STOP_FIELDS, row))
+            for row in session.query(*[getattr(GtfsStop, field) for field in STOP_FIELDS]).filter(GtfsStop.date == date)
+        ]
+
+
+def get_ttl_seconds(date):
+    # stops of closed dates are not modified, stops of later dates may still be updated by the ETL
+    if http_cache.is_closed_date(date):
+        return cache.CACHE_HISTORICAL_TTL_SECONDS
+    else:
+        return cache.CACHE_CURRENT_TTL_SECONDS
+
+
+def get_stop_index(date):
+    found, index = _indexes.get(date)
+    if not found:
+        # the lock prevents concurrent requests from loading the same date multiple times
+        with _load_locks_lock:
+            load_lock = _load_locks.setdefault(date, threading.Lock())
+        try:
+            with load_lock:
+                found, index = _indexes.get(date)
+                if not found:
+                    index = StopIndex(load_stops(date))
+                    _indexes.set(date, index, get_ttl_seconds(date))
+        finally:
+            with _load_locks_lock:
+                if _load_locks.get(date) is load_lock:
+                    del _load_locks[date]
+    return index
+
+
+async def get_stop_index_async(date):
+    # indexes which were already loaded are returned without switching to the threadpool
+    found, index = _indexes.get(date)
+    if found:
+        return index
+    return await run_in_threadpool(get_stop_index, date)
+
+
+def get_stats():
+    return _indexes.get_stats()
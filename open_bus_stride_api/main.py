@@ -2,13 +2,17 @@ import importlib
 import os
 import traceback
 
-from fastapi import FastAPI, Request
-from sqlalchemy.exc import NoResultFound
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, HTTPException, Query
+from sqlalchemy.exc import NoResultFound, DBAPIError, TimeoutError as PoolTimeoutError
+from fastapi.responses import JSONResponse, Response
 from starlette.middleware.cors import CORSMiddleware
 
 from .version import VERSION
-from .routers import ROUTER_NAMES
+from .routers import ROUTER_NAMES, common
+from .common.request_context import RequestContextMiddleware
+from .common.http_cache import ETagMiddleware
+from .common.compression import CompressionMiddleware
+from .common import cache, statement_timeout, metrics, slow_query_log, db_pool, admin
 
 
 with open(os.path.join(os.path.dirname(__file__), "DESCRIPTION.md"), "r") as f:
@@ -26,17 +30,78 @@ def generic_error_exception_handler(request: Request, exc: Exception):
     return JSONResponse(status_code=500, content={"message": str(exc), "traceback": traceback.format_tb(exc.__traceback__)})
 
 
+@app.exception_handler(DBAPIError)
+def sqlalchemy_dbapi_error_exception_handler(request: Request, exc: DBAPIError):
+    if statement_timeout.is_query_canceled(exc):
+        return JSONResponse(status_code=504, content={"message": "Query took too long and was canceled, please narrow down the filters or lower the limit"})
+    return generic_error_exception_handler(request, exc)
+
+
+@app.exception_handler(PoolTimeoutError)
+def sqlalchemy_pool_timeout_exception_handler(request: Request, exc: PoolTimeoutError):
+    # all the db connections of the worker were in use for longer than the pool timeout
+    metrics.POOL_CHECKOUT_TIMEOUTS.inc()
+    return JSONResponse(status_code=503, content={"message": "Server is too busy, please try again later"}, headers={"Retry-After": "10"})
+
+
+@app.exception_handler(statement_timeout.ClientDisconnectedError)
+def client_disconnected_exception_handler(request: Request, exc: statement_timeout.ClientDisconnectedError):
+    # the client will not receive this response, the queries of the request were canceled
+    return JSONResponse(status_code=499, content={"message": "Client disconnected"})
+
+
 for router_name in ROUTER_NAMES:
     app.include_router(
             importlib.import_module('open_bus_stride_api.routers.{}'.format(router_name)).router,
         prefix='/{}'.format(router_name)
     )
 
+app.add_middleware(RequestContextMiddleware)
+# added after RequestContextMiddleware, so that the etag is based on the final response
+app.add_middleware(ETagMiddleware)
+# added after ETagMiddleware, so that the etag is based on the uncompressed response
+app.add_middleware(CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins='*',
+    expose_headers=[*common.EXPOSE_HEADERS, cache.CACHE_STATUS_HEADER, 'ETag'],
 )
+# added last, so that it measures the whole request and the final response bytes
+app.add_middleware(metrics.MetricsMiddleware)
 
 @app.get("/", include_in_schema=False)
 async def root():
     return {"ok": True}
+
+
+@app.get("/stats/cache", include_in_schema=False)
+async def cache_stats():
+    return cache.get_stats()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_():
+    content, content_type = metrics.get_metrics()
+    return Response(content=content, media_type=content_type)
+
+
+def check_admin_token(request: Request):
+    if not admin.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail='Not Found')
+    if not admin.is_admin_token_valid(admin.get_request_admin_token(request.headers.get)):
+        raise HTTPException(status_code=403, detail='Invalid admin token')
+
+
+@app.get("/admin/slow_queries", include_in_schema=False)
+async def admin_slow_queries(request: Request, limit: int = Query(20, ge=1, le=slow_query_log.SLOW_QUERY_MAX_FINGERPRINTS),
+                             order_by: str = Query('total_seconds', regex='^(total_seconds|max_seconds|count)$')):
+    # slowest query shapes of the worker process which handles the request, grouped by normalized sql fingerprint
+    check_admin_token(request)
+    return slow_query_log.get_top(limit, order_by)
+
+
+@app.get("/admin/db_pool", include_in_schema=False)
+async def admin_db_pool(request: Request):
+    # db connection pools of the worker process which handles the request
+    check_admin_token(request)
+    return db_pool.get_status()
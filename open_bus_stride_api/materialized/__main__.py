@@ -0,0 +1,22 @@
+import sys
+
+from . import velocity_grid, rides_execution, gtfs_rides_agg
+
+
+# usage: python -m open_bus_stride_api.materialized <store_name> [args..]
+# e.g. python -m open_bus_stride_api.materialized velocity_grid 2023-05-01 7 1,2,3
+#      python -m open_bus_stride_api.materialized rides_execution 2023-05-01 7
+#      python -m open_bus_stride_api.materialized gtfs_rides_agg 2023-01-01 365
+STORES = {
+    'velocity_grid': velocity_grid.build,
+    'rides_execution': rides_execution.build,
+    'gtfs_rides_agg': gtfs_rides_agg.build,
+}
+
+
+def main(store_name, *args):
+    STORES[store_name](*args)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
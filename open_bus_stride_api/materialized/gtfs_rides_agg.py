@@ -0,0 +1,243 @@
+import json
+import datetime
+
+from sqlalchemy import text
+
+from . import store
+from ..common import db_pool
+
+
+# gtfs_rides_agg_by_hour rollup per date, hour, operator_ref and line_ref, it can answer any gtfs_rides_agg group_by query
+# route names are stored as json lists, so that they can be merged when grouping by line_ref
+LIVE_QUERY = """
+    select
+        agg.gtfs_route_date as date,
+        agg.gtfs_route_hour,
+        date_part('hour', agg.gtfs_route_hour)::integer as hour,
+        rt.operator_ref,
+        rt.line_ref,
+        trim(lower(to_char(agg.gtfs_route_hour, 'DAY'))) as day_of_week,
+        count(1) as total_routes,
+        sum(agg.num_planned_rides)::bigint as total_planned_rides,
+        sum(agg.num_actual_rides)::bigint as total_actual_rides,
+        json_agg(distinct rt.route_short_name)::text as route_short_name,
+        json_agg(distinct rt.route_long_name)::text as route_long_name
+    from gtfs_rides_agg_by_hour agg, gtfs_route rt
+    where
+        agg.gtfs_route_id = rt.id
+        and agg.gtfs_route_date >= :date_from
+        and agg.gtfs_route_date <= :date_to
+        and rt.date >= :rt_date_from
+        and rt.date <= :rt_date_to
+    group by agg.gtfs_route_date, agg.gtfs_route_hour, rt.operator_ref, rt.line_ref
+"""
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS gtfs_rides_agg_day (
+        date TEXT NOT NULL PRIMARY KEY,
+        created_at TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS gtfs_rides_agg_hour (
+        date TEXT NOT NULL,
+        gtfs_route_hour TEXT NOT NULL,
+        hour INTEGER NOT NULL,
+        operator_ref INTEGER,
+        line_ref INTEGER,
+        day_of_week TEXT NOT NULL,
+        total_routes INTEGER NOT NULL,
+        total_planned_rides INTEGER NOT NULL,
+        total_actual_rides INTEGER NOT NULL,
+        route_short_name TEXT NOT NULL,
+        route_long_name TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS gtfs_rides_agg_hour_date ON gtfs_rides_agg_hour (date);
+    CREATE TABLE IF NOT EXISTS gtfs_rides_agg_line_day (
+        date TEXT NOT NULL,
+        operator_ref INTEGER,
+        line_ref INTEGER,
+        day_of_week TEXT NOT NULL,
+        total_routes INTEGER NOT NULL,
+        total_planned_rides INTEGER NOT NULL,
+        total_actual_rides INTEGER NOT NULL,
+        route_short_name TEXT NOT NULL,
+        route_long_name TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS gtfs_rides_agg_line_day_date ON gtfs_rides_agg_line_day (date);
+"""
+# sqlite column of each group by field
+GROUP_BY_COLUMNS = {
+    'gtfs_route_date': 'date',
+    'gtfs_route_hour': 'gtfs_route_hour',
+    'operator_ref': 'operator_ref',
+    'day_of_week': 'day_of_week',
+    'line_ref': 'line_ref',
+}
+ROUTE_NAME_FIELDS = ['route_short_name', 'route_long_name']
+TOTAL_FIELDS = ['total_routes', 'total_planned_rides', 'total_actual_rides']
+# separates the route names json lists of grouped rows, it can't appear in json text
+NAMES_SEPARATOR = '\x1f'
+
+
+def get_live_rows(date_from, date_to):
+    with db_pool.get_session() as session:
+        return [tuple(row) for row in session.execute(text(LIVE_QUERY), {
+            'date_from': date_from,
+            'date_to': date_to,
+            'rt_date_from': date_from - datetime.timedelta(days=30),
+            'rt_date_to': date_to + datetime.timedelta(days=30),
+        })]
+
+
+def merge_route_names(names_jsons):
+    # merges json lists of distinct names, the result is formatted like postgresql json_agg(distinct ..)::text
+    names = set()
+    for names_json in names_jsons:
+        names.update(json.loads(names_json))
+    return json.dumps(sorted(names, key=lambda name: (name is None, name)), ensure_ascii=False)
+
+
+def get_connection():
+    return store.get_connection('gtfs_rides_agg', SCHEMA_SQL)
+
+
+def set_stored_rows(connection, dates, rows):
+    # stores the hourly rows of the given dates, and rolls them up to the per day table
+    created_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    line_days = {}
+    with connection:
+        for date in dates:
+            connection.execute('DELETE FROM gtfs_rides_agg_hour WHERE date = ?', (date.isoformat(),))
+            connection.execute('DELETE FROM gtfs_rides_agg_line_day WHERE date = ?', (date.isoformat(),))
+        hour_rows = []
+        for date, gtfs_route_hour, hour, operator_ref, line_ref, day_of_week, *totals, route_short_name, route_long_name in rows:
+            if date not in dates:
+                continue
+            hour_rows.append((date.isoformat(), gtfs_route_hour.isoformat(), hour, operator_ref, line_ref, day_of_week, *totals, route_short_name, route_long_name))
+            line_day = line_days.setdefault((date.isoformat(), operator_ref, line_ref, day_of_week), [0, 0, 0, [], []])
+            for i, total in enumerate(totals):
+                line_day[i] += total
+            line_day[3].append(route_short_name)
+            line_day[4].append(route_long_name)
+        connection.executemany('INSERT INTO gtfs_rides_agg_hour VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', hour_rows)
+        connection.executemany('INSERT INTO gtfs_rides_agg_line_day VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+            (*key, *totals, merge_route_names(route_short_names), merge_route_names(route_long_names))
+            for key, (*totals, route_short_names, route_long_names) in line_days.items()
+        ])
+        connection.executemany('INSERT OR REPLACE INTO gtfs_rides_agg_day VALUES (?, ?)', [
+            (date.isoformat(), created_at) for date in dates
+        ])
+
+
+def get_stored_dates(connection, date_from, date_to):
+    return {
+        datetime.date.fromisoformat(row[0]) for row in connection.execute(
+            'SELECT date FROM gtfs_rides_agg_day WHERE date >= ? AND date <= ?', (date_from.isoformat(), date_to.isoformat())
+        )
+    }
+
+
+def _get_group_value(fieldname, value):
+    if fieldname == 'gtfs_route_date':
+        return datetime.date.fromisoformat(value)
+    elif fieldname == 'gtfs_route_hour':
+        return datetime.datetime.fromisoformat(value)
+    else:
+        return value
+
+
+def get_stored_groups(connection, group_by, date_from, date_to, exclude_hours_from=None, exclude_hours_to=None, exclude_date_ranges=()):
+    # returns the grouped rows as dicts with the same fields as the gtfs_rides_agg group_by live query
+    # the hourly table is used only if needed, otherwise the smaller per day table is used
+    if 'gtfs_route_hour' in group_by or exclude_hours_from or exclude_hours_to:
+        table = 'gtfs_rides_agg_hour'
+    else:
+        table = 'gtfs_rides_agg_line_day'
+    columns = [GROUP_BY_COLUMNS[fieldname] for fieldname in group_by]
+    select_fields = [*columns, *[f'SUM({fieldname})' for fieldname in TOTAL_FIELDS]]
+    if 'line_ref' in group_by:
+        select_fields += [f"GROUP_CONCAT({fieldname}, '{NAMES_SEPARATOR}')" for fieldname in ROUTE_NAME_FIELDS]
+    sql = f'SELECT {", ".join(select_fields)} FROM {table} WHERE date >= ? AND date <= ?'
+    params = [date_from.isoformat(), date_to.isoformat()]
+    if exclude_hours_from:
+        sql += ' AND NOT hour >= ?'
+        params.append(exclude_hours_from)
+    if exclude_hours_to:
+        sql += ' AND NOT hour <= ?'
+        params.append(exclude_hours_to)
+    for exclude_date_from, exclude_date_to in exclude_date_ranges:
+        # dates which are queried live, they might be stored by a concurrent request
+        sql += ' AND NOT date BETWEEN ? AND ?'
+        params += [exclude_date_from.isoformat(), exclude_date_to.isoformat()]
+    if columns:
+        sql += f' GROUP BY {", ".join(columns)}'
+    groups = []
+    for row in connection.execute(sql, params):
+        if not columns and row[0] is None:
+            # aggregation without group by returns a single row of nulls if there are no rows
+            continue
+        # fields are ordered like the live query fields
+        group = {}
+        for fieldname, value in zip(group_by, row):
+            if fieldname == 'line_ref':
+                for names_fieldname, names_jsons in zip(ROUTE_NAME_FIELDS, row[len(columns) + len(TOTAL_FIELDS):]):
+                    group[names_fieldname] = merge_route_names(names_jsons.split(NAMES_SEPARATOR))
+            group[fieldname] = _get_group_value(fieldname, value)
+        group.update(zip(TOTAL_FIELDS, row[len(columns):len(columns) + len(TOTAL_FIELDS)]))
+        groups.append(group)
+    return groups
+
+
+def get_groups(group_by, date_from, date_to, exclude_hours_from=None, exclude_hours_to=None):
+    # returns tuple of (groups, live_date_ranges)
+    # groups are the grouped rows of the stored days in range, live_date_ranges are (date_from, date_to) tuples which should be queried live
+    # at most MAX_REQUEST_BUILD_DAYS missing days are materialized by each request, the other missing days are queried live
+    # returns (None, [(date_from, date_to)]) if there are no closed days in range, so that the full range is queried live
+    materialized_date_to = store.get_materialized_date_to(date_from, date_to)
+    if materialized_date_to is None:
+        return None, [(date_from, date_to)]
+    connection = get_connection()
+    try:
+        missing_dates = store.get_missing_dates(get_stored_dates(connection, date_from, materialized_date_to), date_from, materialized_date_to)
+        for build_date_from, build_date_to in store.get_build_date_runs(missing_dates):
+            set_stored_rows(connection, set(store.get_dates(build_date_from, build_date_to)), get_live_rows(build_date_from, build_date_to))
+        live_date_ranges = store.get_live_date_ranges(missing_dates, materialized_date_to, date_to)
+        groups = get_stored_groups(connection, group_by, date_from, materialized_date_to, exclude_hours_from, exclude_hours_to, live_date_ranges)
+    finally:
+        connection.close()
+    return groups, live_date_ranges
+
+
+def merge_groups(group_by, groups_lists):
+    # merges grouped rows of separate date ranges, which may contain the same groups
+    merged = {}
+    for groups in groups_lists:
+        for group in groups:
+            key = tuple(group[fieldname] for fieldname in group_by)
+            merged_group = merged.get(key)
+            if merged_group is None:
+                merged[key] = dict(group)
+            else:
+                for fieldname in TOTAL_FIELDS:
+                    merged_group[fieldname] += group[fieldname]
+                if 'line_ref' in group_by:
+                    for fieldname in ROUTE_NAME_FIELDS:
+                        merged_group[fieldname] = merge_route_names([merged_group[fieldname], group[fieldname]])
+    return list(merged.values())
+
+
+def build(date_from, num_days=1):
+    # materializes consecutive days starting from date_from, skipping days which were already materialized
+    date_from = datetime.date.fromisoformat(date_from)
+    connection = get_connection()
+    try:
+        for day in range(int(num_days)):
+            date = date_from + datetime.timedelta(days=day)
+            if not store.is_materialized_day(date):
+                print(f'{date}: not closed yet')
+                continue
+            if get_stored_dates(connection, date, date):
+                continue
+            rows = get_live_rows(date, date)
+            set_stored_rows(connection, {date}, rows)
+            print(f'{date}: {len(rows)} rows')
+    finally:
+        connection.close()
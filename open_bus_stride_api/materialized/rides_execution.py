@@ -0,0 +1,275 @@
+import datetime
+from textwrap import dedent
+
+from sqlalchemy import text
+
+from . import store
+from ..common import db_pool, sql_route
+
+
+# planned (gtfs) vs. actual (siri) rides, matched by line and start time
+# the start time conditions are equivalent to date_trunc('day', start_time) between :date_from and :date_to,
+# but they allow to use the start time indexes
+LIVE_QUERY = """
+    select
+        coalesce(actual_rides.operator_ref, planned_rides.operator_ref) as operator_ref,
+        coalesce(actual_rides.line_ref, planned_rides.line_ref) as line_ref,
+        date_trunc('day', coalesce(planned_rides.start_time, actual_rides.start_time))::date as date,
+        actual_rides.start_time::timestamptz as actual_start_time,
+        planned_rides.start_time::timestamptz as planned_start_time,
+        planned_rides.gtfs_ride_id,
+        actual_rides.siri_ride_id
+    from
+        (
+            (select
+                siri_ride.scheduled_start_time as start_time, siri_ride.id as siri_ride_id, sr.operator_ref, sr.line_ref
+            from
+                siri_ride
+                join siri_route sr on siri_ride.siri_route_id = sr.id
+            where
+                {siri_route_condition}
+                and siri_ride.scheduled_start_time >= :date_from
+                and siri_ride.scheduled_start_time < :date_to_exclusive
+            ) actual_rides
+        full outer join
+            (select
+                gtfs_ride.start_time as start_time, gtfs_ride.id as gtfs_ride_id, gr.operator_ref, gr.line_ref
+            from
+                gtfs_ride
+                join gtfs_route gr on gtfs_ride.gtfs_route_id = gr.id
+            where
+                {gtfs_route_condition}
+                and gtfs_ride.start_time >= :date_from
+                and gtfs_ride.start_time < :date_to_exclusive
+            ) planned_rides
+        on
+            actual_rides.start_time = planned_rides.start_time
+            and actual_rides.operator_ref = planned_rides.operator_ref
+            and actual_rides.line_ref = planned_rides.line_ref
+    )
+"""
+# conditions on the route table alias, for all the lines of an operator or for some of its lines
+OPERATOR_ROUTE_CONDITION = '{route}.operator_ref = :operator_ref'
+LINES_ROUTE_CONDITION = '{route}.operator_ref = :operator_ref and {route}.line_ref = any(cast(:line_refs as integer[]))'
+# fields of the ride tuples
+RIDE_FIELDS = ('operator_ref', 'line_ref', 'date', 'actual_start_time', 'planned_start_time', 'gtfs_ride_id', 'siri_ride_id')
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS rides_execution_day (
+        date TEXT NOT NULL PRIMARY KEY,
+        created_at TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS rides_execution_operator_day (
+        date TEXT NOT NULL,
+        operator_ref INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (operator_ref, date)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS rides_execution_line_day (
+        date TEXT NOT NULL,
+        operator_ref INTEGER NOT NULL,
+        line_ref INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (operator_ref, line_ref, date)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS rides_execution_ride (
+        date TEXT NOT NULL,
+        operator_ref INTEGER NOT NULL,
+        line_ref INTEGER NOT NULL,
+        actual_start_time TEXT,
+        planned_start_time TEXT,
+        gtfs_ride_id INTEGER,
+        siri_ride_id INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS rides_execution_ride_line_date ON rides_execution_ride (operator_ref, line_ref, date);
+    CREATE INDEX IF NOT EXISTS rides_execution_ride_operator_date ON rides_execution_ride (operator_ref, date);
+"""
+
+
+def get_live_sql(route_condition):
+    return dedent(LIVE_QUERY.format(
+        siri_route_condition=route_condition.format(route='sr'),
+        gtfs_route_condition=route_condition.format(route='gr'),
+    ))
+
+
+def get_live_rides(date_from, date_to, route_condition, params):
+    # returns list of tuples: (operator_ref, line_ref, date, actual_start_time, planned_start_time, gtfs_ride_id, siri_ride_id)
+    with db_pool.get_session() as session:
+        return [tuple(row) for row in session.execute(text(get_live_sql(route_condition)), {
+            **params, 'date_from': date_from, 'date_to_exclusive': date_to + datetime.timedelta(days=1),
+        })]
+
+
+def get_connection(check_same_thread=True):
+    # the store name is versioned, so that stores which were created with an older schema are rebuilt
+    return store.get_connection('rides_execution_v3', SCHEMA_SQL, check_same_thread)
+
+
+def _get_datetime_value(value):
+    # times are stored as utc iso format text with a fixed precision, so that their text order is the same as their time order
+    return value.astimezone(datetime.timezone.utc).isoformat(timespec='microseconds') if value is not None else None
+
+
+def _get_stored_value(value):
+    return _get_datetime_value(value) if isinstance(value, datetime.datetime) else value
+
+
+def _get_ride_value(fieldname, value):
+    if value is None:
+        return None
+    elif fieldname == 'date':
+        return datetime.date.fromisoformat(value)
+    elif fieldname in ('actual_start_time', 'planned_start_time'):
+        return datetime.datetime.fromisoformat(value)
+    else:
+        return value
+
+
+def set_stored_rides(connection, dates, rides, operator_ref=None, line_refs=None):
+    # stores the rides of the given dates, and marks the dates as materialized for:
+    # the given lines of the operator, all the lines of the operator if line_refs is None,
+    # or all the lines of all the operators if operator_ref is None
+    created_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with connection:
+        for date in dates:
+            if operator_ref is None:
+                connection.execute('DELETE FROM rides_execution_ride WHERE date = ?', (date.isoformat(),))
+            elif line_refs is None:
+                connection.execute('DELETE FROM rides_execution_ride WHERE operator_ref = ? AND date = ?', (operator_ref, date.isoformat()))
+            else:
+                connection.executemany('DELETE FROM rides_execution_ride WHERE operator_ref = ? AND line_ref = ? AND date = ?', [
+                    (operator_ref, line_ref, date.isoformat()) for line_ref in line_refs
+                ])
+        connection.executemany('INSERT INTO rides_execution_ride VALUES (?, ?, ?, ?, ?, ?, ?)', [
+            (date.isoformat(), ride_operator_ref, line_ref, _get_datetime_value(actual_start_time), _get_datetime_value(planned_start_time), gtfs_ride_id, siri_ride_id)
+            for ride_operator_ref, line_ref, date, actual_start_time, planned_start_time, gtfs_ride_id, siri_ride_id in rides
+            if date in dates
+        ])
+        if operator_ref is None:
+            connection.executemany('INSERT OR REPLACE INTO rides_execution_day VALUES (?, ?)', [
+                (date.isoformat(), created_at) for date in dates
+            ])
+        elif line_refs is None:
+            connection.executemany('INSERT OR REPLACE INTO rides_execution_operator_day VALUES (?, ?, ?)', [
+                (date.isoformat(), operator_ref, created_at) for date in dates
+            ])
+        else:
+            connection.executemany('INSERT OR REPLACE INTO rides_execution_line_day VALUES (?, ?, ?, ?)', [
+                (date.isoformat(), operator_ref, line_ref, created_at) for date in dates for line_ref in line_refs
+            ])
+
+
+def get_stored_dates(connection, operator_ref, line_refs, date_from, date_to):
+    # returns the dates in range which were materialized for the given lines, or all the lines of the operator if line_refs is None
+    sql = (
+        'SELECT date FROM rides_execution_day WHERE date >= ? AND date <= ? '
+        'UNION SELECT date FROM rides_execution_operator_day WHERE operator_ref = ? AND date >= ? AND date <= ?'
+    )
+    params = [date_from.isoformat(), date_to.isoformat(), operator_ref, date_from.isoformat(), date_to.isoformat()]
+    if line_refs is not None:
+        sql += (
+            ' UNION SELECT date FROM rides_execution_line_day '
+            'WHERE operator_ref = ? AND line_ref IN ({}) AND date >= ? AND date <= ? '
+            'GROUP BY date HAVING COUNT(*) = ?'
+        ).format(', '.join('?' * len(line_refs)))
+        params += [operator_ref, *line_refs, date_from.isoformat(), date_to.isoformat(), len(line_refs)]
+    return {datetime.date.fromisoformat(row[0]) for row in connection.execute(sql, params)}
+
+
+def get_stored_rides_condition(operator_ref, line_refs, date_from, date_to, exclude_date_ranges, params):
+    # returns the condition of the stored rides of the given lines, or all the lines of the operator if line_refs is None
+    # the values are added to params as named parameters
+    conditions = ['operator_ref = :operator_ref', 'date >= :date_from', 'date <= :date_to']
+    params.update(operator_ref=operator_ref, date_from=date_from.isoformat(), date_to=date_to.isoformat())
+    if line_refs is not None:
+        conditions.append('line_ref IN ({})'.format(', '.join(f':line_ref_{i}' for i in range(len(line_refs)))))
+        params.update({f'line_ref_{i}': line_ref for i, line_ref in enumerate(line_refs)})
+    for i, (exclude_date_from, exclude_date_to) in enumerate(exclude_date_ranges):
+        # dates which are queried live, they might be stored by a concurrent request
+        conditions.append(f'NOT date BETWEEN :exclude_date_from_{i} AND :exclude_date_to_{i}')
+        params.update({f'exclude_date_from_{i}': exclude_date_from.isoformat(), f'exclude_date_to_{i}': exclude_date_to.isoformat()})
+    return ' AND '.join(conditions)
+
+
+def count_stored_rides(connection, operator_ref, line_refs, date_from, date_to, exclude_date_ranges=()):
+    params = {}
+    condition = get_stored_rides_condition(operator_ref, line_refs, date_from, date_to, exclude_date_ranges, params)
+    return connection.execute(f'SELECT COUNT(*) FROM rides_execution_ride WHERE {condition}', params).fetchone()[0]
+
+
+def iter_stored_rides(connection, fieldnames, operator_ref, line_refs, date_from, date_to, exclude_date_ranges=(), order_by_args=(), cursor_values=None, limit=None):
+    # yields the stored rides as dicts of the given RIDE_FIELDS, rows are read from the store while iterating
+    # order_by_args, cursor_values and limit are applied by the query, like the sql_route keyset pagination of the live query
+    # nulls are ordered like the postgresql default (last in ascending order)
+    assert all(fieldname in RIDE_FIELDS for fieldname in fieldnames)
+    assert all(fieldname in RIDE_FIELDS for _, fieldname in order_by_args)
+    params = {}
+    sql = 'SELECT {} FROM rides_execution_ride WHERE {}'.format(
+        ', '.join(fieldnames), get_stored_rides_condition(operator_ref, line_refs, date_from, date_to, exclude_date_ranges, params)
+    )
+    if cursor_values is not None:
+        sql += ' AND ({})'.format(sql_route.get_keyset_sql_condition(order_by_args, [_get_stored_value(value) for value in cursor_values], params))
+    if order_by_args:
+        sql += ' ORDER BY ' + ', '.join(f'{fieldname} IS NULL {direction}, {fieldname} {direction}' for direction, fieldname in order_by_args)
+    if limit is not None:
+        sql += ' LIMIT :limit'
+        params['limit'] = limit
+    for row in connection.execute(sql, params):
+        yield {fieldname: _get_ride_value(fieldname, value) for fieldname, value in zip(fieldnames, row)}
+
+
+def get_route_condition(operator_ref, line_refs):
+    # returns tuple of (route_condition, params) for the given lines of the operator,
+    # or for all the lines of the operator if line_refs is None
+    if line_refs is not None:
+        return LINES_ROUTE_CONDITION, {'operator_ref': operator_ref, 'line_refs': sorted(set(line_refs))}
+    return OPERATOR_ROUTE_CONDITION, {'operator_ref': operator_ref, 'line_refs': None}
+
+
+def get_live_rides_sql(operator_ref, line_refs, date_from, date_to):
+    # returns tuple of (sql, sql_params) for querying the rides between the given dates (inclusive) live
+    route_condition, params = get_route_condition(operator_ref, line_refs)
+    return get_live_sql(route_condition), {**params, 'date_from': date_from, 'date_to_exclusive': date_to + datetime.timedelta(days=1)}
+
+
+def build_rides(operator_ref, line_refs, date_from, date_to):
+    # materializes the closed days in range of the given lines, or of all the lines of the operator if line_refs is None
+    # at most MAX_REQUEST_BUILD_DAYS missing days are materialized by each request, using a single live query for each contiguous run
+    # returns tuple of (materialized_date_to, live_date_ranges): the rides until materialized_date_to are read using iter_stored_rides,
+    # excluding the live date ranges, which are queried using get_live_rides_sql
+    # returns None if no days in range are closed, so that the full range is queried live
+    route_condition, params = get_route_condition(operator_ref, line_refs)
+    line_refs = params['line_refs']
+    materialized_date_to = store.get_materialized_date_to(date_from, date_to)
+    if materialized_date_to is None:
+        return None
+    connection = get_connection()
+    try:
+        stored_dates = get_stored_dates(connection, operator_ref, line_refs, date_from, materialized_date_to)
+        missing_dates = store.get_missing_dates(stored_dates, date_from, materialized_date_to)
+        for build_date_from, build_date_to in store.get_build_date_runs(missing_dates):
+            rides = get_live_rides(build_date_from, build_date_to, route_condition, params)
+            set_stored_rides(connection, set(store.get_dates(build_date_from, build_date_to)), rides, operator_ref, line_refs)
+    finally:
+        connection.close()
+    return materialized_date_to, store.get_live_date_ranges(missing_dates, materialized_date_to, date_to)
+
+
+def build(date_from, num_days=1):
+    # materializes all the lines of consecutive days starting from date_from, using a single live query for each day
+    # days which were already fully materialized are skipped
+    date_from = datetime.date.fromisoformat(date_from)
+    connection = get_connection()
+    try:
+        for day in range(int(num_days)):
+            date = date_from + datetime.timedelta(days=day)
+            if not store.is_closed_day(date):
+                print(f'{date}: not closed yet')
+                continue
+            if connection.execute('SELECT 1 FROM rides_execution_day WHERE date = ?', (date.isoformat(),)).fetchone() is not None:
+                continue
+            rides = get_live_rides(date, date, 'true', {})
+            set_stored_rides(connection, {date}, rides)
+            print(f'{date}: {len(rides)} rides of {len({(ride[0], ride[1]) for ride in rides})} lines')
+    finally:
+        connection.close()
@@ -0,0 +1,96 @@
+import os
+import sqlite3
+import datetime
+
+
+# local sqlite databases with precomputed results of expensive queries over closed (past) periods
+# the data is a cache of the stride db data, so the directory can be deleted at any time, it will be rebuilt on demand
+MATERIALIZED_ENABLED = os.environ.get('MATERIALIZED_ENABLED', 'yes').lower() in ('1', 'true', 'yes')
+MATERIALIZED_DIR = os.environ.get('MATERIALIZED_DIR', '/tmp/open-bus-stride-api-materialized')
+# a period is considered closed only after this delay, to allow the ETL processes to finish loading its data
+MATERIALIZED_CLOSED_DELAY_MINUTES = int(os.environ.get('MATERIALIZED_CLOSED_DELAY_MINUTES', '360'))
+# maximum number of missing days which are materialized by a single request, so that requests don't wait for long builds
+# longer periods can be prebuilt using the cli
+MAX_REQUEST_BUILD_DAYS = 7
+
+
+def get_connection(name, schema_sql, check_same_thread=True):
+    # each store is a separate sqlite database, so that it can be rebuilt independently
+    # WAL journal mode allows concurrent reads from all workers while one of them writes
+    # check_same_thread=False is needed for connections which are used by streaming responses, which iterate in other threads
+    os.makedirs(MATERIALIZED_DIR, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(MATERIALIZED_DIR, f'{name}.sqlite'), timeout=30, check_same_thread=check_same_thread)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(schema_sql)
+    return connection
+
+
+def is_closed(period_end):
+    # period_end is a timezone aware datetime, naive datetimes are considered as UTC
+    if period_end.tzinfo is None:
+        period_end = period_end.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return period_end + datetime.timedelta(minutes=MATERIALIZED_CLOSED_DELAY_MINUTES) < now
+
+
+def get_day_start(date, timezone=datetime.timezone.utc):
+    # stored days are utc calendar days, unless the store is keyed by the days of another timezone
+    return datetime.datetime.combine(date, datetime.time(), tzinfo=timezone)
+
+
+def is_closed_day(date, timezone=datetime.timezone.utc):
+    return is_closed(get_day_start(date + datetime.timedelta(days=1), timezone))
+
+
+def is_materialized_day(date, timezone=datetime.timezone.utc):
+    return MATERIALIZED_ENABLED and is_closed_day(date, timezone)
+
+
+def get_materialized_date_to(date_from, date_to):
+    # returns the last date in range which can be served from the store, or None if there are no such dates
+    # days are closed in order, so all days until the returned date are closed
+    materialized_date_to = None
+    date = date_from
+    while date <= date_to and is_materialized_day(date):
+        materialized_date_to = date
+        date += datetime.timedelta(days=1)
+    return materialized_date_to
+
+
+def get_dates(date_from, date_to):
+    # returns the list of dates in range (inclusive)
+    return [date_from + datetime.timedelta(days=day) for day in range((date_to - date_from).days + 1)]
+
+
+def get_missing_dates(stored_dates, date_from, date_to):
+    # returns the sorted list of dates in range which are not in stored_dates
+    return [date for date in get_dates(date_from, date_to) if date not in stored_dates]
+
+
+def get_date_runs(dates):
+    # returns (date_from, date_to) tuples of the contiguous runs of the given sorted dates
+    runs = []
+    for date in dates:
+        if runs and runs[-1][1] + datetime.timedelta(days=1) == date:
+            runs[-1] = (runs[-1][0], date)
+        else:
+            runs.append((date, date))
+    return runs
+
+
+def get_build_date_runs(missing_dates):
+    # at most MAX_REQUEST_BUILD_DAYS missing days are materialized by each request
+    # returns the contiguous runs of these days, each run should be materialized using a single live query
+    return get_date_runs(missing_dates[:MAX_REQUEST_BUILD_DAYS])
+
+
+def get_live_date_ranges(missing_dates, materialized_date_to, date_to):
+    # returns (date_from, date_to) tuples of the days which should be queried live:
+    # the missing days which are not materialized by this request, and the days after materialized_date_to
+    live_date_ranges = get_date_runs(missing_dates[MAX_REQUEST_BUILD_DAYS:])
+    if materialized_date_to < date_to:
+        if live_date_ranges and live_date_ranges[-1][1] == materialized_date_to:
+            live_date_ranges[-1] = (live_date_ranges[-1][0], date_to)
+        else:
+            live_date_ranges.append((materialized_date_to + datetime.timedelta(days=1), date_to))
+    return live_date_ranges
@@ -0,0 +1,251 @@
+import math
+import datetime
+try:
+    import zoneinfo
+except ImportError:
+    # python < 3.9
+    from backports import zoneinfo
+
+from sqlalchemy import text
+
+from . import store
+from ..common import db_pool
+
+
+# the rolling average is calculated for each grid cell, and then aggregated to per-cell partials
+# (count, sum and sum of squares), which allow to calculate the average and stddev for any set of days
+# the time range is half-open, so that partials of consecutive days can be merged without counting samples twice
+PARTIALS_QUERY = """
+    WITH RollingAvg AS (
+        with RoundedLonLat as (
+            SELECT
+                (CAST(lon AS NUMERIC) * POWER(2, :rounding_precision) + 0.5)::INT / POWER(2, :rounding_precision) AS rounded_lon,
+                (CAST(lat AS NUMERIC) * POWER(2, :rounding_precision) + 0.5)::INT / POWER(2, :rounding_precision) AS rounded_lat,
+                velocity,
+                recorded_at_time
+            FROM
+                siri_vehicle_location
+            WHERE
+                velocity > :velocity_min
+                AND velocity < :velocity_max
+                AND lon BETWEEN :lon_min AND :lon_max
+                AND lat BETWEEN :lat_min AND :lat_max
+                AND recorded_at_time >= :recorded_from AND recorded_at_time < :recorded_to
+        )
+        SELECT
+            rounded_lon,
+            rounded_lat,
+            AVG(velocity) OVER (
+                PARTITION BY
+                    rounded_lon,
+                    rounded_lat
+                ORDER BY
+                    recorded_at_time
+                ROWS BETWEEN 2 PRECEDING AND 2 FOLLOWING
+            ) AS rolling_average
+        FROM
+            RoundedLonLat
+    )
+    SELECT
+        rounded_lon::DOUBLE PRECISION AS rounded_lon,
+        rounded_lat::DOUBLE PRECISION AS rounded_lat,
+        COUNT(*) AS sample_count,
+        SUM(rolling_average)::DOUBLE PRECISION AS sum_rolling_avg,
+        SUM(rolling_average * rolling_average)::DOUBLE PRECISION AS sumsq_rolling_avg
+    FROM
+        RollingAvg
+    GROUP BY
+        rounded_lon,
+        rounded_lat
+"""
+VELOCITY_MIN = 0
+VELOCITY_MAX = 200
+# maximum time range of a single request, longer ranges are aggregated from per-day partials
+MAX_DAYS = 31
+# the stored grid covers these bounds, requests with bounds inside them are served from the store
+BOUNDS = {'lon_min': 34.25, 'lon_max': 35.70, 'lat_min': 29.50, 'lat_max': 33.33}
+# the stored partials are of israel calendar days, so that requests of whole local days (e.g. from 00:00+03:00) are served from the store
+TIMEZONE = zoneinfo.ZoneInfo('Asia/Jerusalem')
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS velocity_grid_day (
+        date TEXT NOT NULL,
+        rounding_precision INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (date, rounding_precision)
+    );
+    CREATE TABLE IF NOT EXISTS velocity_grid_cell (
+        date TEXT NOT NULL,
+        rounding_precision INTEGER NOT NULL,
+        rounded_lon REAL NOT NULL,
+        rounded_lat REAL NOT NULL,
+        sample_count INTEGER NOT NULL,
+        sum_rolling_avg REAL NOT NULL,
+        sumsq_rolling_avg REAL NOT NULL,
+        PRIMARY KEY (date, rounding_precision, rounded_lon, rounded_lat)
+    ) WITHOUT ROWID;
+"""
+
+
+def _as_utc(value):
+    # naive datetimes are considered as UTC, like in store.is_closed
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+
+def get_day_start(date):
+    return store.get_day_start(date, TIMEZONE)
+
+
+def get_live_partials(recorded_from, recorded_to, rounding_precision, bounds):
+    # returns list of tuples: (rounded_lon, rounded_lat, sample_count, sum_rolling_avg, sumsq_rolling_avg)
+    params = {
+        "rounding_precision": rounding_precision,
+        "velocity_min": VELOCITY_MIN,
+        "velocity_max": VELOCITY_MAX,
+        "recorded_from": recorded_from,
+        "recorded_to": recorded_to,
+        **bounds,
+    }
+    with db_pool.get_session() as session:
+        return [tuple(row) for row in session.execute(text(PARTIALS_QUERY), params)]
+
+
+def get_stored_partials(connection, date, rounding_precision):
+    # returns None if the day was not materialized yet
+    key = date.isoformat()
+    if connection.execute(
+        'SELECT 1 FROM velocity_grid_day WHERE date = ? AND rounding_precision = ?', (key, rounding_precision)
+    ).fetchone() is None:
+        return None
+    return connection.execute(
+        'SELECT rounded_lon, rounded_lat, sample_count, sum_rolling_avg, sumsq_rolling_avg '
+        'FROM velocity_grid_cell WHERE date = ? AND rounding_precision = ?', (key, rounding_precision)
+    ).fetchall()
+
+
+def set_stored_partials(connection, date, rounding_precision, partials):
+    key = date.isoformat()
+    with connection:
+        connection.execute('DELETE FROM velocity_grid_cell WHERE date = ? AND rounding_precision = ?', (key, rounding_precision))
+        connection.executemany(
+            'INSERT OR REPLACE INTO velocity_grid_cell VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(key, rounding_precision, *row) for row in partials]
+        )
+        connection.execute(
+            'INSERT OR REPLACE INTO velocity_grid_day VALUES (?, ?, ?)',
+            (key, rounding_precision, datetime.datetime.now(datetime.timezone.utc).isoformat())
+        )
+
+
+def is_materialized_bounds(bounds):
+    return (
+        bounds['lon_min'] >= BOUNDS['lon_min'] and bounds['lon_max'] <= BOUNDS['lon_max']
+        and bounds['lat_min'] >= BOUNDS['lat_min'] and bounds['lat_max'] <= BOUNDS['lat_max']
+    )
+
+
+def get_connection():
+    # the store name is versioned, so that stores which were created with an older schema are rebuilt
+    return store.get_connection('velocity_grid_v3', SCHEMA_SQL)
+
+
+def build_day(connection, date, rounding_precision):
+    partials = get_live_partials(get_day_start(date), get_day_start(date + datetime.timedelta(days=1)), rounding_precision, BOUNDS)
+    set_stored_partials(connection, date, rounding_precision, partials)
+    return partials
+
+
+def _filter_bounds(partials, rounding_precision, bounds):
+    # each cell covers the area within half a step of its rounded coordinates
+    half_step = 0.5 / 2 ** rounding_precision
+    return [
+        row for row in partials
+        if bounds['lon_min'] - half_step <= row[0] <= bounds['lon_max'] + half_step
+        and bounds['lat_min'] - half_step <= row[1] <= bounds['lat_max'] + half_step
+    ]
+
+
+def get_partials(recorded_from, recorded_to, rounding_precision, bounds):
+    # local calendar days in range which ended are served from the store, they are materialized on first request
+    # the parts of days at the start and end of the range, days which didn't end, or bounds outside of the stored grid
+    # are calculated using the live query, consecutive live days are calculated using a single query
+    # returns the partials of all days, use get_cells to merge them
+    recorded_from, recorded_to = _as_utc(recorded_from), _as_utc(recorded_to)
+    live_ranges, stored_dates = [], []
+    live_from = recorded_from
+    if is_materialized_bounds(bounds):
+        date = recorded_from.astimezone(TIMEZONE).date()
+        if get_day_start(date) < recorded_from:
+            date += datetime.timedelta(days=1)
+        while get_day_start(date + datetime.timedelta(days=1)) <= recorded_to:
+            if store.is_materialized_day(date, TIMEZONE):
+                if live_from < get_day_start(date):
+                    live_ranges.append((live_from, get_day_start(date)))
+                stored_dates.append(date)
+                live_from = get_day_start(date + datetime.timedelta(days=1))
+            date += datetime.timedelta(days=1)
+    if live_from < recorded_to:
+        live_ranges.append((live_from, recorded_to))
+    partials = []
+    if stored_dates:
+        connection = get_connection()
+        try:
+            stored_partials = {date: get_stored_partials(connection, date, rounding_precision) for date in stored_dates}
+            missing_dates = [date for date, day_partials in stored_partials.items() if day_partials is None]
+            if len(missing_dates) > store.MAX_REQUEST_BUILD_DAYS:
+                # the full range is queried live, the missing days should be prebuilt using the build command
+                return get_live_partials(recorded_from, recorded_to, rounding_precision, bounds)
+            for date in missing_dates:
+                stored_partials[date] = build_day(connection, date, rounding_precision)
+            for day_partials in stored_partials.values():
+                partials += _filter_bounds(day_partials, rounding_precision, bounds)
+        finally:
+            connection.close()
+    for live_recorded_from, live_recorded_to in live_ranges:
+        partials += get_live_partials(live_recorded_from, live_recorded_to, rounding_precision, bounds)
+    return partials
+
+
+def get_cells(partials):
+    # returns the aggregated cells, with the same fields as the original siri_velocity_aggregation query
+    cells = {}
+    for rounded_lon, rounded_lat, sample_count, sum_rolling_avg, sumsq_rolling_avg in partials:
+        cell = cells.setdefault((rounded_lon, rounded_lat), [0, 0.0, 0.0])
+        cell[0] += sample_count
+        cell[1] += sum_rolling_avg
+        cell[2] += sumsq_rolling_avg
+    res = []
+    for (rounded_lon, rounded_lat), (sample_count, sum_rolling_avg, sumsq_rolling_avg) in sorted(cells.items()):
+        average = sum_rolling_avg / sample_count
+        if sample_count > 1:
+            # sample standard deviation, same as postgresql STDDEV
+            stddev = math.sqrt(max(sumsq_rolling_avg - sum_rolling_avg * average, 0) / (sample_count - 1))
+        else:
+            stddev = None
+        res.append({
+            'rounded_lon': rounded_lon,
+            'rounded_lat': rounded_lat,
+            'total_sample_count': sample_count,
+            'average_rolling_avg': average,
+            'stddev_rolling_avg': stddev,
+        })
+    return res
+
+
+def build(date_from, num_days=1, rounding_precisions='2'):
+    # materializes consecutive local days starting from date_from, skipping days which were already materialized
+    date_from = datetime.date.fromisoformat(date_from)
+    connection = get_connection()
+    try:
+        for day in range(int(num_days)):
+            date = date_from + datetime.timedelta(days=day)
+            if not store.is_closed_day(date, TIMEZONE):
+                print(f'{date}: not closed yet')
+                continue
+            for rounding_precision in [int(p) for p in rounding_precisions.split(',')]:
+                if get_stored_partials(connection, date, rounding_precision) is None:
+                    partials = build_day(connection, date, rounding_precision)
+                    print(f'{date} (rounding_precision={rounding_precision}): {len(partials)} cells')
+    finally:
+        connection.close()
@@ -1,21 +1,51 @@
 import os
 import json
+import base64
 import typing
+import datetime
 import inspect
+import binascii
 import itertools
 
 import fastapi
 import pydantic
 import sqlalchemy
 import sqlalchemy.orm
+import starlette.background
+from starlette.concurrency import run_in_threadpool
 
-from open_bus_stride_db.db import _sessionmaker, get_session
+from ..common import request_context, async_db, serialization, response_formats, statement_timeout, metrics, db_pool, admin
 
 
 DEFAULT_LIMIT = 100
 MAX_LIMIT = 500000
+# maximum limit / list filter items per request when the query cost guard is disabled
+MAX_PAGE_LIMIT = 15000
+MAX_LIST_FILTER_ITEMS = 1000
+# list queries are admitted based on their estimated cost (EXPLAIN total cost) instead of fixed limits and date ranges
+# cheap queries may use larger limits and list filters, queries above the budget are rejected before they run
+QUERY_COST_GUARD = os.environ.get('QUERY_COST_GUARD', 'yes').lower() in ('1', 'true', 'yes')
+QUERY_COST_BUDGET = float(os.environ.get('QUERY_COST_BUDGET', '5000000'))
+QUERY_COST_GUARD_MAX_LIMIT = int(os.environ.get('QUERY_COST_GUARD_MAX_LIMIT', '100000'))
+QUERY_COST_GUARD_MAX_LIST_FILTER_ITEMS = int(os.environ.get('QUERY_COST_GUARD_MAX_LIST_FILTER_ITEMS', '10000'))
+# filter types which can't use an index to limit the rows scanned, list queries with these filters are always checked
+UNBOUNDED_FILTER_TYPES = ('contains', 'prefix')
 QUERY_PAGE_SIZE = 1000
 DEBUG = bool(os.environ.get('DEBUG'))
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+COUNT_MODES = ['exact', 'estimate', 'bounded']
+BOUNDED_COUNT_MAX = 100000
+COUNT_MODE_HEADER = 'X-Count-Mode'
+COUNT_LOWER_BOUND_HEADER = 'X-Count-Lower-Bound'
+# when the debug_plan=true query param is set, list and get queries run also with EXPLAIN ANALYZE,
+# and the plan cost and number of rows scanned are returned in response headers
+# the query runs twice, so it's disabled by default, and it requires the admin token, see common.admin
+DEBUG_PLAN_ENABLED = os.environ.get('DEBUG_PLAN_ENABLED', 'no').lower() in ('1', 'true', 'yes')
+DEBUG_PLAN_PARAM = 'debug_plan'
+PLAN_COST_HEADER = 'X-Plan-Cost'
+ROWS_SCANNED_HEADER = 'X-Rows-Scanned'
+# response headers which are exposed to browser clients in CORS requests
+EXPOSE_HEADERS = [NEXT_CURSOR_HEADER, COUNT_MODE_HEADER, COUNT_LOWER_BOUND_HEADER, PLAN_COST_HEADER, ROWS_SCANNED_HEADER, 'Server-Timing']
 
 
 FILTER_DOCS = {
@@ -33,6 +63,9 @@ FILTER_DOCS = {
     "hour_to": 'Filter by {what_singular}. Only return items which have a date before or equals to given value. Format: 0(12AM)-23',
     "greater_or_equal": 'Filter by {what_singular}. Only return items which have a numeric value greater than or equal to given value',
     "lower_or_equal": 'Filter by {what_singular}. Only return items which have a numeric value lower than or equal to given value',
+    "bbox": 'Filter by {what_singular} bounding box. Only return items which are located inside the given box. '
+            'Format: "lon_min,lat_min,lon_max,lat_max", e.g. "34.75,32.03,34.82,32.1". '
+            'More efficient than the equivalent lon/lat greater_or_equal / lower_or_equal filters.',
 }
 
 
@@ -51,60 +84,309 @@ def post_process_response_obj(obj, convert_to_dict):
         return convert_to_dict(obj)
 
 
-def streaming_response_iterator(session, first_items, q_iterator, convert_to_dict):
+def is_streaming_limit(limit):
+    return limit is not None and int(limit) == -1
+
+
+def iterate_chunks(iterator, chunk_size):
+    iterator = iter(iterator)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def encode_streaming_chunk(objs, convert_to_dict, is_first_chunk):
+    if serialization.FAST_SERIALIZATION:
+        items = [post_process_response_obj(obj, convert_to_dict) for obj in objs]
+        if is_first_chunk and items:
+            debug_print(f'yielded first item: {items[0]}')
+        # strip the list brackets, items are already separated by commas
+        chunk = serialization.dumps(items)[1:-1]
+        return chunk if is_first_chunk or not chunk else b"," + chunk
+    chunk = []
+    for i, obj in enumerate(objs):
+        item = post_process_response_obj(obj, convert_to_dict)
+        item = fastapi.encoders.jsonable_encoder(item)
+        if i == 0 and is_first_chunk:
+            debug_print(f'yielded first item: {item}')
+        else:
+            chunk.append(b",")
+        chunk.append(json.dumps(item).encode())
+    return b"".join(chunk)
+
+
+def streaming_response_iterator(session, q_iterator, convert_to_dict, response_format='json'):
+    # items are encoded and yielded in chunks of QUERY_PAGE_SIZE items, so memory usage depends
+    # only on the chunk size and not on the total number of results
+    q_iterator = metrics.timed_iterator(q_iterator, 'db')
     try:
-        yield b"["
-        for i, obj in enumerate(itertools.chain(first_items, q_iterator)):
-            item = post_process_response_obj(obj, convert_to_dict)
-            item = fastapi.encoders.jsonable_encoder(item)
-            if i > 0:
-                yield b","
-            yield json.dumps(item).encode()
-            if i == 0:
-                debug_print(f'yielded first item: {item}')
-            if i + 1 >= MAX_LIMIT:
-                raise Exception("Too many results, please limit the query")
-        yield b"]"
+        if response_format == 'json':
+            yield b"["
+            for i, objs in enumerate(iterate_chunks(q_iterator, QUERY_PAGE_SIZE)):
+                metrics.add('rows', len(objs))
+                with metrics.timer('serialization'):
+                    chunk = encode_streaming_chunk(objs, convert_to_dict, i == 0)
+                yield chunk
+            yield b"]"
+        else:
+            encoder = response_formats.get_encoder(response_format)
+            for objs in iterate_chunks(q_iterator, response_formats.get_chunk_size(response_format, QUERY_PAGE_SIZE)):
+                metrics.add('rows', len(objs))
+                with metrics.timer('serialization'):
+                    chunk = encoder.encode([post_process_response_obj(obj, convert_to_dict) for obj in objs])
+                yield chunk
+            yield encoder.finish()
     finally:
         session.close()
 
 
-def get_list(*args, convert_to_dict=None, **kwargs):
+async def async_streaming_response_iterator(session, result, convert_to_dict, response_format='json'):
+    # async equivalent of streaming_response_iterator, result is an sqlalchemy AsyncResult
+    try:
+        if response_format == 'json':
+            yield b"["
+            is_first_chunk = True
+            async for objs in metrics.async_timed_iterator(result.partitions(QUERY_PAGE_SIZE), 'db'):
+                metrics.add('rows', len(objs))
+                with metrics.timer('serialization'):
+                    chunk = encode_streaming_chunk(objs, convert_to_dict, is_first_chunk)
+                yield chunk
+                is_first_chunk = False
+            yield b"]"
+        else:
+            encoder = response_formats.get_encoder(response_format)
+            async for objs in metrics.async_timed_iterator(result.partitions(response_formats.get_chunk_size(response_format, QUERY_PAGE_SIZE)), 'db'):
+                metrics.add('rows', len(objs))
+                with metrics.timer('serialization'):
+                    chunk = encoder.encode([post_process_response_obj(obj, convert_to_dict) for obj in objs])
+                yield chunk
+            yield encoder.finish()
+    finally:
+        await session.close()
+
+
+def _close_streaming_response(session, iterator):
+    iterator.close()
+    session.close()
+
+
+async def _async_close_streaming_response(session, iterator):
+    await iterator.aclose()
+    await session.close()
+
+
+def get_streaming_response(session, q_iterator, convert_to_dict, response_format='json'):
+    iterator = streaming_response_iterator(session, q_iterator, convert_to_dict, response_format)
+    return fastapi.responses.StreamingResponse(
+        iterator, media_type=response_formats.MEDIA_TYPES[response_format],
+        # background task runs also if client disconnected before streaming completed
+        # it makes sure the server-side cursor and the session are closed in that case
+        background=starlette.background.BackgroundTask(_close_streaming_response, session, iterator)
+    )
+
+
+def get_async_streaming_response(session, result, convert_to_dict, response_format='json'):
+    iterator = async_streaming_response_iterator(session, result, convert_to_dict, response_format)
+    return fastapi.responses.StreamingResponse(
+        iterator, media_type=response_formats.MEDIA_TYPES[response_format],
+        background=starlette.background.BackgroundTask(_async_close_streaming_response, session, iterator)
+    )
+
+
+def get_items_response(items, response_format=None):
+    # items is a list of dicts which were computed in memory, e.g. from a materialized store
+    response_format = response_formats.get_response_format(response_format)
+    metrics.add('rows', len(items))
+    if response_format == 'json':
+        if serialization.FAST_SERIALIZATION:
+            return serialization.get_json_response(items)
+        metrics.mark_data_returned()
+        return items
+    encoder = response_formats.get_encoder(response_format)
+    with metrics.timer('serialization'):
+        chunks = [encoder.encode(objs) for objs in iterate_chunks(items, response_formats.get_chunk_size(response_format, QUERY_PAGE_SIZE))]
+        chunks.append(encoder.finish())
+    return fastapi.Response(content=b''.join(chunks), media_type=response_formats.MEDIA_TYPES[response_format])
+
+
+def get_query_plan(session, q, sql_params=None, explain_options='FORMAT JSON'):
+    # q is either an orm query or an sql string, returns the top level plan node
+    if isinstance(q, str):
+        result = session.execute(sqlalchemy.text(f'EXPLAIN ({explain_options}) {q}'), sql_params)
+    else:
+        compiled = q.statement.compile(dialect=session.get_bind().dialect, compile_kwargs={'render_postcompile': True})
+        result = session.connection().exec_driver_sql(f'EXPLAIN ({explain_options}) {compiled}', compiled.params)
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def validate_limit(limit):
+    max_limit = QUERY_COST_GUARD_MAX_LIMIT if QUERY_COST_GUARD else MAX_PAGE_LIMIT
+    if not limit or not 0 < limit <= max_limit:
+        raise fastapi.HTTPException(status_code=400, detail=f"due to abuse, maximum limit per request is {max_limit} items, contact us if you need more")
+
+
+def is_debug_plan_request():
+    if not DEBUG_PLAN_ENABLED or request_context.get_query_param(DEBUG_PLAN_PARAM, '').lower() not in ('1', 'true', 'yes'):
+        return False
+    return admin.is_admin_token_valid(admin.get_request_admin_token(request_context.get_request_header))
+
+
+def get_rows_scanned(plan):
+    # total number of rows read by the scan nodes of an EXPLAIN ANALYZE plan, including rows which were removed by filters
+    rows_scanned = 0
+    if 'Scan' in plan['Node Type']:
+        rows_per_loop = plan.get('Actual Rows', 0) + plan.get('Rows Removed by Filter', 0) + plan.get('Rows Removed by Index Recheck', 0)
+        rows_scanned += rows_per_loop * plan.get('Actual Loops', 1)
+    for sub_plan in plan.get('Plans', []):
+        rows_scanned += get_rows_scanned(sub_plan)
+    return int(rows_scanned)
+
+
+def set_query_plan_headers(session, q, sql_params=None):
+    # runs the query using EXPLAIN ANALYZE, so it's used only for debug requests
+    plan = get_query_plan(session, q, sql_params, 'ANALYZE, FORMAT JSON')
+    request_context.set_response_header(PLAN_COST_HEADER, f"{plan['Total Cost']:.0f}")
+    request_context.set_response_header(ROWS_SCANNED_HEADER, get_rows_scanned(plan))
+
+
+def is_bounded_list_query(limit, offset, filters):
+    # list queries with up to the default limit and without offset or unbounded filters read few rows,
+    # so their cost is not estimated, to save the EXPLAIN query
+    return limit is not None and limit <= DEFAULT_LIMIT and not offset and not any(
+        filter['type'] in UNBOUNDED_FILTER_TYPES and filter.get('value') for filter in filters
+    )
+
+
+def check_query_cost(session, q, sql_params=None, skip_cost_guard=False):
+    # q is either an orm query or an sql string of the final list query, including its limit
+    if QUERY_COST_GUARD and not skip_cost_guard:
+        cost = get_query_plan(session, q, sql_params)['Total Cost']
+        debug_print(f'query estimated cost: {cost}')
+        if cost > QUERY_COST_BUDGET:
+            raise fastapi.HTTPException(status_code=400, detail=f'Query is too expensive (estimated query cost {cost:.0f} is above the budget of {QUERY_COST_BUDGET:.0f}), '
+                                                                f'please narrow down the filters or lower the limit')
+    if is_debug_plan_request():
+        set_query_plan_headers(session, q, sql_params)
+
+
+def _get_count(session, q, sql_params=None, max_count=None):
+    if isinstance(q, str):
+        if max_count is not None:
+            q = f'select 1 from ({q}) as q limit {int(max_count)}'
+        return list(session.execute(f'select count(1) from ({q}) as count', sql_params))[0][0]
+    elif max_count is None:
+        return q.count()
+    else:
+        return session.query(sqlalchemy.func.count()).select_from(q.limit(max_count).subquery()).scalar()
+
+
+def validate_count_mode(count_mode):
+    if not count_mode:
+        count_mode = 'exact'
+    if count_mode not in COUNT_MODES:
+        raise fastapi.HTTPException(status_code=400, detail=f'Invalid count_mode, valid values: {", ".join(COUNT_MODES)}')
+    return count_mode
+
+
+def get_count_response(session, q, sql_params=None, count_mode=None):
+    # q is either an orm query or an sql string
+    count_mode = validate_count_mode(count_mode)
+    headers = {COUNT_MODE_HEADER: count_mode}
+    if count_mode == 'estimate':
+        count = int(get_query_plan(session, q, sql_params)['Plan Rows'])
+    elif count_mode == 'bounded':
+        count = _get_count(session, q, sql_params, max_count=BOUNDED_COUNT_MAX + 1)
+        if count > BOUNDED_COUNT_MAX:
+            count = BOUNDED_COUNT_MAX
+            headers[COUNT_LOWER_BOUND_HEADER] = 'true'
+    else:
+        count = _get_count(session, q, sql_params)
+    return fastapi.Response(content=str(count), media_type="application/json", headers=headers)
+
+
+def get_list_query_response(session, q, get_count, convert_to_dict=None, count_mode=None, skip_response_validation=False):
+    # returns the response for a non-streaming query created by get_list_query
+    # skip_response_validation should be used only for queries which select exactly the response model fields
+    if get_count:
+        debug_print(f'Getting count for query {q} (count_mode={count_mode})')
+        with metrics.timer('db'):
+            return get_count_response(session, q, count_mode=count_mode)
+    elif skip_response_validation and convert_to_dict is None and serialization.FAST_SERIALIZATION:
+        debug_print(f'Getting results for query: {q}')
+        with metrics.timer('db'):
+            data = serialization.rows_to_dicts(q.all())
+        metrics.add('rows', len(data))
+        set_next_cursor_header(getattr(q, '__q_order_by_args', None), getattr(q, '__q_limit', None), data)
+        return serialization.get_json_response(data)
+    else:
+        debug_print(f'Getting results for query: {q}')
+        with metrics.timer('db'):
+            data = [post_process_response_obj(obj, convert_to_dict) for obj in q]
+        metrics.add('rows', len(data))
+        if convert_to_dict is None:
+            set_next_cursor_header(getattr(q, '__q_order_by_args', None), getattr(q, '__q_limit', None), data)
+        metrics.mark_data_returned()
+        return data
+
+
+def is_streaming_response(q, get_count, response_format):
+    # formats other than json are always streamed, so that they are encoded in batches straight from the db cursor
+    return not get_count and (getattr(q, '__q_stream', False) or response_format != 'json')
+
+
+def get_list(*args, convert_to_dict=None, count_mode=None, skip_response_validation=False, response_format=None, **kwargs):
     debug_print(f'start get_list {args}')
-    session = _sessionmaker()
+    response_format = response_formats.get_response_format(response_format)
+    session = db_pool.create_session()
     try:
+        metrics.checkout_connection(session)
         q = get_list_query(session, *args, **kwargs)
-        if kwargs.get('get_count'):
-            debug_print(f'Getting count for query {q}')
-            q_count = q.count()
-            session.close()
-            return fastapi.Response(content=str(q_count), media_type="application/json")
+        if is_streaming_response(q, kwargs.get('get_count'), response_format):
+            debug_print(f'Streaming results for query: {q}')
+            q = q.yield_per(QUERY_PAGE_SIZE)
+            return get_streaming_response(session, iter(q), convert_to_dict, response_format)
         else:
-            debug_print(f'Getting results for query: {q}')
-            data = [post_process_response_obj(obj, convert_to_dict) for obj in q]
+            res = get_list_query_response(session, q, kwargs.get('get_count'), convert_to_dict, count_mode, skip_response_validation)
             session.close()
-            return data
-            # if not hasattr(q, '__q_limit') or not q.__q_limit or q.__q_limit > QUERY_PAGE_SIZE:
-            #     debug_print(f'adding yield_per({QUERY_PAGE_SIZE}) to query')
-            #     q = q.yield_per(QUERY_PAGE_SIZE)
-            # q_iterator = (obj for obj in q)
-            # first_items = list(itertools.islice(q_iterator, QUERY_PAGE_SIZE + 1))
-            # if len(first_items) <= QUERY_PAGE_SIZE:
-            #     debug_print(f'got {len(first_items)} items - returning without streaming')
-            #     data = [post_process_response_obj(obj, convert_to_dict) for obj in first_items]
-            #     session.close()
-            #     return data
-            # else:
-            #     debug_print(f'got {len(first_items)} items - returning using streaming')
-            #     return fastapi.responses.StreamingResponse(
-            #         streaming_response_iterator(session, first_items, q_iterator, convert_to_dict),
-            #         media_type="application/json"
-            #     )
+            return res
     except:
         session.close()
         raise
 
 
+async def get_list_async(*args, convert_to_dict=None, count_mode=None, skip_response_validation=False, response_format=None, **kwargs):
+    if not async_db.ASYNC_DB or db_pool.is_replica_request():
+        return await statement_timeout.run_cancellable(run_in_threadpool(
+            get_list, *args, convert_to_dict=convert_to_dict, count_mode=count_mode,
+            skip_response_validation=skip_response_validation, response_format=response_format, **kwargs
+        ))
+    debug_print(f'start get_list_async {args}')
+    response_format = response_formats.get_response_format(response_format)
+    session = async_db.get_async_session()
+    try:
+        await metrics.async_checkout_connection(session)
+        # the sync query building and processing code runs using the async driver via run_sync
+        q = await statement_timeout.run_cancellable(session.run_sync(lambda sync_session: get_list_query(sync_session, *args, **kwargs)))
+        if is_streaming_response(q, kwargs.get('get_count'), response_format):
+            debug_print(f'Streaming results for query: {q}')
+            result = await session.stream(q.statement)
+            return get_async_streaming_response(session, result, convert_to_dict, response_format)
+        else:
+            res = await statement_timeout.run_cancellable(session.run_sync(lambda sync_session: get_list_query_response(
+                sync_session, q, kwargs.get('get_count'), convert_to_dict, count_mode, skip_response_validation
+            )))
+            await session.close()
+            return res
+    except:
+        await session.close()
+        raise
+
+
 def get_base_session_query(session, db_model, pydantic_model=...):
     # we have to set select fields for queries otherwise database migrations which add fields
     # cause the api to fail with "no such column" because it tries to select all fields which
@@ -157,18 +439,117 @@ def process_list_query_order_by_limit_offset(skip_order_by, order_by, get_count,
     return order_by_args, res_limit, res_offset
 
 
+def _encode_cursor_value(value):
+    # date/time values are tagged so that they are decoded back to the same type
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.isoformat()}
+    elif isinstance(value, datetime.date):
+        return {'date': value.isoformat()}
+    else:
+        return fastapi.encoders.jsonable_encoder(value)
+
+
+def _decode_cursor_value(value):
+    if isinstance(value, dict) and 'datetime' in value:
+        return datetime.datetime.fromisoformat(value['datetime'])
+    elif isinstance(value, dict) and 'date' in value:
+        return datetime.date.fromisoformat(value['date'])
+    else:
+        return value
+
+
+def encode_cursor(order_by_args, values):
+    return base64.urlsafe_b64encode(json.dumps({
+        'order_by': order_by_args,
+        'values': [_encode_cursor_value(value) for value in values],
+    }).encode()).decode()
+
+
+def decode_cursor(cursor, order_by_args):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        cursor_order_by_args = [tuple(arg) for arg in data['order_by']]
+        values = [_decode_cursor_value(value) for value in data['values']]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise fastapi.HTTPException(status_code=400, detail='Invalid cursor')
+    if order_by_args is None or cursor_order_by_args != list(order_by_args) or len(values) != len(order_by_args):
+        raise fastapi.HTTPException(status_code=400, detail='Cursor does not match the order_by of the query, make sure to use the same parameters as in the previous request')
+    return values
+
+
+def get_next_cursor(order_by_args, limit, items):
+    # next cursor is returned only if the page is full, otherwise there are no more results
+    # null values are encoded as well, see get_keyset_condition for how they are ordered
+    if not order_by_args or not limit or len(items) < limit:
+        return None
+    last_item = items[-1]
+    return encode_cursor(order_by_args, [last_item.get(field_name) for _, field_name in order_by_args])
+
+
+def set_next_cursor_header(order_by_args, limit, items):
+    next_cursor = get_next_cursor(order_by_args, limit, items)
+    if next_cursor:
+        request_context.set_response_header(NEXT_CURSOR_HEADER, next_cursor)
+
+
+def validate_cursor_params(cursor, offset, skip_order_by):
+    if cursor:
+        if offset:
+            raise fastapi.HTTPException(status_code=400, detail='cursor and offset parameters cannot be used together')
+        if skip_order_by:
+            raise fastapi.HTTPException(status_code=400, detail='cursor pagination is not supported for this query')
+
+
+def _get_keyset_column_after_condition(direction, column, value):
+    # nulls are ordered like the postgresql default: last in ascending order and first in descending order
+    # returns None if no values are after the given value
+    if direction == 'desc':
+        return column.isnot(None) if value is None else column < value
+    elif value is None:
+        return None
+    else:
+        return sqlalchemy.or_(column > value, column.is_(None))
+
+
+def get_keyset_condition(columns, values):
+    # columns is a list of (direction, column) tuples matching the query order by
+    # returns condition which selects only items after the given values in that order
+    directions = set(direction for direction, _ in columns)
+    if len(directions) == 1 and all(getattr(column, 'nullable', True) is False for _, column in columns) and None not in values:
+        # row value comparison can use a multi-column index, but it doesn't handle nulls
+        left = sqlalchemy.tuple_(*[column for _, column in columns])
+        right = sqlalchemy.tuple_(*values)
+        return left < right if directions == {'desc'} else left > right
+    else:
+        conditions = []
+        for i, (direction, column) in enumerate(columns):
+            after_condition = _get_keyset_column_after_condition(direction, column, values[i])
+            if after_condition is not None:
+                conditions.append(sqlalchemy.and_(
+                    *[prev_column.is_(None) if prev_value is None else prev_column == prev_value
+                      for (_, prev_column), prev_value in zip(columns[:i], values[:i])],
+                    after_condition
+                ))
+        return sqlalchemy.or_(sqlalchemy.false(), *conditions)
+
+
 def get_list_query(session, db_model, limit, offset, filters=None, default_limit=DEFAULT_LIMIT,
                    order_by=None, skip_order_by=False, get_count=False,
                    post_session_query_hook=None, pydantic_model=...,
-                   get_base_session_query_callback=None):
-    debug_print(f'get_list_query: limit={limit}, offset={offset}, order_by={order_by}')
+                   get_base_session_query_callback=None, cursor=None):
+    debug_print(f'get_list_query: limit={limit}, offset={offset}, order_by={order_by}, cursor={cursor}')
+    if get_count:
+        cursor = None
+    validate_cursor_params(cursor, offset, skip_order_by)
     if get_count:
         limit, offset, default_limit, order_by = None, None, None, None
     elif not limit and default_limit:
         limit = default_limit
     if limit:
         limit = int(limit)
-    assert get_count or (limit and 0 < limit <= 15000), "due to abuse, maximum limit per request is 15000 items, contact us if you need more"
+    stream = not get_count and is_streaming_limit(limit)
+    if not get_count and not stream:
+        validate_limit(limit)
     if filters is None:
         filters = []
     if get_base_session_query_callback is None:
@@ -180,6 +561,11 @@ def get_list_query(session, db_model, limit, offset, filters=None, default_limit
     for filter in filters:
         session_query = globals()['get_list_query_filter_{}'.format(filter['type'])](session_query, filters, filter)
     q_order_by_args, q_limit, q_offset = process_list_query_order_by_limit_offset(skip_order_by, order_by, get_count, limit, offset)
+    if cursor:
+        session_query = session_query.filter(get_keyset_condition(
+            [(direction, getattr(db_model, field_name)) for direction, field_name in q_order_by_args],
+            decode_cursor(cursor, q_order_by_args)
+        ))
     if q_order_by_args is not None:
         order_by_args = []
         for direction, field_name in q_order_by_args:
@@ -187,9 +573,15 @@ def get_list_query(session, db_model, limit, offset, filters=None, default_limit
         session_query = session_query.order_by(*order_by_args)
     if q_limit is not None:
         session_query = session_query.limit(q_limit)
+    elif stream:
+        session_query = session_query.limit(MAX_LIMIT)
     if q_offset is not None:
         session_query = session_query.offset(q_offset)
+    if not get_count:
+        check_query_cost(session, session_query, skip_cost_guard=is_bounded_list_query(q_limit, q_offset, filters))
     session_query.__q_limit = q_limit
+    session_query.__q_stream = stream
+    session_query.__q_order_by_args = q_order_by_args
     return session_query
 
 
@@ -205,7 +597,9 @@ def get_list_query_filter_in(session_query, filters, filter):
         if isinstance(value, str):
             value = value.split(',')
         if len(value) > 0:
-            assert len(value) <= 1000, 'too many items in list, maximum allowed is 1000 items'
+            max_items = QUERY_COST_GUARD_MAX_LIST_FILTER_ITEMS if QUERY_COST_GUARD else MAX_LIST_FILTER_ITEMS
+            if len(value) > max_items:
+                raise fastapi.HTTPException(status_code=400, detail=f'too many items in list, maximum allowed is {max_items} items')
             session_query = session_query.filter(filter['field'].in_(value))
     return session_query
 
@@ -253,11 +647,59 @@ def get_list_query_filter_lower_or_equal(session_query, filters, filter):
     return session_query
 
 
+def parse_bbox(value):
+    try:
+        lon_min, lat_min, lon_max, lat_max = [float(v) for v in value.split(',')]
+    except ValueError:
+        raise fastapi.HTTPException(status_code=400, detail='Invalid bbox, expected format: lon_min,lat_min,lon_max,lat_max')
+    if lon_min > lon_max or lat_min > lat_max:
+        raise fastapi.HTTPException(status_code=400, detail='Invalid bbox, min values must be lower than max values')
+    return lon_min, lat_min, lon_max, lat_max
+
+
+def get_bbox_condition(lon_field, lat_field, bbox):
+    # the point in box containment can use a gist index on the point(lon, lat) expression (added by the stride db migrations)
+    # the lon / lat range predicates are kept, so that the existing btree indexes are used where the gist index doesn't exist
+    lon_min, lat_min, lon_max, lat_max = bbox
+    func = sqlalchemy.func
+    return sqlalchemy.and_(
+        lon_field.between(lon_min, lon_max),
+        lat_field.between(lat_min, lat_max),
+        func.point(lon_field, lat_field).op('<@')(func.box(func.point(lon_min, lat_min), func.point(lon_max, lat_max))),
+    )
+
+
+def get_list_query_filter_bbox(session_query, filters, filter):
+    if filter['value'] is not None:
+        lon_field, lat_field = filter['fields']
+        session_query = session_query.filter(get_bbox_condition(lon_field, lat_field, parse_bbox(filter['value'])))
+    return session_query
+
+
+def get_session_item(session, db_model, field, value, pydantic_model=...):
+    session_query = get_base_session_query(session, db_model, pydantic_model).filter(field == value)
+    if is_debug_plan_request():
+        set_query_plan_headers(session, session_query)
+    with metrics.timer('db'):
+        obj = session_query.one()
+    metrics.add('rows', 1)
+    metrics.mark_data_returned()
+    return post_process_response_obj(obj, None)
+
+
 def get_item(db_model, field, value, pydantic_model=...):
-    with get_session() as session:
-        session_query = get_base_session_query(session, db_model, pydantic_model)
-        obj = session_query.filter(field == value).one()
-        return post_process_response_obj(obj, None)
+    with db_pool.get_session() as session:
+        metrics.checkout_connection(session)
+        return get_session_item(session, db_model, field, value, pydantic_model)
+
+
+async def get_item_async(db_model, field, value, pydantic_model=...):
+    if not async_db.ASYNC_DB or db_pool.is_replica_request():
+        return await statement_timeout.run_cancellable(run_in_threadpool(get_item, db_model, field, value, pydantic_model))
+    async with async_db.get_async_session() as session:
+        return await statement_timeout.run_cancellable(session.run_sync(lambda sync_session: get_session_item(
+            sync_session, db_model, field, value, pydantic_model
+        )))
 
 
 class PydanticRelatedModel():
@@ -281,6 +723,8 @@ class PydanticRelatedModel():
 
     def add_session_query_entities(self, db_model, session_query):
         for name in self.pydantic_model.__fields__.keys():
+            if self.include_field_names and name not in self.include_field_names:
+                continue
             if self.exclude_field_names and name in self.exclude_field_names:
                 continue
             session_query = session_query.add_entity(getattr(db_model, name).label('{}{}'.format(self.field_name_prefix, name)))
@@ -350,6 +794,17 @@ def param_offset(as_RouteParam=False):
                                                f'decoder to get all results up to a maximum of {MAX_LIMIT} results.')
 
 
+def param_cursor(as_RouteParam=False):
+    if as_RouteParam:
+        return RouteParam('cursor', str, param_cursor())
+    else:
+        return fastapi.Query(None, description=f'Cursor for keyset pagination, more efficient than offset for deep pages. '
+                                               f'To get the next page, set to the value of the {NEXT_CURSOR_HEADER} response header '
+                                               f'of the previous request, keeping all other parameters unchanged. '
+                                               f'The header is not returned when there are no more results. '
+                                               f'Cannot be used together with offset.')
+
+
 def param_get_count(as_RouteParam=False):
     if as_RouteParam:
         return RouteParam('get_count', bool, param_get_count())
@@ -357,6 +812,27 @@ def param_get_count(as_RouteParam=False):
         return fastapi.Query(False, description='Set to "true" to only get the total number of results for given filters. limit/offset/order parameters will be ignored.')
 
 
+def param_count_mode(as_RouteParam=False):
+    if as_RouteParam:
+        return RouteParam('count_mode', str, param_count_mode())
+    else:
+        return fastapi.Query('exact', description=f'How to count the results when get_count is "true". '
+                                                  f'"exact" - count all the results, may be slow for queries which match many items. '
+                                                  f'"estimate" - return the database query planner estimate, fast but may be inaccurate. '
+                                                  f'"bounded" - count up to {BOUNDED_COUNT_MAX} results, if there are more results, '
+                                                  f'{BOUNDED_COUNT_MAX} is returned and the {COUNT_LOWER_BOUND_HEADER} response header is set to "true".')
+
+
+def param_format(as_RouteParam=False):
+    if as_RouteParam:
+        return RouteParam('format', str, param_format())
+    else:
+        return fastapi.Query(None, description=f'Response format: {", ".join(response_formats.MEDIA_TYPES)}. '
+                                               f'If not set, the format is selected based on the Accept header, defaulting to json. '
+                                               f'Formats other than json are streamed and more efficient for large results, '
+                                               f'arrow (IPC stream) and parquet can be loaded directly into dataframes.')
+
+
 def param_filter_list(what_singular, example='1,2,3'):
     return fastapi.Query(None, description=f'Filter by {what_singular}. Comma-separated list of values, e.g. "{example}".')
 
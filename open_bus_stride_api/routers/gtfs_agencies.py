@@ -4,9 +4,8 @@ from textwrap import dedent
 import pydantic
 from fastapi import APIRouter
 
-from open_bus_stride_db.db import get_session
-
 from . import common
+from ..common import sql_route, cache
 
 
 router = APIRouter()
@@ -25,36 +24,29 @@ PYDANTIC_MODEL = GtfsAgencyPydanticModel
 
 
 @common.router_list(router, TAG, PYDANTIC_MODEL, WHAT_PLURAL)
-def list_(limit: int = common.param_limit(),
+@cache.cached_route(date_to_param_names=['date_to'])
+async def list_(limit: int = common.param_limit(),
           offset: int = common.param_offset(),
+          cursor: str = common.param_cursor(),
+          format: str = common.param_format(),
           date_from: datetime.date = common.doc_param('date', filter_type='date_from'),
           date_to: datetime.date = common.doc_param('date', filter_type='date_to')):
-    with get_session() as session:
-        if not limit:
-            limit = common.DEFAULT_LIMIT
-        if not offset:
-            offset = 0
-        res = []
-        wheres = []
-        if date_from:
-            wheres.append("date >= '{}'".format(date_from.strftime('%Y-%m-%d')))
-        if date_to:
-            wheres.append("date <= '{}'".format(date_to.strftime('%Y-%m-%d')))
-        if len(wheres) > 0:
-            where = 'where ' + ' and '.join(wheres)
-        else:
-            where = ''
-        for row in session.execute(dedent("""
-            select date, operator_ref, agency_name
-            from gtfs_route
-            {where}
-            group by date, operator_ref, agency_name
-            order by date, agency_name
-            limit :limit offset :offset
-        """.format(where=where)), dict(limit=limit, offset=offset)):
-            res.append(GtfsAgencyPydanticModel(
-                date=row[0],
-                operator_ref=row[1],
-                agency_name=row[2]
-            ))
-        return res
+    sql_params = {}
+    wheres = []
+    if date_from:
+        wheres.append("date >= :date_from")
+        sql_params['date_from'] = date_from
+    if date_to:
+        wheres.append("date <= :date_to")
+        sql_params['date_to'] = date_to
+    if len(wheres) > 0:
+        where = 'where ' + ' and '.join(wheres)
+    else:
+        where = ''
+    sql = dedent("""
+        select date, operator_ref, agency_name
+        from gtfs_route
+        {where}
+        group by date, operator_ref, agency_name
+    """.format(where=where))
+    return await sql_route.list_async(sql, sql_params, common.DEFAULT_LIMIT, limit, offset, False, 'date asc, agency_name asc, operator_ref asc', False, cursor=cursor, response_format=format)
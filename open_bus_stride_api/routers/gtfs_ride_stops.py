@@ -7,6 +7,7 @@ from fastapi import APIRouter, HTTPException
 from open_bus_stride_db import model
 
 from . import common, gtfs_rides, gtfs_stops, gtfs_routes
+from ..common import http_cache
 
 
 router = APIRouter()
@@ -106,7 +107,10 @@ gtfs_ride_stop_filter_params_with_related = [
 gtfs_ride_stop_list_params = [
     common.param_limit(as_RouteParam=True),
     common.param_offset(as_RouteParam=True),
+    common.param_cursor(as_RouteParam=True),
     common.param_get_count(as_RouteParam=True),
+    common.param_count_mode(as_RouteParam=True),
+    common.param_format(as_RouteParam=True),
     *gtfs_ride_stop_filter_params_with_related,
     common.param_order_by(as_RouteParam=True),
 ]
@@ -125,7 +129,8 @@ gtfs_ride_stop_list_params = [
     Additional filters can be applied in addition to one of the above options to narrow down the results.
     """).strip()
 )
-def list_(**kwargs):
+@http_cache.date_cache_control(date_to_param_names=['arrival_time_to'])
+async def list_(**kwargs):
     if not kwargs.get('gtfs_ride_ids') or ',' in kwargs['gtfs_ride_ids']:
         # Validate arrival_time range is no longer than 30 days (to avoid heavy queries)
         if not kwargs.get('arrival_time_from') or not kwargs.get('arrival_time_to'):
@@ -133,7 +138,7 @@ def list_(**kwargs):
         if (kwargs['arrival_time_to'] - kwargs['arrival_time_from']).days > 30:
             raise HTTPException(status_code=400, detail="Time range is longer than 30 days")
 
-    return common.get_list(
+    return await common.get_list_async(
         SQL_MODEL, kwargs['limit'], kwargs['offset'],
         [
             route_param.get_filter(kwargs)
@@ -142,13 +147,16 @@ def list_(**kwargs):
         order_by=kwargs['order_by'],
         post_session_query_hook=_post_session_query_hook,
         get_count=kwargs['get_count'],
+        count_mode=kwargs['count_mode'],
+        response_format=kwargs['format'],
         pydantic_model=PYDANTIC_MODEL,
+        cursor=kwargs['cursor'],
     )
 
 
 @common.router_get(router, TAG, PYDANTIC_MODEL, WHAT_SINGULAR)
-def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
-    return common.get_item(
+async def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
+    return await common.get_item_async(
         SQL_MODEL, SQL_MODEL.id, id,
         pydantic_model=PYDANTIC_MODEL,
     )
@@ -5,9 +5,12 @@ import typing
 import fastapi
 import pydantic
 from fastapi import APIRouter
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
 
 from . import common
-from ..common import sql_route
+from ..common import sql_route, cache, serialization, statement_timeout, db_pool, http_cache
+from ..materialized import gtfs_rides_agg as materialized_gtfs_rides_agg
 
 
 router = APIRouter()
@@ -42,12 +45,18 @@ GROUP_BY_PYDANTIC_MODEL = GtfsRidesAggGroupByPydanticModel
 DEFAULT_LIMIT = 1000
 ALLOWED_GROUP_BY_FIELDS = ['gtfs_route_date', 'gtfs_route_hour', 'operator_ref', 'day_of_week', 'line_ref']
 AGG_VIEW_FIELDS = ['gtfs_route_date', 'gtfs_route_hour']
+# group by results are not paginated, the number of results depends on the grouping and date range
+GROUP_BY_MAX_RESULTS = 15000
 
 
 @common.router_list(router, TAG, PYDANTIC_MODEL, WHAT_PLURAL)
-def list_(limit: int = common.param_limit(default_limit=DEFAULT_LIMIT),
+@http_cache.date_cache_control(date_to_param_names=['date_to'])
+async def list_(limit: int = common.param_limit(default_limit=DEFAULT_LIMIT),
           offset: int = common.param_offset(),
+          cursor: str = common.param_cursor(),
           get_count: bool = common.param_get_count(),
+          count_mode: str = common.param_count_mode(),
+          format: str = common.param_format(),
           date_from: datetime.date = common.doc_param('date', filter_type='date_from', default=...),
           date_to: datetime.date = common.doc_param('date', filter_type='date_to', default=...),
           exclude_hours_from: int = common.doc_param('hour', filter_type='hour_from', description="Hours to exclude from search, currently used to filter out edge cases."),
@@ -81,18 +90,10 @@ def list_(limit: int = common.param_limit(default_limit=DEFAULT_LIMIT),
         sql += " and not date_part('hour', agg.gtfs_route_hour) <= :exclude_hour_to"
         sql_params['exclude_hour_to'] = exclude_hours_to
 
-    return sql_route.list_(dedent(sql), sql_params, DEFAULT_LIMIT, limit, offset, get_count, 'gtfs_route_hour asc, gtfs_route_id asc', False)
+    return await sql_route.list_async(dedent(sql), sql_params, DEFAULT_LIMIT, limit, offset, get_count, 'gtfs_route_hour asc, gtfs_route_id asc', False, cursor=cursor, count_mode=count_mode, response_format=format)
 
 
-@router.get("/group_by", tags=[TAG], response_model=typing.List[GROUP_BY_PYDANTIC_MODEL], description=f'{WHAT_SINGULAR} grouped by given fields.')
-def group_by_(date_from: datetime.date = common.doc_param('date', filter_type='date_from', default=...),
-              date_to: datetime.date = common.doc_param('date', filter_type='date_to', default=...),
-              exclude_hours_from: int = common.doc_param('hour', filter_type='hour_from', description="Hours to exclude from search, currently used to filter out edge cases."),
-              exclude_hours_to: int = common.doc_param('hour', filter_type='hour_to', description="Hours to exclude from search, currently used to filter out edge cases."),
-              group_by: str = fastapi.Query(..., description=f'Comma-separated list of fields to group by. Valid values: {", ".join(ALLOWED_GROUP_BY_FIELDS)}.')
-              ):
-    group_by = [f.strip() for f in group_by.split(',') if f.strip()]
-    assert all(f in ALLOWED_GROUP_BY_FIELDS for f in group_by), f'Invalid group_by fields: {group_by}. Valid values: {", ".join(ALLOWED_GROUP_BY_FIELDS)}.'
+def get_group_by_sql(group_by, date_from, date_to, exclude_hours_from, exclude_hours_to):
     select_fields = []
     group_by_fields = []
     for fieldname in group_by:
@@ -138,4 +139,44 @@ def group_by_(date_from: datetime.date = common.doc_param('date', filter_type='d
         sql_params['exclude_hour_to'] = exclude_hours_to
 
     sql += f" group by {', '.join(group_by_fields)}"
-    return sql_route.list_(sql, sql_params, None, None, None, None, None, True)
+    return sql, sql_params
+
+
+def get_live_groups(sql, sql_params):
+    with db_pool.get_session() as session:
+        return serialization.rows_to_dicts(session.execute(text(sql), sql_params).all())
+
+
+async def get_groups_response(group_by, date_from, date_to, exclude_hours_from, exclude_hours_to, response_format):
+    # closed days are served from the materialized hourly rollup, see materialized.gtfs_rides_agg
+    # days which are not closed yet or were not materialized yet are queried live and merged with the materialized groups
+    groups, live_date_ranges = await run_in_threadpool(materialized_gtfs_rides_agg.get_groups, group_by, date_from, date_to, exclude_hours_from, exclude_hours_to)
+    if groups is None:
+        return None
+    if live_date_ranges:
+        groups_lists = [groups]
+        for live_date_from, live_date_to in live_date_ranges:
+            sql, sql_params = get_group_by_sql(group_by, live_date_from, live_date_to, exclude_hours_from, exclude_hours_to)
+            groups_lists.append(await run_in_threadpool(get_live_groups, sql, sql_params))
+        groups = materialized_gtfs_rides_agg.merge_groups(group_by, groups_lists)
+    return common.get_items_response(groups[:GROUP_BY_MAX_RESULTS], response_format)
+
+
+@router.get("/group_by", tags=[TAG], response_model=typing.List[GROUP_BY_PYDANTIC_MODEL], description=f'{WHAT_SINGULAR} grouped by given fields.')
+@cache.cached_route(date_to_param_names=['date_to'], max_item_rows=GROUP_BY_MAX_RESULTS)
+@statement_timeout.route_statement_timeout(statement_timeout.ANALYTICAL_STATEMENT_TIMEOUT_SECONDS)
+@db_pool.analytical_route
+async def group_by_(date_from: datetime.date = common.doc_param('date', filter_type='date_from', default=...),
+              date_to: datetime.date = common.doc_param('date', filter_type='date_to', default=...),
+              exclude_hours_from: int = common.doc_param('hour', filter_type='hour_from', description="Hours to exclude from search, currently used to filter out edge cases."),
+              exclude_hours_to: int = common.doc_param('hour', filter_type='hour_to', description="Hours to exclude from search, currently used to filter out edge cases."),
+              group_by: str = fastapi.Query(..., description=f'Comma-separated list of fields to group by. Valid values: {", ".join(ALLOWED_GROUP_BY_FIELDS)}.'),
+              format: str = common.param_format(),
+              ):
+    group_by = [f.strip() for f in group_by.split(',') if f.strip()]
+    assert all(f in ALLOWED_GROUP_BY_FIELDS for f in group_by), f'Invalid group_by fields: {group_by}. Valid values: {", ".join(ALLOWED_GROUP_BY_FIELDS)}.'
+    response = await get_groups_response(group_by, date_from, date_to, exclude_hours_from, exclude_hours_to, format)
+    if response is not None:
+        return response
+    sql, sql_params = get_group_by_sql(group_by, date_from, date_to, exclude_hours_from, exclude_hours_to)
+    return await sql_route.list_async(sql, sql_params, GROUP_BY_MAX_RESULTS, None, None, None, None, True, response_format=format)
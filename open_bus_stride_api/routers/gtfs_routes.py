@@ -6,6 +6,7 @@ from fastapi import APIRouter
 from open_bus_stride_db.model.gtfs_route import GtfsRoute
 
 from . import common
+from ..common import cache
 
 
 router = APIRouter()
@@ -83,15 +84,19 @@ gtfs_route_filter_params = [
 gtfs_route_list_params = [
     common.param_limit(as_RouteParam=True),
     common.param_offset(as_RouteParam=True),
+    common.param_cursor(as_RouteParam=True),
     common.param_get_count(as_RouteParam=True),
+    common.param_count_mode(as_RouteParam=True),
+    common.param_format(as_RouteParam=True),
     *gtfs_route_filter_params,
     common.param_order_by(as_RouteParam=True),
 ]
 
 
 @common.add_api_router_list(router, TAG, PYDANTIC_MODEL, WHAT_PLURAL, gtfs_route_list_params)
-def list_(**kwargs):
-    return common.get_list(
+@cache.cached_route(date_to_param_names=['date_to'])
+async def list_(**kwargs):
+    return await common.get_list_async(
         GtfsRoute, kwargs['limit'], kwargs['offset'],
         [
             route_param.get_filter(kwargs)
@@ -99,13 +104,16 @@ def list_(**kwargs):
         ],
         order_by=kwargs['order_by'],
         get_count=kwargs['get_count'],
+        count_mode=kwargs['count_mode'],
+        response_format=kwargs['format'],
         pydantic_model=PYDANTIC_MODEL,
+        cursor=kwargs['cursor'],
     )
 
 
 @common.router_get(router, TAG, PYDANTIC_MODEL, WHAT_SINGULAR)
-def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
-    return common.get_item(
+async def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
+    return await common.get_item_async(
         SQL_MODEL, SQL_MODEL.id, id,
         pydantic_model=PYDANTIC_MODEL,
     )
@@ -1,11 +1,13 @@
+import typing
 import datetime
 
 import pydantic
-from fastapi import APIRouter
+from fastapi import APIRouter, Query
 
 from open_bus_stride_db.model.gtfs_stop import GtfsStop
 
 from . import common
+from ..common import cache, serialization, stop_index
 
 
 router = APIRouter()
@@ -21,11 +23,17 @@ class GtfsStopPydanticModel(pydantic.BaseModel):
     city: str = None
 
 
+class GtfsStopWithDistancePydanticModel(GtfsStopPydanticModel):
+    distance_meters: float
+
+
 WHAT_SINGULAR = 'gtfs stop'
 WHAT_PLURAL = f'{WHAT_SINGULAR}s'
 TAG = 'gtfs'
 PYDANTIC_MODEL = GtfsStopPydanticModel
 SQL_MODEL = GtfsStop
+SPATIAL_MAX_LIMIT = 1000
+SPATIAL_MAX_DISTANCE_METERS = 50000
 
 
 # This is only used by other routers to include the stop filters
@@ -47,33 +55,75 @@ gtfs_stop_filter_params = [
         'city', str, common.DocParam('city', filter_type='equals'),
         {'type': 'equals', 'field': GtfsStop.city},
     ),
+    common.RouteParam(
+        'bbox', str, common.DocParam('lon/lat', filter_type='bbox'),
+        {'type': 'bbox', 'fields': (GtfsStop.lon, GtfsStop.lat)},
+    ),
 ]
 
 
 @common.router_list(router, TAG, PYDANTIC_MODEL, WHAT_PLURAL)
-def list_(limit: int = common.param_limit(),
+@cache.cached_route(date_to_param_names=['date_to'])
+async def list_(limit: int = common.param_limit(),
           offset: int = common.param_offset(),
+          cursor: str = common.param_cursor(),
           get_count: bool = common.param_get_count(),
+          count_mode: str = common.param_count_mode(),
+          format: str = common.param_format(),
           date_from: datetime.date = common.doc_param('date', filter_type='date_from'),
           date_to: datetime.date = common.doc_param('date', filter_type='date_to'),
           code: int = common.doc_param('code', filter_type='equals'),
-          city: str = common.doc_param('city', filter_type='equals')):
-    return common.get_list(
+          city: str = common.doc_param('city', filter_type='equals'),
+          bbox: str = common.doc_param('lon/lat', filter_type='bbox')):
+    return await common.get_list_async(
         GtfsStop, limit, offset,
         [
             {'type': 'datetime_from', 'field': GtfsStop.date, 'value': date_from},
             {'type': 'datetime_to', 'field': GtfsStop.date, 'value': date_to},
             {'type': 'equals', 'field': GtfsStop.code, 'value': code},
             {'type': 'equals', 'field': GtfsStop.city, 'value': city},
+            {'type': 'bbox', 'fields': (GtfsStop.lon, GtfsStop.lat), 'value': bbox},
         ],
         get_count=get_count,
+        count_mode=count_mode,
+        response_format=format,
         pydantic_model=PYDANTIC_MODEL,
+        cursor=cursor,
     )
 
 
 @common.router_get(router, TAG, PYDANTIC_MODEL, WHAT_SINGULAR)
-def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
-    return common.get_item(
+async def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
+    return await common.get_item_async(
         SQL_MODEL, SQL_MODEL.id, id,
         pydantic_model=PYDANTIC_MODEL,
     )
+
+
+def param_spatial_date():
+    return Query(..., description='Date of the gtfs stops. Format: "YYYY-MM-DD", e.g. "2021-11-03". '
+                                  'The stops of recently used dates are kept in memory, '
+                                  'so the first request for a date is slower than the following ones.')
+
+
+@router.get('/nearest', tags=[TAG], response_model=typing.List[GtfsStopWithDistancePydanticModel],
+            description=f'Return the {WHAT_PLURAL} nearest to the given point, ordered by distance.')
+async def nearest(date: datetime.date = param_spatial_date(),
+                  lat: float = Query(..., ge=-90, le=90, description='Latitude of the point', example=31.961),
+                  lon: float = Query(..., ge=-180, le=180, description='Longitude of the point', example=34.808),
+                  limit: int = Query(10, ge=1, le=SPATIAL_MAX_LIMIT, description='Number of stops to return'),
+                  max_distance_meters: float = Query(SPATIAL_MAX_DISTANCE_METERS, gt=0, le=SPATIAL_MAX_DISTANCE_METERS,
+                                                     description='Only return stops up to this distance from the point')):
+    index = await stop_index.get_stop_index_async(date)
+    return serialization.get_json_response(index.nearest(lat, lon, limit, max_distance_meters))
+
+
+@router.get('/within_radius', tags=[TAG], response_model=typing.List[GtfsStopWithDistancePydanticModel],
+            description=f'Return the {WHAT_PLURAL} within the given radius from the point, ordered by distance.')
+async def within_radius(date: datetime.date = param_spatial_date(),
+                        lat: float = Query(..., ge=-90, le=90, description='Latitude of the point', example=31.961),
+                        lon: float = Query(..., ge=-180, le=180, description='Longitude of the point', example=34.808),
+                        radius_meters: float = Query(..., gt=0, le=SPATIAL_MAX_DISTANCE_METERS, description='Radius in meters'),
+                        limit: int = Query(100, ge=1, le=SPATIAL_MAX_LIMIT, description='Maximum number of stops to return')):
+    index = await stop_index.get_stop_index_async(date)
+    return serialization.get_json_response(index.within_radius(lat, lon, radius_meters, limit))
@@ -1,11 +1,17 @@
+import heapq
+import typing
 import datetime
-from textwrap import dedent
+import itertools
 
+import fastapi
 import pydantic
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
 
 from . import common
-from ..common import sql_route
+from ..common import sql_route, statement_timeout, db_pool, http_cache, metrics, response_formats
+from ..materialized import rides_execution as materialized_rides_execution
 
 router = APIRouter()
 
@@ -14,58 +20,160 @@ class RideExecutionPydanticModel(pydantic.BaseModel):
     planned_start_time: datetime.datetime = None
     actual_start_time: datetime.datetime = None
     gtfs_ride_id: int = None
+    siri_ride_id: int = None
+
+
+class RideExecutionBatchPydanticModel(RideExecutionPydanticModel):
+    operator_ref: int = None
+    line_ref: int = None
+
 
 DEFAULT_LIMIT = 100
+# the ride ids make the order unique, so that cursor pagination doesn't skip rides with the same start times
+# each row has a different pair of ride ids, one of them may be null
+ORDER_BY = 'planned_start_time asc, actual_start_time asc, gtfs_ride_id asc, siri_ride_id asc'
+BATCH_MAX_LINES = 500
 WHAT_PLURAL = """A comparison between the planned and actual rides of a specific route between the given dates.
 Currently, the "actual_rides_count", will be either None (no actual ride) or equal to the "planned_rides_count"""
 TAG = 'user cases'
 PYDANTIC_MODEL = RideExecutionPydanticModel
 
+
+def get_live_rides_lists(fieldnames, operator_ref, line_refs, live_date_ranges, order_by_args, cursor_values, limit):
+    # returns a list of the rides of each live date range, ordered, filtered by the cursor and limited by the live queries
+    rides_lists = []
+    with db_pool.get_session() as session:
+        for live_date_from, live_date_to in live_date_ranges:
+            sql, sql_params = materialized_rides_execution.get_live_rides_sql(operator_ref, line_refs, live_date_from, live_date_to)
+            sql = f'select {", ".join(fieldnames)} from ({sql}) rides'
+            if cursor_values is not None:
+                sql += ' where ' + sql_route.get_keyset_sql_condition(order_by_args, cursor_values, sql_params)
+            sql += ' order by ' + ', '.join(f'{fieldname} {direction}' for direction, fieldname in order_by_args)
+            sql += f' limit {limit}'
+            with metrics.timer('db'):
+                rides_lists.append([dict(row._mapping) for row in session.execute(text(sql), sql_params)])
+    return rides_lists
+
+
+def get_rides_count(operator_ref, line_refs, date_from, materialized_date_to, live_date_ranges):
+    connection = materialized_rides_execution.get_connection()
+    try:
+        count = materialized_rides_execution.count_stored_rides(connection, operator_ref, line_refs, date_from, materialized_date_to, live_date_ranges)
+    finally:
+        connection.close()
+    with db_pool.get_session() as session:
+        for live_date_from, live_date_to in live_date_ranges:
+            sql, sql_params = materialized_rides_execution.get_live_rides_sql(operator_ref, line_refs, live_date_from, live_date_to)
+            with metrics.timer('db'):
+                count += session.execute(text(f'select count(*) from ({sql}) rides'), sql_params).scalar()
+    return count
+
+
+def get_rides_order_key(order_by_args):
+    # nulls are ordered last, like the postgresql default of ascending order
+    assert all(direction == 'asc' for direction, _ in order_by_args)
+    return lambda ride: tuple((ride[fieldname] is None, ride[fieldname]) for _, fieldname in order_by_args)
+
+
+def get_rides_list_response(fieldnames, order_by_args, operator_ref, line_refs, date_from, materialized_date_to, live_date_ranges, limit, offset, cursor_values, stream, response_format):
+    # each source returns at most offset + limit rides after the cursor, so the merged page is complete
+    rides_limit = offset + (common.MAX_LIMIT if stream else limit)
+    live_rides_lists = get_live_rides_lists(fieldnames, operator_ref, line_refs, live_date_ranges, order_by_args, cursor_values, rides_limit)
+    connection = materialized_rides_execution.get_connection(check_same_thread=False)
+    try:
+        stored_rides = materialized_rides_execution.iter_stored_rides(connection, fieldnames, operator_ref, line_refs, date_from, materialized_date_to,
+                                                                      live_date_ranges, order_by_args, cursor_values, rides_limit)
+        rides = itertools.islice(heapq.merge(stored_rides, *live_rides_lists, key=get_rides_order_key(order_by_args)), offset, rides_limit)
+        if stream:
+            # the stored rides are read while streaming, the connection is closed when the response completes
+            return common.get_streaming_response(connection, rides, dict, response_format)
+        rides = list(rides)
+    except:
+        connection.close()
+        raise
+    connection.close()
+    common.set_next_cursor_header(order_by_args, limit, rides)
+    return common.get_items_response(rides, response_format)
+
+
+async def get_rides_response(fieldnames, order_by, operator_ref, line_refs, date_from, date_to, limit, offset, get_count, cursor, count_mode, response_format):
+    # closed days are served from precomputed per line and day rides, see materialized.rides_execution
+    # the stored rides and the rides of each live date range are ordered and paginated by their queries and merged in order
+    # returns None if the full range should be queried live
+    built = await run_in_threadpool(materialized_rides_execution.build_rides, operator_ref, line_refs, date_from, date_to)
+    if built is None:
+        return None
+    materialized_date_to, live_date_ranges = built
+    if get_count:
+        # the stored and live rides are counted exactly for all count modes
+        count_mode = common.validate_count_mode(count_mode)
+        count = await run_in_threadpool(get_rides_count, operator_ref, line_refs, date_from, materialized_date_to, live_date_ranges)
+        return fastapi.Response(content=str(count), media_type="application/json", headers={common.COUNT_MODE_HEADER: count_mode})
+    limit = int(limit) if limit else DEFAULT_LIMIT
+    stream = common.is_streaming_limit(limit)
+    common.validate_cursor_params(cursor, offset, False)
+    order_by_args, limit, offset = common.process_list_query_order_by_limit_offset(False, order_by, False, limit, offset, skip_order_by_id_field=True)
+    if not stream:
+        common.validate_limit(limit)
+    cursor_values = common.decode_cursor(cursor, order_by_args) if cursor else None
+    return await run_in_threadpool(get_rides_list_response, fieldnames, order_by_args, operator_ref, line_refs, date_from, materialized_date_to, live_date_ranges,
+                                   limit, offset or 0, cursor_values, stream, response_formats.get_response_format(response_format))
+
+
 @common.router_list(router, TAG, PYDANTIC_MODEL, WHAT_PLURAL)
-def list_(limit: int = common.param_limit(default_limit=DEFAULT_LIMIT),
+@statement_timeout.route_statement_timeout(statement_timeout.ANALYTICAL_STATEMENT_TIMEOUT_SECONDS)
+@db_pool.analytical_route
+@http_cache.date_cache_control(date_to_param_names=['date_to'])
+async def list_(limit: int = common.param_limit(default_limit=DEFAULT_LIMIT),
           offset: int = common.param_offset(),
+          cursor: str = common.param_cursor(),
           get_count: bool = common.param_get_count(),
+          count_mode: str = common.param_count_mode(),
+          format: str = common.param_format(),
           date_from: datetime.date = common.doc_param('date', filter_type='date_from', default=...),
           date_to: datetime.date = common.doc_param('date', filter_type='date_to', default=...),
           operator_ref: int = common.doc_param('operator_ref', filter_type='equals', description="Line operator ref.", default=...),
           line_ref: int = common.doc_param('line_ref', filter_type='equals', description="Line ref.", default=...),):
-    sql = """
-    select
-        actual_rides.start_time::timestamptz as actual_start_time,
-        planned_rides.start_time::timestamptz as planned_start_time,
-        planned_rides.gtfs_ride_id
-    from
-        (
-            (select
-                siri_ride.scheduled_start_time as start_time
-            from
-                siri_ride
-                join siri_route sr on siri_ride.siri_route_id = sr.id
-            where
-                sr.operator_ref = :operator_ref
-                and sr.line_ref = :line_ref
-                and date_trunc('day', siri_ride.scheduled_start_time) between :date_from and :date_to
-            ) actual_rides
-        full outer join
-            (select 
-                gtfs_ride.start_time as start_time, gtfs_ride.id as gtfs_ride_id
-            from
-                gtfs_ride
-                join gtfs_route gr on gtfs_ride.gtfs_route_id = gr.id
-            where
-                gr.operator_ref = :operator_ref
-                and gr.line_ref = :line_ref
-                and date_trunc('day', gtfs_ride.start_time) between :date_from and :date_to
-            ) planned_rides
-        on
-            actual_rides.start_time = planned_rides.start_time
-    )
-    """
-    sql_params = {
-        'date_from': date_from,
-        'date_to': date_to,
-        'operator_ref': operator_ref,
-        'line_ref': line_ref,
-    }
-
-    return sql_route.list_(dedent(sql), sql_params, DEFAULT_LIMIT, limit, offset, get_count, 'planned_start_time asc, actual_start_time asc', False)
+    response = await get_rides_response(['actual_start_time', 'planned_start_time', 'gtfs_ride_id', 'siri_ride_id'], ORDER_BY,
+                                        operator_ref, [line_ref], date_from, date_to, limit, offset, get_count, cursor, count_mode, format)
+    if response is not None:
+        return response
+    sql, sql_params = materialized_rides_execution.get_live_rides_sql(operator_ref, [line_ref], date_from, date_to)
+    sql = f'select actual_start_time, planned_start_time, gtfs_ride_id, siri_ride_id from ({sql}) rides'
+    return await sql_route.list_async(sql, sql_params, DEFAULT_LIMIT, limit, offset, get_count, ORDER_BY, False, cursor=cursor, count_mode=count_mode, response_format=format)
+
+
+@router.get('/batch_list', tags=[TAG], response_model=typing.List[RideExecutionBatchPydanticModel],
+            description='A comparison between the planned and actual rides of multiple lines of an operator between the given dates, '
+                        'using a single query for all the lines. Results are ordered (grouped) by line_ref. '
+                        'Use limit -1 to stream all the results.')
+@statement_timeout.route_statement_timeout(statement_timeout.ANALYTICAL_STATEMENT_TIMEOUT_SECONDS)
+@db_pool.analytical_route
+@http_cache.date_cache_control(date_to_param_names=['date_to'])
+async def batch_list(limit: int = common.param_limit(default_limit=DEFAULT_LIMIT),
+                     offset: int = common.param_offset(),
+                     cursor: str = common.param_cursor(),
+                     get_count: bool = common.param_get_count(),
+                     count_mode: str = common.param_count_mode(),
+                     format: str = common.param_format(),
+                     date_from: datetime.date = common.doc_param('date', filter_type='date_from', default=...),
+                     date_to: datetime.date = common.doc_param('date', filter_type='date_to', default=...),
+                     operator_ref: int = common.doc_param('operator_ref', filter_type='equals', description="Line operator ref.", default=...),
+                     line_refs: str = common.doc_param('line_ref', filter_type='list', description=f"Line refs of the operator, up to {BATCH_MAX_LINES} lines. "
+                                                                                                   "If not set, returns all the lines of the operator.")):
+    if line_refs:
+        try:
+            line_refs = [int(line_ref) for line_ref in line_refs.split(',')]
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid line_refs, expected comma-separated list of integers')
+        if len(line_refs) > BATCH_MAX_LINES:
+            raise HTTPException(status_code=400, detail=f'Too many line_refs, maximum allowed is {BATCH_MAX_LINES}')
+    else:
+        line_refs = None
+    response = await get_rides_response(['operator_ref', 'line_ref', 'actual_start_time', 'planned_start_time', 'gtfs_ride_id', 'siri_ride_id'], f'line_ref asc, {ORDER_BY}',
+                                        operator_ref, line_refs, date_from, date_to, limit, offset, get_count, cursor, count_mode, format)
+    if response is not None:
+        return response
+    sql, sql_params = materialized_rides_execution.get_live_rides_sql(operator_ref, line_refs, date_from, date_to)
+    sql = f'select operator_ref, line_ref, actual_start_time, planned_start_time, gtfs_ride_id, siri_ride_id from ({sql}) rides'
+    return await sql_route.list_async(sql, sql_params, DEFAULT_LIMIT, limit, offset, get_count, f'line_ref asc, {ORDER_BY}', False, cursor=cursor, count_mode=count_mode, response_format=format)
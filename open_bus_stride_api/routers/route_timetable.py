@@ -8,6 +8,7 @@ from open_bus_stride_db.model.gtfs_stop import GtfsStop
 from open_bus_stride_db import model
 
 from . import common
+from ..common import cache
 
 
 router = APIRouter()
@@ -60,16 +61,19 @@ def _convert_to_dict(obj):
 
 
 @common.router_list(router, TAG, PYDANTIC_MODEL, WHAT_PLURAL)
-def list_(limit: int = common.param_limit(),
+@cache.cached_route(date_to_param_names=['planned_start_time_date_to'])
+async def list_(limit: int = common.param_limit(),
           offset: int = common.param_offset(),
           get_count: bool = common.param_get_count(),
+          count_mode: str = common.param_count_mode(),
+          format: str = common.param_format(),
           planned_start_time_date_from: datetime.datetime = common.doc_param('planned_start_time', 'datetime_from', description='Set a time range to get the timetable of a specific ride'),
           planned_start_time_date_to: datetime.datetime = common.doc_param('planned_start_time', 'datetime_to', description='Set a time range to get the time table of a specific ride'),
           line_refs: str = common.doc_param('line_ref', 'list', description='To get a line ref, first query gtfs_routes')):
     assert line_refs or (planned_start_time_date_to and planned_start_time_date_from), 'please select either line_refs or both planned_start_time_from and planned_start_time_to'
     if planned_start_time_date_from and planned_start_time_date_to:
         assert (planned_start_time_date_to - planned_start_time_date_from).total_seconds() <= 86400, 'planned_start_time_date_from/to interval must be lower than 1 day'
-    return common.get_list(
+    return await common.get_list_async(
         GtfsStop, limit, offset,
         [
             {'type': 'datetime_from', 'field': model.GtfsRide.start_time, 'value': planned_start_time_date_from},
@@ -79,6 +83,8 @@ def list_(limit: int = common.param_limit(),
         post_session_query_hook=_post_session_query_hook,
         convert_to_dict=_convert_to_dict,
         get_count=get_count,
+        count_mode=count_mode,
+        response_format=format,
         skip_order_by=True,
         get_base_session_query_callback=get_base_session_query,
     )
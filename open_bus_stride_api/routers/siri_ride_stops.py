@@ -8,6 +8,7 @@ from open_bus_stride_db import model
 
 from . import common
 from . import siri_rides, siri_stops, gtfs_stops, siri_vehicle_locations, gtfs_ride_stops, gtfs_rides, gtfs_routes
+from ..common import http_cache
 
 
 router = APIRouter()
@@ -91,9 +92,13 @@ def _post_session_query_hook(session_query: sqlalchemy.orm.Query):
 
 
 @common.router_list(router, TAG, SiriRideStopWithRelatedPydanticModel, WHAT_PLURAL)
-def list_(limit: int = common.param_limit(),
+@http_cache.date_cache_control(date_to_param_names=['siri_vehicle_location__recorded_at_time_to', 'siri_ride__scheduled_start_time_to', 'gtfs_date_to'])
+async def list_(limit: int = common.param_limit(),
           offset: int = common.param_offset(),
+          cursor: str = common.param_cursor(),
           get_count: bool = common.param_get_count(),
+          count_mode: str = common.param_count_mode(),
+          format: str = common.param_format(),
           siri_stop_ids: str = common.doc_param('siri stop id', filter_type='list'),
           siri_ride_ids: str = common.doc_param('siri ride id', filter_type='list'),
           siri_vehicle_location__lon__greater_or_equal: float = common.doc_param(
@@ -104,6 +109,7 @@ def list_(limit: int = common.param_limit(),
               'siri vehicle location lat', filter_type='greater_or_equal', example='31.961'),
           siri_vehicle_location__lat__lower_or_equal: float = common.doc_param(
               'siri vehicle location lat', filter_type='lower_or_equal', example='31.961'),
+          siri_vehicle_location__bbox: str = common.doc_param('siri vehicle location lon/lat', filter_type='bbox'),
           siri_vehicle_location__recorded_at_time_from: datetime.datetime = common.doc_param(
               'siri vehicle location recorded at time', filter_type='datetime_from'),
           siri_vehicle_location__recorded_at_time_to: datetime.datetime = common.doc_param(
@@ -120,6 +126,7 @@ def list_(limit: int = common.param_limit(),
               'gtfs stop lon', filter_type='greater_or_equal', example='34.808'),
           gtfs_stop__lon__lower_or_equal: float = common.doc_param(
               'gtfs stop lon', filter_type='lower_or_equal', example='34.808'),
+          gtfs_stop__bbox: str = common.doc_param('gtfs stop lon/lat', filter_type='bbox'),
           gtfs_date_from: datetime.date = common.doc_param(
               'gtfs date', filter_type='date_from',
               description='filter all gtfs related records on this date'),
@@ -128,7 +135,7 @@ def list_(limit: int = common.param_limit(),
               description='filter all gtfs related records on this date'),
           order_by: str = common.param_order_by(default=''),
           ):
-    return common.get_list(
+    return await common.get_list_async(
         model.SiriRideStop, limit, offset,
         [
             {'type': 'in', 'field': model.SiriRideStop.siri_stop_id, 'value': siri_stop_ids},
@@ -137,12 +144,14 @@ def list_(limit: int = common.param_limit(),
             {'type': 'lower_or_equal', 'field': model.SiriVehicleLocation.lon, 'value': siri_vehicle_location__lon__lower_or_equal},
             {'type': 'greater_or_equal', 'field': model.SiriVehicleLocation.lat, 'value': siri_vehicle_location__lat__greater_or_equal},
             {'type': 'lower_or_equal', 'field': model.SiriVehicleLocation.lat, 'value': siri_vehicle_location__lat__lower_or_equal},
+            {'type': 'bbox', 'fields': (model.SiriVehicleLocation.lon, model.SiriVehicleLocation.lat), 'value': siri_vehicle_location__bbox},
             {'type': 'datetime_from', 'field': model.SiriVehicleLocation.recorded_at_time, 'value': siri_vehicle_location__recorded_at_time_from},
             {'type': 'datetime_to', 'field': model.SiriVehicleLocation.recorded_at_time, 'value': siri_vehicle_location__recorded_at_time_to},
             {'type': 'greater_or_equal', 'field': model.GtfsStop.lat, 'value': gtfs_stop__lat__greater_or_equal},
             {'type': 'lower_or_equal', 'field': model.GtfsStop.lat, 'value': gtfs_stop__lat__lower_or_equal},
             {'type': 'greater_or_equal', 'field': model.GtfsStop.lon, 'value': gtfs_stop__lon__greater_or_equal},
             {'type': 'lower_or_equal', 'field': model.GtfsStop.lon, 'value': gtfs_stop__lon__lower_or_equal},
+            {'type': 'bbox', 'fields': (model.GtfsStop.lon, model.GtfsStop.lat), 'value': gtfs_stop__bbox},
             {'type': 'datetime_from', 'field': model.GtfsRoute.date, 'value': gtfs_date_from},
             {'type': 'datetime_to', 'field': model.GtfsRoute.date, 'value': gtfs_date_to},
             {'type': 'datetime_from', 'field': model.GtfsStop.date, 'value': gtfs_date_from},
@@ -153,13 +162,17 @@ def list_(limit: int = common.param_limit(),
         order_by=order_by,
         post_session_query_hook=_post_session_query_hook,
         get_count=get_count,
+        count_mode=count_mode,
+        response_format=format,
         pydantic_model=PYDANTIC_MODEL,
+        cursor=cursor,
+        skip_response_validation=True,
     )
 
 
 @common.router_get(router, TAG, PYDANTIC_MODEL, WHAT_SINGULAR)
-def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
-    return common.get_item(
+async def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
+    return await common.get_item_async(
         SQL_MODEL, SQL_MODEL.id, id,
         pydantic_model=PYDANTIC_MODEL,
     )
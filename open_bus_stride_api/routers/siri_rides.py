@@ -7,6 +7,7 @@ import sqlalchemy.orm
 from open_bus_stride_db import model
 
 from . import common, gtfs_rides, gtfs_routes, siri_routes
+from ..common import http_cache
 
 
 router = APIRouter()
@@ -120,15 +121,19 @@ siri_ride_filter_params_with_related = [
 siri_ride_list_params = [
     common.param_limit(as_RouteParam=True),
     common.param_offset(as_RouteParam=True),
+    common.param_cursor(as_RouteParam=True),
     common.param_get_count(as_RouteParam=True),
+    common.param_count_mode(as_RouteParam=True),
+    common.param_format(as_RouteParam=True),
     *siri_ride_filter_params_with_related,
     common.param_order_by(as_RouteParam=True),
 ]
 
 
 @common.add_api_router_list(router, TAG, SiriRideWithRelatedPydanticModel, WHAT_PLURAL, siri_ride_list_params)
-def list_(**kwargs):
-    return common.get_list(
+@http_cache.date_cache_control(date_to_param_names=['scheduled_start_time_to'])
+async def list_(**kwargs):
+    return await common.get_list_async(
         SQL_MODEL, kwargs['limit'], kwargs['offset'],
         [
             route_param.get_filter(kwargs)
@@ -137,13 +142,17 @@ def list_(**kwargs):
         order_by=kwargs['order_by'],
         post_session_query_hook=_post_session_query_hook,
         get_count=kwargs['get_count'],
+        count_mode=kwargs['count_mode'],
+        response_format=kwargs['format'],
         pydantic_model=PYDANTIC_MODEL,
+        cursor=kwargs['cursor'],
     )
 
 
 @common.router_get(router, TAG, PYDANTIC_MODEL, WHAT_SINGULAR)
-def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
-    return common.get_item(
+@http_cache.date_cache_control(item_date_field_names=['scheduled_start_time'])
+async def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
+    return await common.get_item_async(
         SQL_MODEL, SQL_MODEL.id, id,
         pydantic_model=PYDANTIC_MODEL,
     )
@@ -22,25 +22,31 @@ SQL_MODEL = SiriStop
 
 
 @common.router_list(router, TAG, PYDANTIC_MODEL, WHAT_PLURAL)
-def list_(limit: int = common.param_limit(),
+async def list_(limit: int = common.param_limit(),
           offset: int = common.param_offset(),
+          cursor: str = common.param_cursor(),
           get_count: bool = common.param_get_count(),
+          count_mode: str = common.param_count_mode(),
+          format: str = common.param_format(),
           codes: str = common.doc_param('stop code', filter_type='list'),
           order_by: str = common.param_order_by()):
-    return common.get_list(
+    return await common.get_list_async(
         SiriStop, limit, offset,
         [
             {'type': 'in', 'field': SiriStop.code, 'value': codes},
         ],
         order_by=order_by,
         get_count=get_count,
+        count_mode=count_mode,
+        response_format=format,
         pydantic_model=PYDANTIC_MODEL,
+        cursor=cursor,
     )
 
 
 @common.router_get(router, TAG, PYDANTIC_MODEL, WHAT_SINGULAR)
-def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
-    return common.get_item(
+async def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
+    return await common.get_item_async(
         SQL_MODEL, SQL_MODEL.id, id,
         pydantic_model=PYDANTIC_MODEL,
     )
@@ -3,13 +3,16 @@ import datetime
 import sqlalchemy
 
 import pydantic
-from fastapi import APIRouter
+from fastapi import APIRouter, Query, HTTPException, Response
+from starlette.concurrency import run_in_threadpool
 
 from open_bus_stride_db.model.siri_vehicle_location import SiriVehicleLocation
 from open_bus_stride_db import model
 
 from . import siri_rides, siri_routes, siri_snapshots
 from . import common
+from ..common import cache, mvt, statement_timeout, db_pool, http_cache
+from ..materialized import store
 
 
 router = APIRouter()
@@ -33,6 +36,43 @@ WHAT_PLURAL = f'{WHAT_SINGULAR}s'
 TAG = 'siri'
 PYDANTIC_MODEL = SiriVehicleLocationPydanticModel
 SQL_MODEL = model.SiriVehicleLocation
+# list requests which scan more rows (limit + offset), stream all the results or count exactly are sent to the read replicas
+DEEP_SCAN_MIN_ROWS = 10000
+# vector tiles: points are clustered in a grid of TILE_CLUSTER_SIZE tile units (out of mvt.EXTENT)
+# above TILE_CLUSTER_MAX_ZOOM the grid size is halved for each zoom level, until each point is returned separately
+# tiles are limited to TILE_MAX_FEATURES clusters, keeping the clusters with the most points
+TILE_MIN_ZOOM = 8
+TILE_CLUSTER_SIZE = 64
+TILE_CLUSTER_MAX_ZOOM = 14
+TILE_MAX_FEATURES = 10000
+TILE_MAX_HOURS = 24
+TILE_QUERY = """
+    SELECT
+        FLOOR(px / :cluster_size) AS cluster_x,
+        FLOOR(py / :cluster_size) AS cluster_y,
+        COUNT(*) AS point_count,
+        AVG(velocity)::DOUBLE PRECISION AS velocity_avg,
+        AVG(px)::DOUBLE PRECISION AS cluster_px,
+        AVG(py)::DOUBLE PRECISION AS cluster_py
+    FROM (
+        SELECT
+            velocity,
+            ((lon + 180) / 360 * :n - :x) * :extent AS px,
+            ((1 - LN(TAN(RADIANS(lat)) + 1 / COS(RADIANS(lat))) / PI()) / 2 * :n - :y) * :extent AS py
+        FROM
+            siri_vehicle_location
+        WHERE
+            recorded_at_time >= :recorded_from AND recorded_at_time < :recorded_to
+            AND lon >= :lon_min AND lon < :lon_max
+            AND lat > :lat_min AND lat <= :lat_max
+    ) points
+    GROUP BY
+        cluster_x,
+        cluster_y
+    ORDER BY
+        point_count DESC
+    LIMIT :max_features
+"""
 
 
 siri_route_related_model = common.PydanticRelatedModel(
@@ -74,9 +114,13 @@ def _post_session_query_hook(session_query: sqlalchemy.orm.Query):
 
 
 @common.router_list(router, TAG, SiriVehicleLocationWithRelatedPydanticModel, WHAT_PLURAL)
-def list_(limit: int = common.param_limit(),
+@http_cache.date_cache_control(date_to_param_names=['recorded_at_time_to', 'siri_rides__schedualed_start_time_to'])
+async def list_(limit: int = common.param_limit(),
           offset: int = common.param_offset(),
+          cursor: str = common.param_cursor(),
           get_count: bool = common.param_get_count(),
+          count_mode: str = common.param_count_mode(),
+          format: str = common.param_format(),
           siri_vehicle_location_ids: str = common.doc_param('siri vehicle location id', filter_type='list'),
           siri_snapshot_ids: str = common.doc_param('siri snapshot id', filter_type='list'),
           siri_ride_stop_ids: str = common.doc_param('siri ride stop id', filter_type='list'),
@@ -86,6 +130,7 @@ def list_(limit: int = common.param_limit(),
           lon__lower_or_equal: float = common.doc_param('lon', filter_type='lower_or_equal', example='34.808'),
           lat__greater_or_equal: float = common.doc_param('lat', filter_type='greater_or_equal', example='31.961'),
           lat__lower_or_equal: float = common.doc_param('lat', filter_type='lower_or_equal', example='31.961'),
+          bbox: str = common.doc_param('lon/lat', filter_type='bbox'),
           order_by: str = common.param_order_by(),
           siri_routes__line_ref: str = common.doc_param('siri route line ref', filter_type='equals'),
           siri_ride__vehicle_ref: str = common.doc_param('siri ride vehicle ref', filter_type='equals'),
@@ -95,7 +140,9 @@ def list_(limit: int = common.param_limit(),
           siri_rides__ids: str = common.doc_param('siri ride id', filter_type='list'),
           siri_routes__ids: str = common.doc_param('siri route id', filter_type='list'),
           ):
-    return common.get_list(
+    if common.is_streaming_limit(limit) or (limit or 0) + (offset or 0) >= DEEP_SCAN_MIN_ROWS or (get_count and count_mode in (None, 'exact')):
+        db_pool.set_analytical_request()
+    return await common.get_list_async(
         SiriVehicleLocation, limit, offset,
         [
             {'type': 'equals', 'field': model.SiriRoute.line_ref, 'value': siri_routes__line_ref},
@@ -114,17 +161,75 @@ def list_(limit: int = common.param_limit(),
             {'type': 'lower_or_equal', 'field': model.SiriVehicleLocation.lon, 'value': lon__lower_or_equal},
             {'type': 'greater_or_equal', 'field': model.SiriVehicleLocation.lat, 'value': lat__greater_or_equal},
             {'type': 'lower_or_equal', 'field': model.SiriVehicleLocation.lat, 'value': lat__lower_or_equal},
+            {'type': 'bbox', 'fields': (model.SiriVehicleLocation.lon, model.SiriVehicleLocation.lat), 'value': bbox},
         ],
         order_by=order_by,
         post_session_query_hook=_post_session_query_hook,
         get_count=get_count,
+        count_mode=count_mode,
+        response_format=format,
         pydantic_model=PYDANTIC_MODEL,
+        cursor=cursor,
+        skip_response_validation=True,
     )
 
 
 @common.router_get(router, TAG, PYDANTIC_MODEL, WHAT_SINGULAR)
-def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
-    return common.get_item(
+@http_cache.date_cache_control(item_date_field_names=['recorded_at_time'])
+async def get_(id: int = common.param_get_id(WHAT_SINGULAR)):
+    return await common.get_item_async(
         SQL_MODEL, SQL_MODEL.id, id,
         pydantic_model=PYDANTIC_MODEL,
     )
+
+
+def get_tile_cluster_size(z):
+    if z <= TILE_CLUSTER_MAX_ZOOM:
+        return TILE_CLUSTER_SIZE
+    return max(1, TILE_CLUSTER_SIZE >> (z - TILE_CLUSTER_MAX_ZOOM))
+
+
+def get_tile_features(z, x, y, recorded_from, recorded_to):
+    params = {
+        'cluster_size': get_tile_cluster_size(z),
+        'n': 2 ** z,
+        'x': x,
+        'y': y,
+        'extent': mvt.EXTENT,
+        'recorded_from': recorded_from,
+        'recorded_to': recorded_to,
+        'max_features': TILE_MAX_FEATURES,
+        **mvt.get_tile_bounds(z, x, y),
+    }
+    with db_pool.get_session() as session:
+        rows = session.execute(sqlalchemy.text(TILE_QUERY), params).fetchall()
+    return [
+        (
+            min(max(int(row.cluster_px), 0), mvt.EXTENT - 1),
+            min(max(int(row.cluster_py), 0), mvt.EXTENT - 1),
+            {'point_count': int(row.point_count), 'velocity_avg': row.velocity_avg},
+        )
+        for row in rows
+    ]
+
+
+@router.get('/tiles/{z}/{x}/{y}.mvt', tags=[TAG], response_class=Response,
+            description=f'Mapbox vector tile of {WHAT_PLURAL}, in layer "{WHAT_PLURAL}". '
+                        f'Points are clustered by zoom level, each feature has the number of points '
+                        f'(point_count) and their average velocity (velocity_avg). '
+                        f'Available from zoom level {TILE_MIN_ZOOM}. '
+                        f'Tiles of ranges which ended more than {store.MATERIALIZED_CLOSED_DELAY_MINUTES} minutes ago are cached for a long time.')
+@cache.cached_route(date_to_param_names=['recorded_at_time_to'])
+@statement_timeout.route_statement_timeout(statement_timeout.ANALYTICAL_STATEMENT_TIMEOUT_SECONDS)
+@db_pool.analytical_route
+async def tile(z: int, x: int, y: int,
+               recorded_at_time_from: datetime.datetime = Query(..., description='start of recorded at time range, inclusive'),
+               recorded_at_time_to: datetime.datetime = Query(..., description=f'end of recorded at time range, exclusive, up to {TILE_MAX_HOURS} hours'),
+               ):
+    mvt.validate_tile(z, x, y)
+    if z < TILE_MIN_ZOOM:
+        raise HTTPException(status_code=400, detail=f'Tiles are available from zoom level {TILE_MIN_ZOOM}')
+    if not recorded_at_time_from < recorded_at_time_to <= recorded_at_time_from + datetime.timedelta(hours=TILE_MAX_HOURS):
+        raise HTTPException(status_code=400, detail=f'recorded_at_time_to must be after recorded_at_time_from, up to {TILE_MAX_HOURS} hours')
+    features = await run_in_threadpool(get_tile_features, z, x, y, recorded_at_time_from, recorded_at_time_to)
+    return mvt.get_tile_response({WHAT_PLURAL: features})
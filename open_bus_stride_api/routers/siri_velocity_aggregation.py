@@ -2,59 +2,13 @@ import datetime
 from typing import List, Optional
 
 import pydantic
-from fastapi import APIRouter, Query, HTTPException
-from sqlalchemy import text
+from fastapi import APIRouter, Query, HTTPException, Response
+from starlette.concurrency import run_in_threadpool
 
-from . import common
+from ..common import cache, mvt, statement_timeout, db_pool
+from ..materialized import velocity_grid, store
 
 TAG = "siri"
-QUERY = """
-    WITH RollingAvg AS (
-        with RoundedLonLat as (
-            SELECT 
-                (CAST(lon AS NUMERIC) * POWER(2, :rounding_precision) + 0.5)::INT / POWER(2, :rounding_precision) AS rounded_lon,
-                (CAST(lat AS NUMERIC) * POWER(2, :rounding_precision) + 0.5)::INT / POWER(2, :rounding_precision) AS rounded_lat,
-                velocity,
-                recorded_at_time
-            FROM 
-                siri_vehicle_location
-            WHERE 
-                velocity > :velocity_min
-                AND velocity < :velocity_max 
-                AND lon BETWEEN :lon_min AND :lon_max
-                AND lat BETWEEN :lat_min AND :lat_max
-                AND recorded_at_time BETWEEN :recorded_from AND (:recorded_from + INTERVAL '1 day')
-        )
-        SELECT 
-            rounded_lon,
-            rounded_lat,
-            AVG(velocity) OVER (
-                PARTITION BY 
-                    rounded_lon,
-                    rounded_lat
-                ORDER BY 
-                    recorded_at_time
-                ROWS BETWEEN 2 PRECEDING AND 2 FOLLOWING
-            ) AS rolling_average
-        FROM 
-            RoundedLonLat
-    )
-    SELECT 
-        rounded_lon::DOUBLE PRECISION AS rounded_lon,
-        rounded_lat::DOUBLE PRECISION AS rounded_lat,
-        COUNT(*) AS total_sample_count,
-        AVG(rolling_average) AS average_rolling_avg,
-        STDDEV(rolling_average) AS stddev_rolling_avg
-    FROM
-        RollingAvg
-    GROUP BY
-        rounded_lon, 
-        rounded_lat
-    ORDER BY
-        rounded_lon, rounded_lat
-"""
-VELOCITY_MIN = 0
-VELOCITY_MAX = 200
 
 
 class SiriVelocityAggregationPydanticModel(pydantic.BaseModel):
@@ -65,18 +19,35 @@ class SiriVelocityAggregationPydanticModel(pydantic.BaseModel):
     stddev_rolling_avg: Optional[float]
 
 
+TILE_LAYER_NAME = "siri_velocity_aggregation"
+
 router = APIRouter()
 
 
+def validate_recorded_range(recorded_from, recorded_to):
+    if recorded_to is None:
+        recorded_to = recorded_from + datetime.timedelta(days=1)
+    if not recorded_from < recorded_to <= recorded_from + datetime.timedelta(days=velocity_grid.MAX_DAYS):
+        raise HTTPException(status_code=400, detail=f'recorded_to must be after recorded_from, up to {velocity_grid.MAX_DAYS} days')
+    return recorded_to
+
+
 @router.get(
     "/siri_velocity_aggregation",
     tags=[TAG],
     response_model=List[SiriVelocityAggregationPydanticModel],
 )
+@statement_timeout.route_statement_timeout(statement_timeout.ANALYTICAL_STATEMENT_TIMEOUT_SECONDS)
+@db_pool.analytical_route
 def siri_velocity_aggregation(
     recorded_from: datetime.datetime = Query(
         ..., description="start of recorded_at_time range, inclusive"
     ),
+    recorded_to: Optional[datetime.datetime] = Query(
+        None, description="end of recorded_at_time range, exclusive. Defaults to 1 day after recorded_from. "
+                          "Longer ranges are aggregated from the results of each Israel calendar day in range (from 00:00 local time), "
+                          f"up to {velocity_grid.MAX_DAYS} days"
+    ),
     lon_min: float = Query(34.25, description="minimum longitude bound"),
     lon_max: float = Query(35.70, description="maximum longitude bound"),
     lat_min: float = Query(29.50, description="minimum latitude bound"),
@@ -85,20 +56,64 @@ def siri_velocity_aggregation(
         2, ge=0, le=10, description="lon/lat scaling factor, in powers of 2"
     ),
 ) -> List[SiriVelocityAggregationPydanticModel]:
-    sql = text(QUERY)
-    params = {
-        "rounding_precision": rounding_precision,
-        "velocity_min": VELOCITY_MIN,
-        "velocity_max": VELOCITY_MAX,
+    recorded_to = validate_recorded_range(recorded_from, recorded_to)
+    bounds = {
         "lon_min": lon_min,
         "lon_max": lon_max,
         "lat_min": lat_min,
         "lat_max": lat_max,
-        "recorded_from": recorded_from,
     }
-    try:
-        with common.get_session() as session:
-            result = session.execute(sql, params)
-            return list(result.fetchall())
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # days which ended are served from precomputed per-cell partials, see materialized.velocity_grid
+    return velocity_grid.get_cells(velocity_grid.get_partials(recorded_from, recorded_to, rounding_precision, bounds))
+
+
+def get_tile_features(z, x, y, recorded_from, recorded_to, rounding_precision):
+    # the bounds are extended by half a cell, so that cells which are centered in the tile include all their samples
+    # the bounds are limited to the stored grid bounds, so that closed days are served from the store
+    half_step = 0.5 / 2 ** rounding_precision
+    tile_bounds = mvt.get_tile_bounds(z, x, y)
+    bounds = {
+        "lon_min": max(tile_bounds["lon_min"] - half_step, velocity_grid.BOUNDS["lon_min"]),
+        "lon_max": min(tile_bounds["lon_max"] + half_step, velocity_grid.BOUNDS["lon_max"]),
+        "lat_min": max(tile_bounds["lat_min"] - half_step, velocity_grid.BOUNDS["lat_min"]),
+        "lat_max": min(tile_bounds["lat_max"] + half_step, velocity_grid.BOUNDS["lat_max"]),
+    }
+    if bounds["lon_min"] >= bounds["lon_max"] or bounds["lat_min"] >= bounds["lat_max"]:
+        return []
+    features = []
+    for cell in velocity_grid.get_cells(velocity_grid.get_partials(recorded_from, recorded_to, rounding_precision, bounds)):
+        pixel = mvt.get_tile_pixel(z, x, y, cell["rounded_lon"], cell["rounded_lat"])
+        if pixel is not None:
+            features.append((*pixel, cell))
+    return features
+
+
+@router.get(
+    "/tiles/{z}/{x}/{y}.mvt",
+    tags=[TAG],
+    response_class=Response,
+    description=f'Mapbox vector tile of the siri velocity aggregation cells, in layer "{TILE_LAYER_NAME}". '
+                'Each cell is a point feature with the same fields as the siri_velocity_aggregation results.',
+)
+@cache.cached_route(date_to_param_names=["recorded_to"])
+@statement_timeout.route_statement_timeout(statement_timeout.ANALYTICAL_STATEMENT_TIMEOUT_SECONDS)
+@db_pool.analytical_route
+async def siri_velocity_aggregation_tile(
+    z: int,
+    x: int,
+    y: int,
+    recorded_from: datetime.datetime = Query(
+        ..., description="start of recorded_at_time range, inclusive"
+    ),
+    recorded_to: datetime.datetime = Query(
+        ..., description=f"end of recorded_at_time range, exclusive, up to {velocity_grid.MAX_DAYS} days. "
+                         f"Tiles of ranges which ended more than {store.MATERIALIZED_CLOSED_DELAY_MINUTES} minutes ago are cached for a long time"
+    ),
+    rounding_precision: int = Query(
+        2, ge=0, le=10, description="lon/lat scaling factor, in powers of 2"
+    ),
+):
+    mvt.validate_tile(z, x, y)
+    recorded_to = validate_recorded_range(recorded_from, recorded_to)
+    features = await run_in_threadpool(get_tile_features, z, x, y, recorded_from, recorded_to, rounding_precision)
+    return mvt.get_tile_response({TILE_LAYER_NAME: features})
@@ -47,12 +47,14 @@ def _convert_to_dict(obj):
 
 
 @common.router_list(router, TAG, PYDANTIC_MODEL, WHAT_PLURAL)
-def list_(limit: int = common.param_limit(LIST_MAX_LIMIT),
+async def list_(limit: int = common.param_limit(LIST_MAX_LIMIT),
           offset: int = common.param_offset(),
           get_count: bool = common.param_get_count(),
+          count_mode: str = common.param_count_mode(),
+          format: str = common.param_format(),
           gtfs_stop_id: int = common.doc_param('gtfs_stop_id', 'equals', description='To get a line ref, first query gtfs_routes'),
           gtfs_ride_ids: str = common.doc_param('line_ref', 'list', description='To get a line ref, first query gtfs_routes')):
-    return common.get_list(
+    return await common.get_list_async(
         GtfsStop, limit, offset,
         [
             {'type': 'equals', 'field': model.GtfsStop.id, 'value': gtfs_stop_id},
@@ -61,6 +63,8 @@ def list_(limit: int = common.param_limit(LIST_MAX_LIMIT),
         post_session_query_hook=_post_session_query_hook,
         convert_to_dict=_convert_to_dict,
         get_count=get_count,
+        count_mode=count_mode,
+        response_format=format,
         skip_order_by=True,
         get_base_session_query_callback=get_base_session_query,
     )
@@ -0,0 +1,18 @@
+from open_bus_stride_api.common import admin
+
+
+def test_admin_token_requires_configured_token(monkeypatch):
+    monkeypatch.setattr(admin, 'ADMIN_TOKEN', None)
+    assert not admin.is_admin_token_valid('secret')
+    assert not admin.is_admin_token_valid(None)
+    monkeypatch.setattr(admin, 'ADMIN_TOKEN', 'secret')
+    assert admin.is_admin_token_valid('secret')
+    assert not admin.is_admin_token_valid('wrong')
+    assert not admin.is_admin_token_valid(None)
+
+
+def test_get_request_admin_token():
+    assert admin.get_request_admin_token({'x-admin-token': 'secret'}.get) == 'secret'
+    assert admin.get_request_admin_token({'authorization': 'Bearer secret'}.get) == 'secret'
+    assert admin.get_request_admin_token({'authorization': 'Basic secret'}.get) is None
+    assert admin.get_request_admin_token({}.get) is None
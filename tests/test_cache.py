@@ -0,0 +1,151 @@
+import os
+import time
+import asyncio
+import datetime
+
+import fastapi
+
+from open_bus_stride_api.common import cache, http_cache, request_context
+from open_bus_stride_api.materialized import store
+
+
+def test_lru_cache_eviction_and_stats():
+    lru_cache = cache.LRUCache(2)
+    lru_cache.set('a', 1, 60)
+    lru_cache.set('b', 2, 60)
+    assert lru_cache.get('a') == (True, 1)
+    lru_cache.set('c', 3, 60)
+    assert lru_cache.get('b') == (False, None)
+    assert lru_cache.get('a') == (True, 1)
+    assert lru_cache.get('c') == (True, 3)
+    assert lru_cache.get_stats() == {'items': 2, 'max_items': 2, 'hits': 3, 'misses': 1, 'evictions': 1}
+
+
+def test_lru_cache_ttl():
+    lru_cache = cache.LRUCache(2)
+    lru_cache.set('a', 1, -1)
+    assert lru_cache.get('a') == (False, None)
+
+
+def test_get_ttl_seconds():
+    yesterday = datetime.date.today() - datetime.timedelta(days=2)
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    assert cache.get_ttl_seconds({'date_to': yesterday}, ['date_to']) == cache.CACHE_HISTORICAL_TTL_SECONDS
+    assert cache.get_ttl_seconds({'date_to': tomorrow}, ['date_to']) == cache.CACHE_CURRENT_TTL_SECONDS
+    assert cache.get_ttl_seconds({'date_to': None}, ['date_to']) == cache.CACHE_CURRENT_TTL_SECONDS
+    # ranges which ended recently may still be loaded by the ETL
+    recently = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=10)
+    assert cache.get_ttl_seconds({'recorded_to': recently}, ['recorded_to']) == cache.CACHE_CURRENT_TTL_SECONDS
+    assert cache.get_ttl_seconds({'date_to': datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=1), 'recorded_to': recently},
+                                 ['date_to', 'recorded_to']) == cache.CACHE_CURRENT_TTL_SECONDS
+
+
+def test_date_cache_control():
+    yesterday = datetime.date.today() - datetime.timedelta(days=2)
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+
+    @http_cache.date_cache_control(date_to_param_names=['date_to'])
+    async def _list(date_to=None):
+        return []
+
+    @http_cache.date_cache_control(item_date_field_names=['date'])
+    async def _get(date=None):
+        return {'date': date}
+
+    async def _get_cache_control(func, **kwargs):
+        request_context._request_context.set({'scope': {}, 'response_headers': {}})
+        await func(**kwargs)
+        return request_context.get_request_context()['response_headers']['cache-control']
+
+    historical_cache_control = f'public, max-age={http_cache.HTTP_CACHE_HISTORICAL_MAX_AGE_SECONDS}'
+    assert asyncio.run(_get_cache_control(_list, date_to=yesterday)) == historical_cache_control
+    assert asyncio.run(_get_cache_control(_list, date_to=tomorrow)) == 'no-cache'
+    assert asyncio.run(_get_cache_control(_list)) == 'no-cache'
+    assert asyncio.run(_get_cache_control(_get, date=yesterday)) == historical_cache_control
+    assert asyncio.run(_get_cache_control(_get, date=tomorrow)) == 'no-cache'
+
+
+def test_cached_route_recently_ended_range(monkeypatch):
+    # e.g. vehicle locations / velocity tiles of a range which ended minutes ago, which may still be loaded by the ETL
+    monkeypatch.setattr(cache, 'CACHE_ENABLED', True)
+    monkeypatch.setattr(cache, '_cache', cache.LRUCache(10))
+
+    @cache.cached_route(date_to_param_names=['recorded_to'])
+    async def _tile(recorded_to=None):
+        return fastapi.Response(content=b'tile')
+
+    async def _get_ttl_and_cache_control(recorded_to):
+        request_context._request_context.set({'scope': {}, 'response_headers': {}})
+        await _tile(recorded_to=recorded_to)
+        key = cache.get_cache_key(_tile.__wrapped__, {'recorded_to': recorded_to})
+        return cache._cache._items[key][0] - time.time(), request_context.get_request_context()['response_headers']['cache-control']
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    ttl, cache_control = asyncio.run(_get_ttl_and_cache_control(now - datetime.timedelta(minutes=10)))
+    assert ttl <= cache.CACHE_CURRENT_TTL_SECONDS and cache_control == 'no-cache'
+    ttl, cache_control = asyncio.run(_get_ttl_and_cache_control(now - datetime.timedelta(days=1)))
+    assert ttl > cache.CACHE_CURRENT_TTL_SECONDS and cache_control.startswith('public')
+
+
+def test_is_closed_date():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    delay = datetime.timedelta(minutes=store.MATERIALIZED_CLOSED_DELAY_MINUTES)
+    # times which ended recently may still be loaded by the ETL
+    assert not http_cache.is_closed_date(now - datetime.timedelta(minutes=1))
+    assert http_cache.is_closed_date(now - delay - datetime.timedelta(minutes=1))
+    # naive times are UTC
+    assert not http_cache.is_closed_date((now - delay + datetime.timedelta(minutes=1)).replace(tzinfo=None))
+    assert http_cache.is_closed_date((now - delay - datetime.timedelta(minutes=1)).replace(tzinfo=None))
+    # dates are closed after the end of the day
+    assert not http_cache.is_closed_date(now.date())
+    assert http_cache.is_closed_date(now.date() - datetime.timedelta(days=2))
+    assert http_cache.is_closed_date((now - delay - datetime.timedelta(days=1, minutes=1)).date())
+
+
+def test_shared_memory_cache_shared_between_workers(tmp_path):
+    worker_1_cache = cache.SharedMemoryCache(str(tmp_path), 10, 1024 * 1024)
+    worker_2_cache = cache.SharedMemoryCache(str(tmp_path), 10, 1024 * 1024)
+    value = {'data': [{'gtfs_route_date': datetime.date(2022, 1, 1), 'total_routes': 5}], 'response_headers': {}}
+    assert worker_2_cache.get('a') == (False, None)
+    worker_1_cache.set('a', value, 60)
+    assert worker_2_cache.get('a') == (True, value)
+    worker_1_cache.set('b', 2, -1)
+    assert worker_2_cache.get('b') == (False, None)
+
+
+def test_shared_memory_cache_eviction(tmp_path):
+    shm_cache = cache.SharedMemoryCache(str(tmp_path), 2, 1024 * 1024, cleanup_interval=1)
+    shm_cache.set('a', 1, 60)
+    shm_cache.set('b', 2, 60)
+    # make sure 'b' is the least recently used regardless of filesystem timestamp resolution
+    os.utime(shm_cache._get_filename('b'), (0, 0))
+    shm_cache.set('c', 3, 60)
+    assert shm_cache.get('a') == (True, 1)
+    assert shm_cache.get('b') == (False, None)
+    assert shm_cache.get('c') == (True, 3)
+    stats = shm_cache.get_stats()
+    assert stats['items'] == 2 and stats['evictions'] == 1
+
+
+class LocalRedisClient:
+    # local stand-in for a redis server, supports only the commands used by the cache
+
+    def __init__(self):
+        self.items = {}
+
+    def get(self, key):
+        value, expires = self.items.get(key, (None, None))
+        return value if value is not None and expires > time.time() else None
+
+    def set(self, key, value, ex):
+        self.items[key] = (value, time.time() + ex)
+
+
+def test_redis_cache_shared_between_workers():
+    client = LocalRedisClient()
+    worker_1_cache = cache.RedisCache(client=client)
+    worker_2_cache = cache.RedisCache(client=client)
+    worker_1_cache.set('a', [1, 2], 60)
+    assert worker_2_cache.get('a') == (True, [1, 2])
+    assert worker_2_cache.get('b') == (False, None)
+    assert worker_2_cache.get_stats() == {'hits': 1, 'misses': 1, 'errors': 0}
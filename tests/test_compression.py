@@ -0,0 +1,71 @@
+import zlib
+
+from starlette.applications import Starlette
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from open_bus_stride_api.common import compression
+
+
+BODY = b'[' + b','.join([b'{"siri_route__line_ref":1,"siri_route__operator_ref":3}'] * 1000) + b']'
+
+
+def _small(request):
+    return Response(b'[]', media_type='application/json')
+
+
+def _large(request):
+    return Response(BODY, media_type='application/json', headers={'etag': '"abc"'})
+
+
+def _stream(request):
+    return StreamingResponse(iter([BODY[:100], BODY[100:]]), media_type='application/json')
+
+
+def _get_client():
+    app = Starlette(routes=[Route('/small', _small), Route('/large', _large), Route('/stream', _stream)])
+    app.add_middleware(compression.CompressionMiddleware)
+    return TestClient(app)
+
+
+def test_gzip_compression():
+    client = _get_client()
+    res = client.get('/large', headers={'Accept-Encoding': 'gzip'})
+    assert res.headers['content-encoding'] == 'gzip'
+    assert res.headers['etag'] == 'W/"abc"'
+    assert res.headers['vary'] == 'Accept-Encoding'
+    assert int(res.headers['content-length']) < len(BODY) / 10
+    # the test client decodes the response content
+    assert res.content == BODY
+
+
+def test_min_size_and_not_accepted():
+    client = _get_client()
+    res = client.get('/small', headers={'Accept-Encoding': 'gzip'})
+    assert 'content-encoding' not in res.headers and res.content == b'[]'
+    res = client.get('/large', headers={'Accept-Encoding': 'identity, gzip;q=0'})
+    assert 'content-encoding' not in res.headers and res.content == BODY
+
+
+def test_streaming_compression():
+    client = _get_client()
+    res = client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+    assert res.headers['content-encoding'] == 'gzip'
+    assert 'content-length' not in res.headers
+    assert res.content == BODY
+
+
+def test_gzip_compressor_chunks_are_decodable():
+    compressor = compression.GzipCompressor()
+    decompressor = zlib.decompressobj(31)
+    # each chunk can be decoded as soon as it's received
+    assert decompressor.decompress(compressor.compress(BODY[:100])) == BODY[:100]
+    assert decompressor.decompress(compressor.finish(BODY[100:])) == BODY[100:]
+
+
+def test_get_accepted_encoding():
+    assert compression.get_accepted_encoding('gzip, deflate') == 'gzip'
+    assert compression.get_accepted_encoding('deflate') is None
+    if compression.brotli is not None:
+        assert compression.get_accepted_encoding('gzip, br') == 'br'
@@ -0,0 +1,31 @@
+import sqlalchemy
+import sqlalchemy.pool
+
+from open_bus_stride_api.common import db_pool, async_db
+
+
+def test_pool_limits(monkeypatch):
+    assert db_pool.get_pool_limits(5, 10) == (5, 10)
+    monkeypatch.setattr(db_pool, 'DB_MAX_CONNECTIONS', 100)
+    monkeypatch.setattr(db_pool, 'DB_POOL_WORKERS', 8)
+    assert db_pool.get_pool_limits(5, 10) == (5, 7)
+    monkeypatch.setattr(async_db, 'ASYNC_DB', True)
+    assert db_pool.get_pool_limits(5, 10) == (5, 1)
+    monkeypatch.setattr(db_pool, 'DB_POOL_WORKERS', 64)
+    assert db_pool.get_pool_limits(5, 10) == (1, 0)
+
+
+def test_pgbouncer_pool_kwargs(monkeypatch):
+    monkeypatch.setattr(db_pool, 'DB_PGBOUNCER', True)
+    assert db_pool.get_engine_pool_kwargs(5, 10, 30) == {'poolclass': sqlalchemy.pool.NullPool}
+
+
+def test_pool_status():
+    engine = sqlalchemy.create_engine('sqlite://', poolclass=sqlalchemy.pool.QueuePool, pool_size=2, max_overflow=1)
+    db_pool.register_pool('test', engine, {'pool_size': 2, 'max_overflow': 1})
+    with engine.connect():
+        status = db_pool.get_status()['pools']['test']
+        assert status['checked_out'] == 1
+        assert status['capacity'] == 3
+        assert status['saturation'] == 0.333
+    assert db_pool.get_status()['pools']['test']['checked_out'] == 0
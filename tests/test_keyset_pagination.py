@@ -0,0 +1,32 @@
+import sqlalchemy
+
+from open_bus_stride_api.common import sql_route
+from open_bus_stride_api.routers import common
+
+
+ROWS = [(1, None, 1), (1, None, 2), (1, 2, 3), (1, 2, 4), (2, None, 5), (None, 1, 6), (None, None, 7)]
+ORDER_BY_ARGS = [('asc', 'a'), ('asc', 'b'), ('asc', 'id')]
+
+
+def _get_pages(connection, order_by_args, limit):
+    order_by = ', '.join(f'{fieldname} {direction} nulls {"last" if direction == "asc" else "first"}' for direction, fieldname in order_by_args)
+    pages, cursor = [], None
+    while True:
+        sql_params = {}
+        where = f'where {sql_route.get_keyset_sql_condition(order_by_args, common.decode_cursor(cursor, order_by_args), sql_params)}' if cursor else ''
+        items = [dict(row._mapping) for row in connection.execute(sqlalchemy.text(f'select * from t {where} order by {order_by} limit {limit}'), sql_params)]
+        pages.append([item['id'] for item in items])
+        cursor = common.get_next_cursor(order_by_args, limit, items)
+        if not cursor:
+            return pages
+
+
+def test_keyset_pagination_with_nulls():
+    engine = sqlalchemy.create_engine('sqlite://')
+    with engine.connect() as connection:
+        connection.execute(sqlalchemy.text('create table t (a integer, b integer, id integer)'))
+        connection.execute(sqlalchemy.text('insert into t values (:a, :b, :id)'), [{'a': a, 'b': b, 'id': id} for a, b, id in ROWS])
+        assert _get_pages(connection, ORDER_BY_ARGS, 2) == [[3, 4], [1, 2], [5, 6], [7]]
+        desc_order_by_args = [('desc', 'a'), ('desc', 'b'), ('desc', 'id')]
+        assert _get_pages(connection, desc_order_by_args, 3) == [[7, 6, 5], [2, 1, 4], [3]]
+
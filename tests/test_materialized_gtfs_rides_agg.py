@@ -0,0 +1,97 @@
+import datetime
+
+from open_bus_stride_api.materialized import store, gtfs_rides_agg
+
+
+def _get_live_row(date, hour, operator_ref, line_ref, num_routes, route_short_name):
+    gtfs_route_hour = datetime.datetime.combine(date, datetime.time(hour), datetime.timezone.utc)
+    return (date, gtfs_route_hour, hour, operator_ref, line_ref, gtfs_route_hour.strftime('%A').lower(),
+            num_routes, num_routes * 2, num_routes, f'["{route_short_name}"]', '["a - b"]')
+
+
+def test_get_groups(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'MATERIALIZED_DIR', str(tmp_path))
+    live_queries = []
+
+    def _get_live_rows(date_from, date_to):
+        live_queries.append((date_from, date_to))
+        return [
+            _get_live_row(date_from, 5, 1, 10, 2, '1'),
+            _get_live_row(date_from, 6, 1, 10, 1, '1א'),
+            _get_live_row(date_to, 5, 1, 10, 3, '1'),
+            _get_live_row(date_to, 6, 2, 20, 4, '2'),
+        ]
+
+    monkeypatch.setattr(gtfs_rides_agg, 'get_live_rows', _get_live_rows)
+    date_from, date_to = datetime.date(2023, 5, 1), datetime.date(2023, 5, 2)
+    for _ in range(2):
+        groups, live_date_ranges = gtfs_rides_agg.get_groups(['operator_ref', 'line_ref'], date_from, date_to)
+        assert live_date_ranges == []
+        assert sorted(groups, key=lambda group: group['line_ref']) == [
+            {'operator_ref': 1, 'route_short_name': '["1", "1א"]', 'route_long_name': '["a - b"]', 'line_ref': 10,
+             'total_routes': 6, 'total_planned_rides': 12, 'total_actual_rides': 6},
+            {'operator_ref': 2, 'route_short_name': '["2"]', 'route_long_name': '["a - b"]', 'line_ref': 20,
+             'total_routes': 4, 'total_planned_rides': 8, 'total_actual_rides': 4},
+        ]
+    # missing days are materialized using a single live query
+    assert live_queries == [(date_from, date_to)]
+    groups, _ = gtfs_rides_agg.get_groups(['gtfs_route_date', 'day_of_week'], date_from, date_to, exclude_hours_from=6)
+    assert sorted((group['gtfs_route_date'], group['day_of_week'], group['total_routes']) for group in groups) == [
+        (date_from, 'monday', 2), (date_to, 'tuesday', 3),
+    ]
+    groups, _ = gtfs_rides_agg.get_groups(['gtfs_route_hour'], date_from, date_from)
+    assert [group['gtfs_route_hour'].hour for group in sorted(groups, key=lambda group: group['gtfs_route_hour'])] == [5, 6]
+    groups, _ = gtfs_rides_agg.get_groups([], date_from, date_to)
+    assert groups == [{'total_routes': 10, 'total_planned_rides': 20, 'total_actual_rides': 10}]
+    connection = gtfs_rides_agg.get_connection()
+    try:
+        assert gtfs_rides_agg.get_stored_groups(connection, [], date_from, date_to, exclude_date_ranges=[(date_from, date_from)]) == [
+            {'total_routes': 7, 'total_planned_rides': 14, 'total_actual_rides': 7},
+        ]
+    finally:
+        connection.close()
+    # days which are not closed yet are queried live
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    assert gtfs_rides_agg.get_groups(['operator_ref'], today, today) == (None, [(today, today)])
+
+
+def test_get_groups_build_days_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'MATERIALIZED_DIR', str(tmp_path))
+    monkeypatch.setattr(store, 'MAX_REQUEST_BUILD_DAYS', 2)
+    live_queries = []
+
+    def _get_live_rows(date_from, date_to):
+        live_queries.append((date_from, date_to))
+        return [_get_live_row(date_from, 5, 1, 10, 1, '1'), _get_live_row(date_to, 6, 1, 10, 1, '1')]
+
+    monkeypatch.setattr(gtfs_rides_agg, 'get_live_rows', _get_live_rows)
+    date = datetime.date(2023, 5, 1)
+    gtfs_rides_agg.get_groups([], date, date + datetime.timedelta(days=1))
+    date_from, date_to = date - datetime.timedelta(days=3), date + datetime.timedelta(days=3)
+    live_queries.clear()
+    # each request builds at most MAX_REQUEST_BUILD_DAYS missing days, the other missing days are queried live
+    groups, live_date_ranges = gtfs_rides_agg.get_groups([], date_from, date_to)
+    assert live_queries == [(date_from, date_from + datetime.timedelta(days=1))]
+    assert live_date_ranges == [(date - datetime.timedelta(days=1), date - datetime.timedelta(days=1)), (date + datetime.timedelta(days=2), date_to)]
+    assert groups == [{'total_routes': 4, 'total_planned_rides': 8, 'total_actual_rides': 4}]
+    # contiguous runs of missing days are queried separately
+    live_queries.clear()
+    groups, live_date_ranges = gtfs_rides_agg.get_groups([], date_from, date_to)
+    assert live_queries == [(date - datetime.timedelta(days=1), date - datetime.timedelta(days=1)), (date + datetime.timedelta(days=2), date + datetime.timedelta(days=2))]
+    assert live_date_ranges == [(date_to, date_to)]
+    live_queries.clear()
+    groups, live_date_ranges = gtfs_rides_agg.get_groups([], date_from, date_to)
+    assert live_queries == [(date_to, date_to)]
+    assert live_date_ranges == []
+    assert groups == [{'total_routes': 10, 'total_planned_rides': 20, 'total_actual_rides': 10}]
+
+
+def test_merge_groups():
+    assert gtfs_rides_agg.merge_groups(['line_ref'], [
+        [{'route_short_name': '["1"]', 'route_long_name': '[null]', 'line_ref': 10, 'total_routes': 1, 'total_planned_rides': 2, 'total_actual_rides': 1}],
+        [{'route_short_name': '["2", "1"]', 'route_long_name': '["a"]', 'line_ref': 10, 'total_routes': 1, 'total_planned_rides': 1, 'total_actual_rides': 0},
+         {'route_short_name': '["3"]', 'route_long_name': '["b"]', 'line_ref': 11, 'total_routes': 1, 'total_planned_rides': 1, 'total_actual_rides': 0}],
+    ]) == [
+        {'route_short_name': '["1", "2"]', 'route_long_name': '["a", null]', 'line_ref': 10, 'total_routes': 2, 'total_planned_rides': 3, 'total_actual_rides': 1},
+        {'route_short_name': '["3"]', 'route_long_name': '["b"]', 'line_ref': 11, 'total_routes': 1, 'total_planned_rides': 1, 'total_actual_rides': 0},
+    ]
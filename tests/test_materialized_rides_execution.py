@@ -0,0 +1,105 @@
+import datetime
+
+from open_bus_stride_api.materialized import store, rides_execution
+
+
+def _get_stored_rides(operator_ref, line_refs, date_from, date_to):
+    materialized_date_to, live_date_ranges = rides_execution.build_rides(operator_ref, line_refs, date_from, date_to)
+    connection = rides_execution.get_connection()
+    try:
+        return list(rides_execution.iter_stored_rides(connection, rides_execution.RIDE_FIELDS, operator_ref, line_refs, date_from, materialized_date_to, live_date_ranges))
+    finally:
+        connection.close()
+
+
+def test_build_rides_materializes_closed_days(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'MATERIALIZED_DIR', str(tmp_path))
+    live_queries = []
+    tz = datetime.timezone(datetime.timedelta(hours=3))
+
+    def _get_live_rides(date_from, date_to, route_condition, params):
+        live_queries.append((date_from, date_to, params['line_refs']))
+        return [
+            (1, 2, date_from, datetime.datetime(2023, 5, 1, 10, tzinfo=tz), datetime.datetime(2023, 5, 1, 10, tzinfo=tz), 5, 15),
+            (1, 2, date_to, None, datetime.datetime(2023, 5, 2, 10, tzinfo=tz), 6, None),
+            (1, 3, date_to, None, datetime.datetime(2023, 5, 2, 11, tzinfo=tz), 7, None),
+        ]
+
+    monkeypatch.setattr(rides_execution, 'get_live_rides', _get_live_rides)
+    date_from, date_to = datetime.date(2023, 5, 1), datetime.date(2023, 5, 2)
+    for _ in range(2):
+        rides = _get_stored_rides(1, [2], date_from, date_to)
+        assert [(ride['gtfs_ride_id'], ride['siri_ride_id']) for ride in rides] == [(5, 15), (6, None)]
+        assert [ride['actual_start_time'] for ride in rides] == [datetime.datetime(2023, 5, 1, 10, tzinfo=tz), None]
+    # missing days are materialized using a single live query
+    assert live_queries == [(date_from, date_to, [2])]
+    # all the lines of the operator
+    for _ in range(2):
+        rides = _get_stored_rides(1, None, date_from, date_to)
+        assert sorted((ride['line_ref'], ride['gtfs_ride_id']) for ride in rides) == [(2, 5), (2, 6), (3, 7)]
+    assert live_queries[1:] == [(date_from, date_to, None)]
+    # lines which were materialized with all the lines of the operator
+    rides = _get_stored_rides(1, [3, 2], date_from, date_to)
+    assert sorted(ride['gtfs_ride_id'] for ride in rides) == [5, 6, 7]
+    assert len(live_queries) == 2
+    # days which are not closed yet are queried live
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    materialized_date_to, live_date_ranges = rides_execution.build_rides(1, [2], today - datetime.timedelta(days=3), today)
+    assert live_date_ranges == [(materialized_date_to + datetime.timedelta(days=1), today)]
+    monkeypatch.setattr(store, 'MATERIALIZED_ENABLED', False)
+    assert rides_execution.build_rides(1, [2], date_from, date_to) is None
+    sql, params = rides_execution.get_live_rides_sql(1, [2], date_from, date_to)
+    assert (params['date_from'], params['date_to_exclusive']) == (date_from, date_to + datetime.timedelta(days=1))
+
+
+def test_iter_stored_rides_pagination(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'MATERIALIZED_DIR', str(tmp_path))
+    date = datetime.date(2023, 5, 1)
+    tz = datetime.timezone(datetime.timedelta(hours=3))
+    planned_start_times = [datetime.datetime(2023, 5, 1, hour, tzinfo=tz) for hour in range(3)] + [None, None]
+    rides = [(1, 2, date, None, planned_start_time, i, None) for i, planned_start_time in enumerate(planned_start_times)]
+    connection = rides_execution.get_connection()
+    try:
+        rides_execution.set_stored_rides(connection, {date}, list(reversed(rides)), 1, [2])
+        order_by_args = [('asc', 'planned_start_time'), ('asc', 'gtfs_ride_id')]
+        fieldnames = ['planned_start_time', 'gtfs_ride_id']
+        pages, cursor_values = [], None
+        while True:
+            # the stored times are utc, cursor values are compared as times and not as text
+            page = list(rides_execution.iter_stored_rides(connection, fieldnames, 1, [2], date, date, (), order_by_args, cursor_values, 2))
+            pages.append([ride['gtfs_ride_id'] for ride in page])
+            if len(page) < 2:
+                break
+            cursor_values = [page[-1][fieldname].astimezone(tz) if fieldname == 'planned_start_time' and page[-1][fieldname] else page[-1][fieldname] for fieldname in fieldnames]
+        # nulls are ordered last
+        assert pages == [[0, 1], [2, 3], [4]]
+        assert rides_execution.count_stored_rides(connection, 1, [2], date, date) == 5
+        assert rides_execution.count_stored_rides(connection, 1, [2], date, date, [(date, date)]) == 0
+    finally:
+        connection.close()
+
+
+def test_build_rides_build_days_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'MATERIALIZED_DIR', str(tmp_path))
+    monkeypatch.setattr(store, 'MAX_REQUEST_BUILD_DAYS', 2)
+    live_queries = []
+
+    def _get_live_rides(date_from, date_to, route_condition, params):
+        live_queries.append((date_from, date_to))
+        return []
+
+    monkeypatch.setattr(rides_execution, 'get_live_rides', _get_live_rides)
+    date_from, date_to = datetime.date(2023, 5, 1), datetime.date(2023, 5, 3)
+    # each request materializes at most MAX_REQUEST_BUILD_DAYS missing days, the other missing days are queried live
+    assert rides_execution.build_rides(1, [2], date_from, date_to) == (date_to, [(date_to, date_to)])
+    assert live_queries == [(date_from, date_to - datetime.timedelta(days=1))]
+    assert rides_execution.build_rides(1, [2], date_from, date_to) == (date_to, [])
+    assert live_queries[1:] == [(date_to, date_to)]
+    assert rides_execution.build_rides(1, [2], date_from, date_to) == (date_to, [])
+    assert len(live_queries) == 2
+    # contiguous runs of missing days are queried separately
+    date = date_to + datetime.timedelta(days=2)
+    rides_execution.build_rides(1, [2], date, date)
+    del live_queries[:]
+    rides_execution.build_rides(1, [2], date_from, date + datetime.timedelta(days=1))
+    assert live_queries == [(date - datetime.timedelta(days=1), date - datetime.timedelta(days=1)), (date + datetime.timedelta(days=1), date + datetime.timedelta(days=1))]
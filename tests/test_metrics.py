@@ -0,0 +1,43 @@
+import fastapi
+from fastapi.testclient import TestClient
+
+from open_bus_stride_api.common import metrics, serialization
+
+
+def test_metrics_middleware():
+    app = fastapi.FastAPI()
+
+    @app.get('/items/{id}')
+    async def get_item(id: int):
+        metrics.add('rows', 3)
+        return serialization.get_json_response([{'id': id}] * 3)
+
+    app.add_middleware(metrics.MetricsMiddleware)
+    client = TestClient(app)
+    assert client.get('/items/1').status_code == 200
+    assert client.get('/items/2').status_code == 200
+    content, _ = metrics.get_metrics()
+    content = content.decode()
+    assert 'stride_api_request_seconds_count{method="GET",route="/items/{id}",status="200"} 2.0' in content
+    assert 'stride_api_rows_returned_total{route="/items/{id}"} 6.0' in content
+    assert 'stride_api_bytes_written_total{route="/items/{id}"} 56.0' in content
+    assert 'stride_api_serialization_seconds_count{route="/items/{id}"} 2.0' in content
+
+
+def test_server_timing_header():
+    app = fastapi.FastAPI()
+
+    @app.get('/items')
+    async def list_items():
+        metrics.add('db', 0.5)
+        metrics.add('db_execute', 0.2)
+        return serialization.get_json_response([{'id': 1}])
+
+    app.add_middleware(metrics.MetricsMiddleware)
+    res = TestClient(app).get('/items')
+    timings = dict(timing.split(';dur=') for timing in res.headers['server-timing'].split(', '))
+    assert list(timings) == ['db', 'fetch', 'encode', 'total']
+    assert timings['db'] == '200.0'
+    assert timings['fetch'] == '300.0'
+    assert float(timings['total']) >= 0
+    assert res.headers['timing-allow-origin'] == '*'
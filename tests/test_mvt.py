@@ -0,0 +1,47 @@
+import datetime
+
+from open_bus_stride_api.common import mvt
+from open_bus_stride_api.materialized import velocity_grid
+from open_bus_stride_api.routers import siri_velocity_aggregation, siri_vehicle_locations
+
+
+def test_encode_layer():
+    assert mvt.encode_layer('a', [(1, 2, {'n': 3, 's': 'x', 'empty': None})]) == (
+        # version, name
+        b'x\x02' b'\n\x01a'
+        # feature: tags, type point, geometry move to (1, 2)
+        b'\x12\r' b'\x12\x04\x00\x00\x01\x01' b'\x18\x01' b'"\x03\t\x02\x04'
+        # keys, values (sint 3, string x), extent
+        b'\x1a\x01n' b'\x1a\x01s' b'"\x020\x06' b'"\x03\n\x01x' b'(\x80 '
+    )
+
+
+def test_tile_pixels():
+    assert mvt.get_tile_pixel(0, 0, 0, 0, 0) == (2048, 2048)
+    bounds = mvt.get_tile_bounds(10, 610, 415)
+    assert mvt.get_tile_pixel(10, 610, 415, bounds['lon_min'] + 1e-9, bounds['lat_max'] - 1e-9) == (0, 0)
+    assert mvt.get_tile_pixel(10, 610, 415, bounds['lon_max'], bounds['lat_max']) is None
+
+
+def test_tile_cluster_size():
+    assert siri_vehicle_locations.get_tile_cluster_size(siri_vehicle_locations.TILE_MIN_ZOOM) == siri_vehicle_locations.TILE_CLUSTER_SIZE
+    assert siri_vehicle_locations.get_tile_cluster_size(siri_vehicle_locations.TILE_CLUSTER_MAX_ZOOM + 1) == siri_vehicle_locations.TILE_CLUSTER_SIZE // 2
+    assert siri_vehicle_locations.get_tile_cluster_size(mvt.MAX_ZOOM) == 1
+
+
+def test_velocity_aggregation_tile_features(monkeypatch):
+    requested_bounds = []
+
+    def _get_partials(recorded_from, recorded_to, rounding_precision, bounds):
+        requested_bounds.append(bounds)
+        return [(34.75, 31.5, 2, 30.0, 500.0), (30.0, 31.5, 1, 7.0, 49.0)]
+
+    monkeypatch.setattr(velocity_grid, 'get_partials', _get_partials)
+    recorded_from = datetime.datetime(2023, 5, 1, tzinfo=datetime.timezone.utc)
+    features = siri_velocity_aggregation.get_tile_features(8, 152, 104, recorded_from, recorded_from + datetime.timedelta(days=1), 2)
+    assert [(feature[2]['rounded_lon'], feature[2]['total_sample_count']) for feature in features] == [(34.75, 2)]
+    # tile bounds are extended by half a cell and limited to the stored grid bounds
+    assert requested_bounds[0]['lon_min'] == velocity_grid.BOUNDS['lon_min']
+    # tiles outside of the grid bounds are empty
+    assert siri_velocity_aggregation.get_tile_features(8, 0, 0, recorded_from, recorded_from + datetime.timedelta(days=1), 2) == []
+    assert len(requested_bounds) == 1
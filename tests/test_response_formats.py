@@ -0,0 +1,44 @@
+import datetime
+
+import pyarrow
+
+from open_bus_stride_api.common import response_formats
+
+
+ITEMS = [
+    {'id': 1, 'recorded_at_time': datetime.datetime(2022, 1, 1, 10, tzinfo=datetime.timezone.utc), 'name': 'a,b', 'bearing': None},
+    {'id': 2, 'recorded_at_time': datetime.datetime(2022, 1, 1, 11, tzinfo=datetime.timezone.utc), 'name': 'c', 'bearing': 90},
+]
+
+
+def _encode(response_format, *chunks):
+    encoder = response_formats.get_encoder(response_format)
+    return b''.join([*[encoder.encode(items) for items in chunks], encoder.finish()])
+
+
+def test_csv():
+    assert _encode('csv', ITEMS[:1], ITEMS[1:]).decode().splitlines() == [
+        'id,recorded_at_time,name,bearing',
+        '1,2022-01-01T10:00:00+00:00,"a,b",',
+        '2,2022-01-01T11:00:00+00:00,c,90',
+    ]
+
+
+def test_ndjson():
+    assert _encode('ndjson', ITEMS).decode().splitlines() == [
+        '{"id":1,"recorded_at_time":"2022-01-01T10:00:00+00:00","name":"a,b","bearing":null}',
+        '{"id":2,"recorded_at_time":"2022-01-01T11:00:00+00:00","name":"c","bearing":90}',
+    ]
+
+
+def test_arrow():
+    table = pyarrow.ipc.open_stream(_encode('arrow', ITEMS[:1], ITEMS[1:])).read_all()
+    assert table.num_rows == 2
+    assert table.schema.field('recorded_at_time').type == pyarrow.timestamp('us', tz='UTC')
+    # columns which are null in the first batch are encoded as strings
+    assert table.column('bearing').to_pylist() == [None, '90']
+
+
+def test_get_response_format():
+    assert response_formats.get_response_format(None) == 'json'
+    assert response_formats.get_response_format('parquet') == 'parquet'
@@ -1,5 +1,8 @@
 import datetime
 
+from open_bus_stride_api.routers import common as routers_common
+from open_bus_stride_api.common import admin
+
 from . import common
 
 
@@ -24,6 +27,33 @@ def test_gtfs_ride_stops_list_bad_arrival_time_range(client):
     assert res.json() == {'detail': 'Time range is longer than 30 days'}
 
 
+def test_gtfs_ride_stops_list_query_cost_budget(client, monkeypatch):
+    monkeypatch.setattr(routers_common, 'QUERY_COST_BUDGET', 1)
+    res = client.get(
+        '/gtfs_ride_stops/list',
+        params={'arrival_time_from': '2023-01-01T00:00:00+00:00', 'arrival_time_to': '2023-01-20T00:00:00+00:00', 'limit': 1000},
+    )
+    assert res.status_code == 400, f'expected 400, got {res.status_code}'
+    assert res.json()['detail'].startswith('Query is too expensive')
+    # queries with up to the default limit are not checked
+    res = client.get(
+        '/gtfs_ride_stops/list',
+        params={'arrival_time_from': '2023-01-01T00:00:00+00:00', 'arrival_time_to': '2023-01-20T00:00:00+00:00'},
+    )
+    assert res.status_code == 200, f'expected 200, got {res.status_code}'
+
+
+def test_list_limits(client, monkeypatch):
+    monkeypatch.setattr(routers_common, 'QUERY_COST_GUARD_MAX_LIMIT', 10)
+    monkeypatch.setattr(routers_common, 'QUERY_COST_GUARD_MAX_LIST_FILTER_ITEMS', 2)
+    res = client.get('/gtfs_agencies/list', params={'limit': 11})
+    assert res.status_code == 400, f'expected 400, got {res.status_code}'
+    assert res.json() == {'detail': 'due to abuse, maximum limit per request is 10 items, contact us if you need more'}
+    res = client.get('/gtfs_routes/list', params={'limit': 10, 'operator_refs': '1,2,3'})
+    assert res.status_code == 400, f'expected 400, got {res.status_code}'
+    assert res.json() == {'detail': 'too many items in list, maximum allowed is 2 items'}
+
+
 def test_gtfs_rides(client):
     common.assert_router_list_get(
         client, '/gtfs_rides',
@@ -108,3 +138,81 @@ def test_siri_vehicle_locations(client):
         client, '/siri_vehicle_locations',
         get_get_count_params=lambda items: {'siri_vehicle_location_ids': str(items[0]['id'])}
     )
+
+
+def test_siri_vehicle_locations_cursor_pagination(client):
+    res = client.get('/siri_vehicle_locations/list', params={'limit': 5})
+    assert res.status_code == 200
+    first_page_ids = [item['id'] for item in res.json()]
+    res = client.get('/siri_vehicle_locations/list', params={'limit': 5, 'cursor': res.headers['X-Next-Cursor']})
+    assert res.status_code == 200
+    second_page_ids = [item['id'] for item in res.json()]
+    assert len(second_page_ids) == 5
+    assert max(second_page_ids) < min(first_page_ids)
+
+
+def test_siri_vehicle_locations_count_modes(client):
+    for count_mode in ['estimate', 'bounded']:
+        res = client.get('/siri_vehicle_locations/list', params={'get_count': 'true', 'count_mode': count_mode})
+        assert res.status_code == 200
+        assert int(res.text) > 0
+        assert res.headers['X-Count-Mode'] == count_mode
+
+
+def test_siri_vehicle_locations_cache_control(client):
+    res = client.get('/siri_vehicle_locations/list', params={'limit': 1, 'recorded_at_time_to': '2023-05-22T00:00:00+00:00'})
+    assert res.status_code == 200
+    assert res.headers['Cache-Control'].startswith('public, max-age=')
+    res = client.get('/siri_vehicle_locations/get', params={'id': res.json()[0]['id']})
+    assert res.status_code == 200
+    assert res.headers['Cache-Control'].startswith('public, max-age=')
+    res = client.get('/siri_vehicle_locations/list', params={'limit': 1})
+    assert res.status_code == 200
+    assert res.headers['Cache-Control'] == 'no-cache'
+
+
+def test_gtfs_agencies_etag(client):
+    params = {'date_to': '2023-05-22'}
+    res = client.get('/gtfs_agencies/list', params=params)
+    assert res.status_code == 200
+    assert res.headers['Cache-Control'].startswith('public, max-age=')
+    etag = res.headers['ETag']
+    res = client.get('/gtfs_agencies/list', params=params, headers={'If-None-Match': etag})
+    assert res.status_code == 304
+    assert res.headers['ETag'] == etag
+    assert res.content == b''
+
+
+def test_siri_vehicle_locations_bbox(client):
+    res = client.get('/siri_vehicle_locations/list', params={'limit': 1})
+    assert res.status_code == 200
+    item = res.json()[0]
+    lon, lat = item['lon'], item['lat']
+    params = {'siri_vehicle_location_ids': str(item['id'])}
+    res = client.get('/siri_vehicle_locations/list', params={**params, 'bbox': f'{lon - 0.01},{lat - 0.01},{lon + 0.01},{lat + 0.01}'})
+    assert [i['id'] for i in res.json()] == [item['id']]
+    res = client.get('/siri_vehicle_locations/list', params={**params, 'bbox': f'{lon + 0.01},{lat + 0.01},{lon + 0.02},{lat + 0.02}'})
+    assert res.json() == []
+    res = client.get('/siri_vehicle_locations/list', params={'bbox': '1,2,3'})
+    assert res.status_code == 400
+
+
+def test_siri_vehicle_locations_debug_plan_headers(client, monkeypatch):
+    res = client.get('/siri_vehicle_locations/list', params={'limit': 1, 'debug_plan': 'true'})
+    assert res.status_code == 200
+    assert 'X-Plan-Cost' not in res.headers
+    assert res.headers['Server-Timing'].startswith('db;dur=')
+    monkeypatch.setattr(routers_common, 'DEBUG_PLAN_ENABLED', True)
+    # requires a configured admin token
+    res = client.get('/siri_vehicle_locations/list', params={'limit': 1, 'debug_plan': 'true'})
+    assert 'X-Plan-Cost' not in res.headers
+    monkeypatch.setattr(admin, 'ADMIN_TOKEN', 'secret')
+    res = client.get('/siri_vehicle_locations/list', params={'limit': 1, 'debug_plan': 'true'})
+    assert res.status_code == 200
+    assert 'X-Plan-Cost' not in res.headers
+    res = client.get('/siri_vehicle_locations/list', params={'limit': 1, 'debug_plan': 'true'}, headers={'X-Admin-Token': 'secret'})
+    assert res.status_code == 200
+    assert float(res.headers['X-Plan-Cost']) > 0
+    assert int(res.headers['X-Rows-Scanned']) >= 1
+    res = client.get('/siri_vehicle_locations/list', params={'limit': 1, 'debug_plan': 'true'}, headers={'Authorization': 'Bearer secret'})
+    assert float(res.headers['X-Plan-Cost']) > 0
@@ -0,0 +1,24 @@
+import json
+import enum
+import datetime
+
+import fastapi
+
+from open_bus_stride_api.common import serialization
+
+
+class _Status(enum.Enum):
+    success = 'success'
+
+
+def test_dumps_matches_jsonable_encoder():
+    items = [{
+        'id': 1,
+        'recorded_at_time': datetime.datetime(2022, 1, 1, 10, 0, 0, 123, tzinfo=datetime.timezone(datetime.timedelta(hours=2))),
+        'date': datetime.date(2022, 1, 2),
+        'status': _Status.success,
+        'lon': 34.808,
+        'name': 'תחנה',
+        'empty': None,
+    }]
+    assert json.loads(serialization.dumps(items)) == json.loads(json.dumps(fastapi.encoders.jsonable_encoder(items)))
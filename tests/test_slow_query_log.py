@@ -0,0 +1,41 @@
+import sqlalchemy
+
+from open_bus_stride_api.common import slow_query_log
+
+
+def test_normalize_sql():
+    assert slow_query_log.normalize_sql(
+        "SELECT a.id, b::text FROM a\n WHERE a.id IN (%(id_1_1)s, %(id_1_2)s) AND a.name = 'x''y' AND a.n > 5 LIMIT 100"
+    ) == "select a.id, b::text from a where a.id in (?) and a.name = ? and a.n > ? limit ?"
+    assert slow_query_log.normalize_sql('select * from a where a.date >= :date_from limit 10') == 'select * from a where a.date >= ? limit ?'
+
+
+def test_log_slow_query(monkeypatch):
+    monkeypatch.setattr(slow_query_log, '_fingerprints', slow_query_log.collections.OrderedDict())
+    monkeypatch.setattr(slow_query_log, 'SLOW_QUERY_EXPLAIN_SAMPLE_RATE', 0)
+    slow_query_log.log_slow_query('select * from a where id = %(id)s', {'id': 1}, 6)
+    slow_query_log.log_slow_query('select * from a where id = %(id)s', {'id': 2}, 8)
+    slow_query_log.log_slow_query('select * from b', {}, 10)
+    top = slow_query_log.get_top(order_by='total_seconds')
+    assert [(stats['normalized_sql'], stats['count'], stats['total_seconds']) for stats in top] == [
+        ('select * from a where id = ?', 2, 14), ('select * from b', 1, 10),
+    ]
+    assert top[0]['slowest_params'] == '{"id": 2}'
+    assert [stats['normalized_sql'] for stats in slow_query_log.get_top(limit=1, order_by='max_seconds')] == ['select * from b']
+
+
+def test_log_slow_query_explain_engine(monkeypatch):
+    monkeypatch.setattr(slow_query_log, '_fingerprints', slow_query_log.collections.OrderedDict())
+    monkeypatch.setattr(slow_query_log, 'SLOW_QUERY_EXPLAIN_SAMPLE_RATE', 1)
+    explains = []
+    monkeypatch.setattr(slow_query_log, '_submit_explain', lambda entry, engine, statement, parameters: explains.append((engine, statement)))
+    engine = sqlalchemy.create_engine('sqlite://')
+    # the plan is captured using the engine which executed the query, e.g. a replica
+    slow_query_log.log_slow_query('select * from a', {}, 6, engine)
+    assert explains == [(engine, 'select * from a')]
+    slow_query_log.log_slow_query('update a set b = 1', {}, 6, engine)
+    slow_query_log.log_slow_query('select * from a', {}, 6)
+    # asyncpg statements are not explained
+    monkeypatch.setattr(engine.dialect, 'is_async', True)
+    slow_query_log.log_slow_query('select * from a where id = $1', (1,), 6, engine)
+    assert len(explains) == 1
@@ -0,0 +1,43 @@
+import asyncio
+
+import sqlalchemy.exc
+
+from open_bus_stride_api.common import request_context, statement_timeout
+
+
+class _QueryCanceled(Exception):
+    pgcode = statement_timeout.QUERY_CANCELED_PGCODE
+
+
+def test_is_query_canceled():
+    assert statement_timeout.is_query_canceled(sqlalchemy.exc.OperationalError('select 1', {}, _QueryCanceled()))
+    assert not statement_timeout.is_query_canceled(sqlalchemy.exc.OperationalError('select 1', {}, Exception()))
+
+
+def test_run_cancellable_client_disconnected():
+    canceled = []
+
+    class _Connection:
+
+        def cancel(self):
+            canceled.append(True)
+
+    async def _receive():
+        await asyncio.sleep(0.01)
+        return {'type': 'http.disconnect'}
+
+    @statement_timeout.route_statement_timeout(5)
+    async def _route():
+        assert statement_timeout.get_statement_timeout_seconds() == 5
+        request_context.get_request_context()['db_connections'] = {'session': _Connection()}
+        return await statement_timeout.run_cancellable(asyncio.sleep(1, 'result'))
+
+    async def _main():
+        request_context._request_context.set({'scope': {}, 'response_headers': {}, 'receive': _receive, 'received_messages': []})
+        try:
+            await _route()
+        except statement_timeout.ClientDisconnectedError:
+            return True
+
+    assert asyncio.run(_main())
+    assert canceled == [True]
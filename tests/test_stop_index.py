@@ -0,0 +1,78 @@
+import random
+import threading
+import datetime
+
+from open_bus_stride_api.common import stop_index
+
+
+def get_random_stops(num_stops):
+    rnd = random.Random(42)
+    return [
+        {'id': i, 'date': datetime.date(2023, 5, 1), 'code': i, 'lat': rnd.uniform(31.5, 32.5), 'lon': rnd.uniform(34.5, 35.5),
+         'name': f'stop {i}', 'city': 'city'}
+        for i in range(num_stops)
+    ] + [{'id': num_stops, 'date': datetime.date(2023, 5, 1), 'code': num_stops, 'lat': None, 'lon': None, 'name': None, 'city': None}]
+
+
+def get_brute_force_result(stops, lat, lon):
+    return sorted(
+        (stop_index.get_distance_meters(lat, lon, stop['lat'], stop['lon']), stop['id'])
+        for stop in stops if stop['lat'] is not None
+    )
+
+
+def test_stop_index():
+    stops = get_random_stops(3000)
+    index = stop_index.StopIndex(stops)
+    assert len(index) == 3000
+    for lat, lon in [(32.0, 35.0), (31.5, 34.5), (33.0, 36.0), (32.123, 34.789)]:
+        expected = get_brute_force_result(stops, lat, lon)
+        res = index.nearest(lat, lon, 10, 200000)
+        assert [(stop['distance_meters'], stop['id']) for stop in res] == expected[:10]
+        res = index.within_radius(lat, lon, 5000, 1000)
+        assert [(stop['distance_meters'], stop['id']) for stop in res] == [item for item in expected if item[0] <= 5000]
+    assert index.nearest(0, 0, 10, 50000) == []
+    assert stop_index.StopIndex([]).nearest(32.0, 35.0, 10, 50000) == []
+
+
+def test_get_stop_index_loads_date_once(monkeypatch):
+    loaded_dates = []
+
+    def _load_stops(date):
+        loaded_dates.append(date)
+        return get_random_stops(10)
+
+    monkeypatch.setattr(stop_index, 'load_stops', _load_stops)
+    monkeypatch.setattr(stop_index, '_indexes', stop_index.cache.LRUCache(1))
+    for date in [datetime.date(2023, 5, 1), datetime.date(2023, 5, 1), datetime.date(2023, 5, 2), datetime.date(2023, 5, 1)]:
+        assert len(stop_index.get_stop_index(date)) == 10
+    assert loaded_dates == [datetime.date(2023, 5, 1), datetime.date(2023, 5, 2), datetime.date(2023, 5, 1)]
+
+
+def test_get_stop_index_loads_dates_concurrently(monkeypatch):
+    # loading a date doesn't block loading other dates
+    other_date_loaded = threading.Event()
+    waited = []
+
+    def _load_stops(date):
+        if date == datetime.date(2023, 5, 1):
+            waited.append(other_date_loaded.wait(5))
+        else:
+            other_date_loaded.set()
+        return get_random_stops(10)
+
+    monkeypatch.setattr(stop_index, 'load_stops', _load_stops)
+    monkeypatch.setattr(stop_index, '_indexes', stop_index.cache.LRUCache(2))
+    thread = threading.Thread(target=stop_index.get_stop_index, args=(datetime.date(2023, 5, 1),))
+    thread.start()
+    assert len(stop_index.get_stop_index(datetime.date(2023, 5, 2))) == 10
+    thread.join()
+    assert waited == [True]
+    assert len(stop_index.get_stop_index(datetime.date(2023, 5, 1))) == 10
+    assert stop_index._load_locks == {}
+
+
+def test_get_ttl_seconds():
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    assert stop_index.get_ttl_seconds(today - datetime.timedelta(days=2)) == stop_index.cache.CACHE_HISTORICAL_TTL_SECONDS
+    assert stop_index.get_ttl_seconds(today) == stop_index.cache.CACHE_CURRENT_TTL_SECONDS
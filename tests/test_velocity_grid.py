@@ -0,0 +1,96 @@
+import datetime
+import statistics
+
+from open_bus_stride_api.materialized import store, velocity_grid
+
+
+def test_get_cells_merges_partials():
+    day_1_values, day_2_values = [10.0, 20.0, 30.0], [40.0, 50.0]
+    partials = [
+        (34.5, 32.0, len(values), sum(values), sum(v * v for v in values))
+        for values in [day_1_values, day_2_values]
+    ] + [(35.0, 32.0, 1, 7.0, 49.0)]
+    cells = velocity_grid.get_cells(partials)
+    assert [(cell['rounded_lon'], cell['total_sample_count']) for cell in cells] == [(34.5, 5), (35.0, 1)]
+    assert cells[0]['average_rolling_avg'] == statistics.mean(day_1_values + day_2_values)
+    assert abs(cells[0]['stddev_rolling_avg'] - statistics.stdev(day_1_values + day_2_values)) < 1e-9
+    assert cells[1]['stddev_rolling_avg'] is None
+
+
+def test_get_partials_materializes_closed_days(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'MATERIALIZED_DIR', str(tmp_path))
+    live_queries = []
+
+    def _get_live_partials(recorded_from, recorded_to, rounding_precision, bounds):
+        live_queries.append((recorded_from, recorded_to, bounds))
+        if bounds == velocity_grid.BOUNDS:
+            return [(34.5, 32.0, 2, 30.0, 500.0), (35.75, 32.0, 1, 7.0, 49.0)]
+        return [(34.5, 32.0, 2, 30.0, 500.0)]
+
+    monkeypatch.setattr(velocity_grid, 'get_live_partials', _get_live_partials)
+    recorded_from = datetime.datetime(2023, 5, 1, tzinfo=datetime.timezone.utc)
+    recorded_to = recorded_from + datetime.timedelta(days=2)
+    bounds = {'lon_min': 34.25, 'lon_max': 35.0, 'lat_min': 29.5, 'lat_max': 33.33}
+    # israel midnight of the next day (+03:00)
+    day_start = datetime.datetime(2023, 5, 2, tzinfo=velocity_grid.TIMEZONE)
+    for _ in range(2):
+        assert velocity_grid.get_partials(recorded_from, recorded_to, 2, bounds) == [(34.5, 32.0, 2, 30.0, 500.0)] * 3
+    # the stored grid of the local day in range is built once for the full bounds, the partial days before and after it are live
+    assert live_queries[:3] == [
+        (day_start, day_start + datetime.timedelta(days=1), velocity_grid.BOUNDS),
+        (recorded_from, day_start, bounds),
+        (day_start + datetime.timedelta(days=1), recorded_to, bounds),
+    ]
+    assert live_queries[3:] == live_queries[1:3]
+    # the stored day is reused by requests with a different start time
+    del live_queries[:]
+    velocity_grid.get_partials(day_start - datetime.timedelta(hours=5), day_start + datetime.timedelta(days=1), 2, bounds)
+    assert live_queries == [(day_start - datetime.timedelta(hours=5), day_start, bounds)]
+    today = datetime.datetime.now(datetime.timezone.utc)
+    velocity_grid.get_partials(today, today + datetime.timedelta(days=1), 2, bounds)
+    assert live_queries[-1] == (today, today + datetime.timedelta(days=1), bounds)
+
+
+def test_get_partials_multiple_days(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'MATERIALIZED_DIR', str(tmp_path))
+    live_queries = []
+
+    def _get_live_partials(recorded_from, recorded_to, rounding_precision, bounds):
+        live_queries.append((recorded_from, recorded_to))
+        return [(34.5, 32.0, 2, 30.0, 500.0)]
+
+    monkeypatch.setattr(velocity_grid, 'get_live_partials', _get_live_partials)
+    recorded_from = datetime.datetime(2023, 5, 1, tzinfo=velocity_grid.TIMEZONE)
+    recorded_to = recorded_from + datetime.timedelta(days=2, hours=12)
+    partials = velocity_grid.get_partials(recorded_from, recorded_to, 2, velocity_grid.BOUNDS)
+    assert len(partials) == 3
+    # two full days are materialized, the remaining half day is calculated using the live query
+    assert live_queries == [
+        (recorded_from, recorded_from + datetime.timedelta(days=1)),
+        (recorded_from + datetime.timedelta(days=1), recorded_from + datetime.timedelta(days=2)),
+        (recorded_from + datetime.timedelta(days=2), recorded_to),
+    ]
+    assert velocity_grid.get_cells(partials)[0]['total_sample_count'] == 6
+    velocity_grid.get_partials(recorded_from, recorded_to, 2, velocity_grid.BOUNDS)
+    assert len(live_queries) == 4
+
+
+def test_get_partials_build_days_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'MATERIALIZED_DIR', str(tmp_path))
+    monkeypatch.setattr(store, 'MAX_REQUEST_BUILD_DAYS', 2)
+    live_queries = []
+
+    def _get_live_partials(recorded_from, recorded_to, rounding_precision, bounds):
+        live_queries.append((recorded_from, recorded_to))
+        return [(34.5, 32.0, 2, 30.0, 500.0)]
+
+    monkeypatch.setattr(velocity_grid, 'get_live_partials', _get_live_partials)
+    recorded_from = datetime.datetime(2023, 5, 1, tzinfo=velocity_grid.TIMEZONE)
+    recorded_to = recorded_from + datetime.timedelta(days=3)
+    # too many missing days, the full range is queried live without materializing
+    assert len(velocity_grid.get_partials(recorded_from, recorded_to, 2, velocity_grid.BOUNDS)) == 1
+    assert live_queries == [(recorded_from, recorded_to)]
+    velocity_grid.build('2023-05-01', 2, '2')
+    del live_queries[:]
+    assert len(velocity_grid.get_partials(recorded_from, recorded_to, 2, velocity_grid.BOUNDS)) == 3
+    assert live_queries == [(recorded_from + datetime.timedelta(days=2), recorded_to)]